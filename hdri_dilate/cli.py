@@ -0,0 +1,567 @@
+from __future__ import annotations
+
+import argparse
+import glob
+import itertools
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from dataclasses import fields
+from pathlib import Path
+
+from hdri_dilate.dilate.batch import FileReport, quiet_stdout, run_batch, run_pipeline
+from hdri_dilate.dilate.checkpoint import CheckpointConfig
+from hdri_dilate.dilate.engine import DilateParams
+from hdri_dilate.dilate.memory import format_size, parse_size
+from hdri_dilate.dilate.outputs import INPUT_SUFFIXES
+from hdri_dilate.enums import MorphShape, SaturationCriterion
+
+PROG = "hdri-dilate"
+
+
+def load_preset(path: str | Path) -> dict:
+    """Load a JSON preset of DilateParams fields
+
+    Raises
+    ------
+    ValueError
+        The preset is not an object or holds unknown parameters.
+
+    """
+    with open(path, encoding="utf-8") as f:
+        preset = json.load(f)
+
+    if not isinstance(preset, dict):
+        raise ValueError(f"The preset must be a JSON object: {path}")
+
+    DilateParams.from_dict(preset)
+    return preset
+
+
+def preset_defaults(preset: dict) -> dict:
+    """Map preset fields to option destinations, for ``set_defaults``"""
+    defaults = dict(preset)
+    if "max_workers" in defaults:
+        defaults["threads"] = defaults.pop("max_workers")
+
+    return defaults
+
+
+def add_dilate_arguments(parser: argparse.ArgumentParser, preset: dict = None):
+    """Add the MainWindow dilate settings as options, with the same defaults
+
+    Values of a ``preset`` replace the defaults, so options given on the
+    command line still override the preset.
+
+    """
+    group = parser.add_argument_group("dilate settings")
+    group.add_argument("--preset",
+                       help="JSON file of dilate settings, as named in DilateParams")
+    group.add_argument("--intensity", type=float, default=15.0,
+                       help="Minimum value of a saturated pixel (default: %(default)s)")
+    group.add_argument("--threshold", type=float, default=1.0,
+                       help="Stop growing once the average is below this value (default: %(default)s)")
+    group.add_argument("--final-intensity-multiplier", type=float, default=1.0,
+                       help="Multiplier of the averaged fill (default: %(default)s)")
+    group.add_argument("--saturation-criterion", default=SaturationCriterion.OTSU,
+                       choices=[
+                           SaturationCriterion.OTSU,
+                           SaturationCriterion.ANY_CHANNEL,
+                           SaturationCriterion.MAX_CHANNEL,
+                           SaturationCriterion.LUMINANCE,
+                       ],
+                       help="How saturated pixels are found (default: %(default)s)")
+    group.add_argument("--dilate-size", type=int, default=2,
+                       help="Dilate size in px (default: %(default)s)")
+    group.add_argument("--dilate-iteration", type=int, default=3,
+                       help="Dilate iteration (default: %(default)s)")
+    group.add_argument("--dilate-shape", default=MorphShape.ELLIPSIS,
+                       choices=[MorphShape.RECTANGLE, MorphShape.CROSS, MorphShape.ELLIPSIS],
+                       help="Dilate shape (default: %(default)s)")
+    group.add_argument("--threads", type=int, default=None,
+                       help="Dilate threads per file (default: CPU count divided by --jobs)")
+    group.add_argument("--max-radius", type=int, default=64,
+                       help="Parallel max radius in px (default: %(default)s)")
+    group.add_argument("--min-area", type=int, default=0,
+                       help="Min component area in px (default: %(default)s)")
+    group.add_argument("--small-area", type=int, default=0,
+                       help="Small component fast path area in px (default: %(default)s)")
+    group.add_argument("--wrap-seam", action="store_true",
+                       help="Wrap components across the equirectangular seam")
+    group.add_argument("--merge-components", action="store_true",
+                       help="Merge colliding components")
+    group.add_argument("--pyramid-levels", type=int, default=0, choices=range(4),
+                       help="Pyramid pre-pass levels, 0 to disable (default: %(default)s)")
+    group.add_argument("--auto-strategy", action="store_true",
+                       help="Pick the pyramid levels with the shortest predicted run time instead, "
+                            "logging why")
+    group.add_argument("--max-iterations", type=int, default=0,
+                       help="Growth steps per component before it is finished with a coarse estimate and "
+                            "flagged, 0 for no limit (default: %(default)s)")
+    group.add_argument("--max-component-seconds", type=float, default=0.0,
+                       help="Seconds of growth per component before it is finished with a coarse estimate and "
+                            "flagged, 0 for no limit (default: %(default)s)")
+    group.add_argument("--terminate-early", action="store_true",
+                       help="Terminate early when any channel hits the threshold")
+    group.add_argument("--use-bgr-order", action="store_true",
+                       help="Use BGR order")
+    group.add_argument("--no-blur", dest="use_blur", action="store_false",
+                       help="Do not feather the dilated masks")
+    group.add_argument("--blur-size", type=int, default=3,
+                       help="Blur size in px, odd (default: %(default)s)")
+    parser.set_defaults(parser=parser)
+    if preset:
+        parser.set_defaults(**preset_defaults(preset))
+
+
+def params_from_args(args: argparse.Namespace, jobs: int = 1) -> DilateParams:
+    # A kernel of no size or no iteration never grows the components
+    for option in ("dilate_size", "dilate_iteration"):
+        if getattr(args, option) < 1:
+            args.parser.error(f"--{option.replace('_', '-')} must be at least 1")
+
+    threads = args.threads
+    if threads is None:
+        threads = max((os.cpu_count() or 1) // max(jobs, 1), 1)
+
+    # Preset only fields without an option are carried by set_defaults too
+    values = {
+        param.name: getattr(args, param.name)
+        for param in fields(DilateParams)
+        if hasattr(args, param.name)
+    }
+    values["max_workers"] = threads
+    return DilateParams(**values)
+
+
+def is_input_file(path: Path) -> bool:
+    return path.is_file() and path.suffix.lower() in INPUT_SUFFIXES
+
+
+def collect_inputs(patterns: list[str]) -> list[Path]:
+    """Collect input files
+
+    Parameters
+    ----------
+    patterns : list[str]
+        Files, glob patterns or directories. Directories are searched for
+        .exr/.hdr files, not recursively.
+
+    Returns
+    -------
+    list[Path]
+        The matching .exr/.hdr files without duplicates, in the order given.
+
+    """
+    inputs = {}
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True) if glob.has_magic(pattern) else [pattern]
+        if not any(Path(match).exists() for match in matches):
+            print(f"{PROG}: nothing matches {pattern}", file=sys.stderr)
+
+        for match in sorted(matches):
+            path = Path(match)
+            if path.is_dir():
+                candidates = sorted(child for child in path.iterdir() if is_input_file(child))
+            else:
+                candidates = [path] if is_input_file(path) else []
+
+            for candidate in candidates:
+                inputs.setdefault(candidate.resolve(), candidate)
+
+    return list(inputs.values())
+
+
+def print_report(report: FileReport, done: int, total: int = None):
+    status = "done" if report.ok else "FAILED"
+    name = Path(report.image_path).name
+    count = f"{done}/{total}" if total else f"{done}"
+    fallback = ""
+    if report.fallback_labels:
+        fallback = f", {len(report.fallback_labels)} components over budget finished coarsely"
+    print(f"[{count}] {status} {name} in {report.seconds:0.2f} secs{fallback}", flush=True)
+    if not report.ok:
+        print(report.error, file=sys.stderr, flush=True)
+
+
+def print_summary(reports: list[FileReport], wall_seconds: float):
+    if not reports:
+        return
+
+    name_width = max(len(Path(report.image_path).name) for report in reports)
+    print()
+    print(f"{'File':<{name_width}}  {'Status':<6}  {'Load':>9}  {'Dilate':>9}  {'Write':>9}  {'Total':>9}")
+    for report in reports:
+        status = "ok" if report.ok else "failed"
+        print(
+            f"{Path(report.image_path).name:<{name_width}}  {status:<6}  "
+            f"{report.load_seconds:>9.2f}  {report.dilate_seconds:>9.2f}  "
+            f"{report.write_seconds:>9.2f}  {report.seconds:>9.2f}"
+        )
+
+    failed = sum(not report.ok for report in reports)
+    over_budget = [report for report in reports if report.fallback_labels]
+    if over_budget:
+        print(
+            f"{len(over_budget)} files have components over the growth budget: "
+            f"{', '.join(Path(report.image_path).name for report in over_budget)}"
+        )
+
+    # Stage times, as the pipeline totals also hold the time spent queued
+    total_seconds = sum(report.load_seconds + report.dilate_seconds + report.write_seconds for report in reports)
+    print(
+        f"{len(reports)} files, {failed} failed, "
+        f"{total_seconds:0.2f} secs of processing in {wall_seconds:0.2f} secs"
+    )
+
+
+def run_command(args: argparse.Namespace) -> int:
+    inputs = collect_inputs(args.inputs)
+    if not inputs:
+        print(f"{PROG}: no .exr/.hdr files found", file=sys.stderr)
+        return 2
+
+    if args.dry_run:
+        return dry_run_command(args, inputs)
+
+    if not args.output:
+        print(f"{PROG}: the -o/--output folder is required unless --dry-run is given", file=sys.stderr)
+        return 2
+
+    jobs = max(args.jobs, 1)
+    params = params_from_args(args, jobs=jobs)
+    done_count = itertools.count(1)
+    # Files already done or run by other nodes are skipped, so the count is unknown
+    total = None if args.queue or args.shared_queue else len(inputs)
+
+    def on_report(report: FileReport):
+        print_report(report, next(done_count), total)
+
+    if args.memory_budget is not None:
+        print(f"Memory budget {format_size(args.memory_budget)}")
+
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = CheckpointConfig(args.checkpoint, args.checkpoint_interval, args.checkpoint_minutes)
+        print(f"Checkpointing interrupted files in {args.checkpoint}")
+
+    start_time = time.perf_counter()
+    if args.queue and args.shared_queue:
+        print(f"{PROG}: --queue and --shared-queue cannot be used together", file=sys.stderr)
+        return 2
+
+    if args.queue:
+        reports = run_queued(args, inputs, params, jobs, on_report, checkpoint)
+        if reports is None:
+            return 2
+    elif args.shared_queue:
+        from hdri_dilate.dilate.distributed import node_name, run_distributed
+
+        if args.pipeline:
+            print(f"{PROG}: --shared-queue runs a process pool and cannot be used with --pipeline", file=sys.stderr)
+            return 2
+
+        print(
+            f"Node {node_name()} dilating {len(inputs)} files shared in {args.shared_queue} "
+            f"with {jobs} jobs of {params.max_workers} threads"
+        )
+        reports = run_distributed(
+            inputs,
+            args.output,
+            params,
+            args.shared_queue,
+            jobs=jobs,
+            lease_seconds=args.lease,
+            max_attempts=args.max_attempts,
+            verbose=args.verbose,
+            on_report=on_report,
+            memory_budget=args.memory_budget,
+            checkpoint=checkpoint,
+        )
+    elif args.pipeline:
+        print(
+            f"Dilating {len(inputs)} files in a pipeline of {args.readers} readers, "
+            f"{jobs} workers of {params.max_workers} threads and {args.writers} writers"
+        )
+        reports = run_pipeline(
+            inputs,
+            args.output,
+            params,
+            readers=args.readers,
+            workers=jobs,
+            writers=args.writers,
+            queue_depth=args.queue_depth,
+            verbose=args.verbose,
+            on_report=on_report,
+            memory_budget=args.memory_budget,
+            checkpoint=checkpoint,
+        )
+    else:
+        print(f"Dilating {len(inputs)} files with {jobs} jobs of {params.max_workers} threads")
+        reports = run_batch(
+            inputs,
+            args.output,
+            params,
+            jobs=jobs,
+            verbose=args.verbose,
+            on_report=on_report,
+            memory_budget=args.memory_budget,
+            checkpoint=checkpoint,
+        )
+
+    print_summary(reports, time.perf_counter() - start_time)
+
+    return 0 if all(report.ok for report in reports) else 1
+
+
+def dry_run_command(args: argparse.Namespace, inputs: list[Path]) -> int:
+    """Print the predictions of every file, one at a time, without writing anything"""
+    from hdri_dilate.dilate.engine import DilateEngine
+
+    params = params_from_args(args)
+    failed = 0
+    for image_path in inputs:
+        print(f"Dry run of {image_path}", flush=True)
+        try:
+            report = DilateEngine(params).dry_run_file(image_path, proxy_levels=args.proxy_levels)
+        except Exception as e:
+            print(f"{PROG}: {image_path}: {e}", file=sys.stderr, flush=True)
+            failed += 1
+            continue
+
+        for line in report.lines():
+            print(f"  {line}", flush=True)
+
+    return 1 if failed else 0
+
+
+def run_queued(
+    args: argparse.Namespace,
+    inputs: list[Path],
+    params: DilateParams,
+    jobs: int,
+    on_report,
+    checkpoint: CheckpointConfig = None,
+) -> list[FileReport] | None:
+    from hdri_dilate.dilate.jobqueue import JobQueue, run_queue
+
+    if args.pipeline:
+        print(f"{PROG}: --queue runs a process pool and cannot be used with --pipeline", file=sys.stderr)
+        return None
+
+    with JobQueue(args.queue, max_attempts=args.max_attempts) as queue:
+        counts = queue.add(inputs, args.output, params)
+        recovered = queue.recover()
+        print(
+            f"Queue {args.queue}: {counts['queued']} files to dilate, {counts['skipped']} already done, "
+            f"{recovered} recovered from dead workers"
+        )
+        print(f"Dilating with {jobs} jobs of {params.max_workers} threads")
+        reports = run_queue(
+            queue,
+            jobs=jobs,
+            max_workers=params.max_workers,
+            verbose=args.verbose,
+            on_report=on_report,
+            memory_budget=args.memory_budget,
+            checkpoint=checkpoint,
+        )
+        counts = queue.counts()
+        print(
+            f"Queue {args.queue}: {counts['done']} done, {counts['failed']} failed, "
+            f"{counts['pending']} pending, {counts['running']} running elsewhere"
+        )
+
+    return reports
+
+
+def watch_command(args: argparse.Namespace) -> int:
+    from hdri_dilate.dilate.watch import WatchDaemon
+
+    watch_folder = Path(args.folder)
+    if not watch_folder.is_dir():
+        print(f"{PROG}: not a folder: {watch_folder}", file=sys.stderr)
+        return 2
+
+    jobs = max(args.jobs, 1)
+    params = params_from_args(args, jobs=jobs)
+    done_count = itertools.count(1)
+
+    def on_report(report: FileReport):
+        print_report(report, next(done_count))
+
+    daemon = WatchDaemon(
+        watch_folder,
+        args.output,
+        params,
+        jobs=jobs,
+        settle_seconds=args.settle,
+        poll_interval=args.poll_interval,
+        use_inotify=not args.poll,
+        verbose=args.verbose,
+        on_report=on_report,
+    )
+    signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+
+    print(f"Starting {jobs} jobs of {params.max_workers} threads...", flush=True)
+    daemon.start()
+    print(f"Watching {watch_folder} with {daemon.watcher_name}, writing to {args.output}", flush=True)
+    daemon.run()
+    return 0
+
+
+def serve_command(args: argparse.Namespace) -> int:
+    from hdri_dilate.dilate.server import JobRunner, JobServer
+
+    jobs = max(args.jobs, 1)
+    params = params_from_args(args, jobs=jobs)
+    try:
+        server = JobServer((args.host, args.port), JobRunner(params, workers=jobs), verbose=args.verbose)
+    except OSError as e:
+        print(f"{PROG}: cannot listen on {args.host}:{args.port}: {e}", file=sys.stderr)
+        return 2
+
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+
+    host, port = server.server_address[:2]
+    print(f"Serving {jobs} workers of {params.max_workers} threads on http://{host}:{port}", flush=True)
+    with server, quiet_stdout(not args.verbose):
+        server.serve_forever()
+
+    return 0
+
+
+def build_parser(preset: dict = None) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog=PROG,
+        description="Fill saturated light sources of HDRIs without the GUI.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser(
+        "run",
+        help="Dilate files, globs or directories",
+        description="Dilate .exr/.hdr files and write the same outputs as the GUI.",
+    )
+    run_parser.add_argument("inputs", nargs="+",
+                            help="Files, glob patterns (quote them) or directories")
+    run_parser.add_argument("-o", "--output",
+                            help="Output folder, required unless --dry-run is given")
+    run_parser.add_argument("-j", "--jobs", type=int, default=1,
+                            help="Files dilated in parallel, one process each or one thread each "
+                                 "with --pipeline (default: %(default)s)")
+    run_parser.add_argument("--pipeline", action="store_true",
+                            help="Overlap loading, dilating and writing in one process")
+    run_parser.add_argument("--readers", type=int, default=1,
+                            help="Loading threads with --pipeline (default: %(default)s)")
+    run_parser.add_argument("--writers", type=int, default=1,
+                            help="Writing threads with --pipeline (default: %(default)s)")
+    run_parser.add_argument("--queue-depth", type=int, default=2,
+                            help="Images waiting between pipeline stages (default: %(default)s)")
+    run_parser.add_argument("--memory-budget", type=parse_size,
+                            help="Only start files while the sum of their estimated peak memory fits, e.g. 96G, "
+                                 "or auto for 80%% of the RAM. Estimates come from the image headers, large files "
+                                 "start first and run alone if they need the whole budget")
+    run_parser.add_argument("--queue",
+                            help="SQLite job queue file. Running the same command again resumes the batch, "
+                                 "skipping the files already done, and other processes may share the queue")
+    run_parser.add_argument("--shared-queue",
+                            help="Folder on a shared filesystem to split the files between nodes running "
+                                 "the same command, without any coordinator")
+    run_parser.add_argument("--lease", type=float, default=120.0,
+                            help="Seconds without a heartbeat before the file of a dead node is taken over, "
+                                 "with --shared-queue (default: %(default)s)")
+    run_parser.add_argument("--max-attempts", type=int, default=3,
+                            help="Attempts per file, per run with --queue or over all the nodes with "
+                                 "--shared-queue (default: %(default)s)")
+    run_parser.add_argument("--checkpoint",
+                            help="Folder to save the finished components of every file to as it runs. Running "
+                                 "the same command again resumes interrupted files from there, and the "
+                                 "checkpoint of a file is removed once its outputs are written")
+    run_parser.add_argument("--checkpoint-interval", type=int, default=500,
+                            help="Finished components between checkpoint saves (default: %(default)s)")
+    run_parser.add_argument("--checkpoint-minutes", type=float, default=5.0,
+                            help="Minutes between checkpoint saves, whichever comes first (default: %(default)s)")
+    run_parser.add_argument("--dry-run", action="store_true",
+                            help="Only find the connected components and print their count and areas, the "
+                                 "predicted iterations, peak memory and ETA, without dilating or writing anything")
+    run_parser.add_argument("--proxy-levels", type=int, default=0, choices=range(5),
+                            help="Find the components on an image downsampled by 2 ** levels "
+                                 "with --dry-run (default: %(default)s)")
+    run_parser.add_argument("-v", "--verbose", action="store_true",
+                            help="Print every growth step")
+    add_dilate_arguments(run_parser, preset)
+    run_parser.set_defaults(func=run_command)
+
+    watch_parser = subparsers.add_parser(
+        "watch",
+        help="Dilate the HDRIs landing in a folder",
+        description=(
+            "Keep a warm process pool and dilate new .exr/.hdr files in a folder once their size is stable. "
+            "Files already in the folder are dilated first unless all their outputs exist."
+        ),
+    )
+    watch_parser.add_argument("folder",
+                              help="Folder to watch, not recursively")
+    watch_parser.add_argument("-o", "--output", required=True,
+                              help="Output folder, may be the watched folder")
+    watch_parser.add_argument("-j", "--jobs", type=int, default=1,
+                              help="Files dilated in parallel, one process each (default: %(default)s)")
+    watch_parser.add_argument("--settle", type=float, default=2.0,
+                              help="Seconds a file has to stay unchanged before it is dilated (default: %(default)s)")
+    watch_parser.add_argument("--poll-interval", type=float, default=1.0,
+                              help="Seconds between checks (default: %(default)s)")
+    watch_parser.add_argument("--poll", action="store_true",
+                              help="Poll instead of using inotify, e.g. for network shares")
+    watch_parser.add_argument("-v", "--verbose", action="store_true",
+                              help="Print every growth step")
+    add_dilate_arguments(watch_parser, preset)
+    watch_parser.set_defaults(func=watch_command)
+
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Run a local HTTP job server",
+        description=(
+            "Queue dilation jobs submitted as JSON over HTTP on a warm process. "
+            "POST /jobs with {\"input\": path, \"output\": folder, \"params\": {...}}, "
+            "then GET /jobs/<id> for the status, progress and timings, or DELETE /jobs/<id> to cancel. "
+            "The dilate settings are the defaults of the submitted params."
+        ),
+    )
+    serve_parser.add_argument("--host", default="127.0.0.1",
+                              help="Address to listen on, there is no authentication (default: %(default)s)")
+    serve_parser.add_argument("--port", type=int, default=8765,
+                              help="Port to listen on (default: %(default)s)")
+    serve_parser.add_argument("-j", "--jobs", type=int, default=1,
+                              help="Files dilated in parallel, one thread each (default: %(default)s)")
+    serve_parser.add_argument("-v", "--verbose", action="store_true",
+                              help="Print every request and growth step")
+    add_dilate_arguments(serve_parser, preset)
+    serve_parser.set_defaults(func=serve_command)
+
+    return parser
+
+
+def main(argv: list[str] = None) -> int:
+    # The preset has to be known before parsing, as it replaces the defaults
+    preset_parser = argparse.ArgumentParser(add_help=False)
+    preset_parser.add_argument("--preset")
+    preset_args, _ = preset_parser.parse_known_args(argv)
+    preset = None
+    if preset_args.preset:
+        try:
+            preset = load_preset(preset_args.preset)
+        except (OSError, ValueError) as e:
+            print(f"{PROG}: invalid preset: {e}", file=sys.stderr)
+            return 2
+
+    parser = build_parser(preset)
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    except KeyboardInterrupt:
+        print(f"{PROG}: interrupted", file=sys.stderr)
+        return 130
@@ -0,0 +1,442 @@
+from __future__ import annotations
+
+import contextlib
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+from hdri_dilate.dilate.checkpoint import CheckpointConfig
+from hdri_dilate.dilate.engine import DilateEngine, DilateParams, load_hdri
+from hdri_dilate.dilate.memory import MemoryBudget, admission_order, estimate_file_peak_bytes
+from hdri_dilate.dilate.outputs import write_component_telemetry, write_outputs, write_run_report
+from hdri_dilate.dilate.profiling import StageProfiler, run_report
+
+
+@dataclass
+class FileReport:
+    """Outcome of dilating a single file
+
+    Attributes
+    ----------
+    image_path : str
+        The source HDRI path.
+    seconds : float
+        Wall clock time from loading the file to writing its last output.
+    load_seconds : float
+        Time spent loading the file.
+    dilate_seconds : float
+        Time spent dilating the file.
+    write_seconds : float
+        Time spent writing the outputs.
+    outputs : list[str]
+        The written paths, the run report and the component telemetry last.
+    fallback_labels : list[int]
+        The components that ran out of their growth budget and were
+        finished with a coarse estimate.
+    error : str | None
+        The traceback when the file failed.
+
+    """
+    image_path: str
+    seconds: float = 0.0
+    load_seconds: float = 0.0
+    dilate_seconds: float = 0.0
+    write_seconds: float = 0.0
+    outputs: list[str] = field(default_factory=list)
+    fallback_labels: list[int] = field(default_factory=list)
+    error: str | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+T_REPORT_CALLBACK = Callable[[FileReport], None]
+
+
+@contextlib.contextmanager
+def quiet_stdout(is_quiet=True):
+    """Silence the growth step prints of the engine, which flood batch logs"""
+    if not is_quiet:
+        yield
+        return
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+class _ReportStdout:
+    """Stdout of the pipeline threads, only passing on their reports
+
+    ``sys.stdout`` is process wide, so the threads cannot each redirect it
+    around their own dilation. This stream is installed once instead and
+    drops everything, except what is printed inside ``reporting``.
+
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text: str) -> int:
+        if getattr(self.local, "is_reporting", False):
+            return self.stream.write(text)
+
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    @contextlib.contextmanager
+    def reporting(self):
+        self.local.is_reporting = True
+        try:
+            yield
+        finally:
+            self.local.is_reporting = False
+
+
+def process_file(
+    image_path: str | Path,
+    output_folder: str | Path,
+    params: DilateParams,
+    verbose=False,
+    checkpoint: CheckpointConfig = None,
+) -> FileReport:
+    """Dilate a file and write its outputs
+
+    Runs in a pool process, so errors are reported instead of raised. With
+    a ``checkpoint``, an interrupted run of the file resumes from its
+    finished components, and the checkpoint is removed once the outputs are
+    written. The stage timings go to a run report beside the outputs, and
+    what every component did to a JSON lines file.
+
+    """
+    report = FileReport(str(image_path))
+    start_time = time.perf_counter()
+    try:
+        profiler = StageProfiler()
+        hdri = load_hdri(image_path, use_bgr_order=params.use_bgr_order, profiler=profiler)
+        report.load_seconds = time.perf_counter() - start_time
+
+        dilate_start_time = time.perf_counter()
+        engine = DilateEngine(params, checkpoint=checkpoint, profiler=profiler)
+        with quiet_stdout(not verbose):
+            output = engine.run(hdri)
+        report.dilate_seconds = time.perf_counter() - dilate_start_time
+        report.fallback_labels = output.fallback_labels
+
+        write_start_time = time.perf_counter()
+        outputs = write_outputs(output, image_path, output_folder, profiler=profiler)
+        report.write_seconds = time.perf_counter() - write_start_time
+        outputs.append(write_run_report(
+            run_report(image_path, params, profiler, output.fallback_labels, engine.telemetry),
+            image_path,
+            output_folder,
+        ))
+        outputs.append(write_component_telemetry(engine.telemetry, image_path, output_folder))
+        report.outputs = [str(path) for path in outputs]
+        engine.discard_checkpoint()
+    except Exception:
+        report.error = traceback.format_exc()
+
+    report.seconds = time.perf_counter() - start_time
+    return report
+
+
+def estimate_inputs(inputs: list[Path], params: DilateParams, memory_budget: int = None) -> dict[Path, int]:
+    """Estimated peak bytes of every input, all 0 without a budget to skip reading headers"""
+    if memory_budget is None:
+        return dict.fromkeys(inputs, 0)
+
+    return {image_path: estimate_file_peak_bytes(image_path, params) for image_path in inputs}
+
+
+def run_batch(
+    inputs: list[Path],
+    output_folder: str | Path,
+    params: DilateParams,
+    jobs: int = 1,
+    verbose=False,
+    on_report: T_REPORT_CALLBACK = None,
+    memory_budget: int = None,
+    checkpoint: CheckpointConfig = None,
+) -> list[FileReport]:
+    """Dilate files with a pool of ``jobs`` processes
+
+    With a ``memory_budget`` in bytes, files only start while the sum of
+    their peak memory estimates fits it. The largest start first, and
+    smaller ones fill what the running ones leave. With a ``checkpoint``,
+    files interrupted by a previous run resume from their finished
+    components.
+
+    ``on_report`` is called as files finish. Reports are returned in input
+    order.
+
+    """
+    reports = {}
+    budget = MemoryBudget(memory_budget)
+    estimates = estimate_inputs(inputs, params, memory_budget)
+    waiting = admission_order(inputs, estimates) if memory_budget else list(inputs)
+    running: dict[Future, Path] = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        try:
+            while waiting or running:
+                for image_path in list(waiting):
+                    if len(running) >= jobs:
+                        break
+
+                    if budget.try_acquire(estimates[image_path]):
+                        waiting.remove(image_path)
+                        future = executor.submit(
+                            process_file, image_path, output_folder, params, verbose, checkpoint
+                        )
+                        running[future] = image_path
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    image_path = running.pop(future)
+                    budget.release(estimates[image_path])
+                    try:
+                        report = future.result()
+                    except Exception:
+                        report = FileReport(str(image_path), error=traceback.format_exc())
+
+                    reports[image_path] = report
+                    if on_report:
+                        on_report(report)
+
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    return [reports[image_path] for image_path in inputs if image_path in reports]
+
+
+@dataclass
+class _PipelineItem:
+    image_path: Path
+    report: FileReport
+    start_time: float
+    payload: object = None
+    estimate: int = 0
+    engine: DilateEngine | None = None
+    profiler: StageProfiler = field(default_factory=StageProfiler)
+
+
+class _Stop:
+    """Queue sentinel telling a stage thread to exit"""
+
+
+def run_pipeline(
+    inputs: list[Path],
+    output_folder: str | Path,
+    params: DilateParams,
+    readers: int = 1,
+    workers: int = 1,
+    writers: int = 1,
+    queue_depth: int = 2,
+    verbose=False,
+    on_report: T_REPORT_CALLBACK = None,
+    memory_budget: int = None,
+    checkpoint: CheckpointConfig = None,
+) -> list[FileReport]:
+    """Dilate files in a load, dilate and write pipeline
+
+    Reader threads load the next files while worker threads dilate and
+    writer threads write the finished ones, so EXR decoding and encoding
+    overlap with the morphology. The stages are joined by queues holding at
+    most ``queue_depth`` images, which bounds memory to roughly
+    ``queue_depth * 2 + readers + workers + writers`` images in flight.
+
+    Everything runs in one process: OpenCV, NumPy and OpenEXR release the GIL
+    for the heavy lifting, and the images never need to be pickled between
+    processes.
+
+    With a ``memory_budget``, readers only load a file once its peak
+    estimate fits next to the files in flight, which are released as they
+    are written.
+
+    Parameters
+    ----------
+    inputs : list[Path]
+        The files to dilate.
+    output_folder : str | Path
+        The folder the outputs are written to.
+    params : DilateParams
+        The dilate parameters.
+    readers : int
+        Number of loading threads.
+    workers : int
+        Number of files dilated at the same time. Each uses
+        ``params.max_workers`` threads of its own.
+    writers : int
+        Number of writing threads.
+    queue_depth : int
+        Maximum number of images waiting between two stages.
+    verbose : bool
+        Keep the growth step prints.
+    on_report : T_REPORT_CALLBACK
+        Called from the stage threads as files finish or fail.
+    memory_budget : int
+        Optional budget in bytes for the files in flight.
+    checkpoint : CheckpointConfig
+        Optionally resume files interrupted by a previous run from their
+        finished components.
+
+    Returns
+    -------
+    list[FileReport]
+        The reports in input order.
+
+    """
+    path_queue = queue.Queue()
+    loaded_queue = queue.Queue(maxsize=max(queue_depth, 1))
+    dilated_queue = queue.Queue(maxsize=max(queue_depth, 1))
+    stop_event = threading.Event()
+    report_lock = threading.Lock()
+    reports = {}
+    budget = MemoryBudget(memory_budget)
+    estimates = estimate_inputs(inputs, params, memory_budget)
+    stdout = _ReportStdout(sys.stdout) if not verbose else None
+
+    def finish(item: _PipelineItem):
+        item.payload = None
+        item.engine = None
+        budget.release(item.estimate)
+        item.report.seconds = time.perf_counter() - item.start_time
+        with report_lock:
+            reports[item.image_path] = item.report
+            if on_report:
+                with stdout.reporting() if stdout is not None else contextlib.nullcontext():
+                    on_report(item.report)
+
+    def fail(item: _PipelineItem):
+        item.report.error = traceback.format_exc()
+        finish(item)
+
+    def put(target: queue.Queue, item):
+        # Keep checking for an abort while a full queue blocks the stage
+        while not stop_event.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def read():
+        while not stop_event.is_set():
+            try:
+                image_path = path_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            estimate = estimates[image_path]
+            while not budget.acquire(estimate, timeout=0.1):
+                if stop_event.is_set():
+                    return
+
+            item = _PipelineItem(image_path, FileReport(str(image_path)), time.perf_counter(), estimate=estimate)
+            try:
+                item.payload = load_hdri(image_path, use_bgr_order=params.use_bgr_order, profiler=item.profiler)
+                item.report.load_seconds = time.perf_counter() - item.start_time
+            except Exception:
+                fail(item)
+                continue
+
+            put(loaded_queue, item)
+
+    def dilate():
+        while not stop_event.is_set():
+            item = loaded_queue.get()
+            if isinstance(item, _Stop):
+                return
+
+            start_time = time.perf_counter()
+            try:
+                item.engine = DilateEngine(params, checkpoint=checkpoint, profiler=item.profiler)
+                item.payload = item.engine.run(item.payload)
+                item.report.dilate_seconds = time.perf_counter() - start_time
+                item.report.fallback_labels = item.payload.fallback_labels
+            except Exception:
+                fail(item)
+                continue
+
+            put(dilated_queue, item)
+
+    def write():
+        while not stop_event.is_set():
+            item = dilated_queue.get()
+            if isinstance(item, _Stop):
+                return
+
+            start_time = time.perf_counter()
+            try:
+                outputs = write_outputs(item.payload, item.image_path, output_folder, profiler=item.profiler)
+                item.report.write_seconds = time.perf_counter() - start_time
+                outputs.append(write_run_report(
+                    run_report(
+                        item.image_path,
+                        params,
+                        item.profiler,
+                        item.payload.fallback_labels,
+                        item.engine.telemetry,
+                    ),
+                    item.image_path,
+                    output_folder,
+                ))
+                outputs.append(write_component_telemetry(item.engine.telemetry, item.image_path, output_folder))
+                item.report.outputs = [str(path) for path in outputs]
+                item.engine.discard_checkpoint()
+            except Exception:
+                fail(item)
+                continue
+
+            finish(item)
+
+    def start(target, count: int, name: str) -> list[threading.Thread]:
+        threads = [
+            threading.Thread(target=target, name=f"{name}-{index}", daemon=True)
+            for index in range(max(count, 1))
+        ]
+        for thread in threads:
+            thread.start()
+
+        return threads
+
+    def join(threads: list[threading.Thread]):
+        # Short timeouts keep the main thread responsive to Ctrl+C
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=0.2)
+
+    for image_path in admission_order(inputs, estimates) if memory_budget else inputs:
+        path_queue.put(image_path)
+
+    with contextlib.redirect_stdout(stdout) if stdout is not None else contextlib.nullcontext():
+        try:
+            reader_threads = start(read, readers, "reader")
+            worker_threads = start(dilate, workers, "dilate")
+            writer_threads = start(write, writers, "writer")
+
+            # Every stage is told to stop once the stage feeding it is done
+            join(reader_threads)
+            for _ in worker_threads:
+                put(loaded_queue, _Stop())
+
+            join(worker_threads)
+            for _ in writer_threads:
+                put(dilated_queue, _Stop())
+
+            join(writer_threads)
+        except KeyboardInterrupt:
+            stop_event.set()
+            raise
+
+    return [reports[image_path] for image_path in inputs if image_path in reports]
@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import zipfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from hdri_dilate.dilate.components import ComponentResult
+
+if TYPE_CHECKING:
+    from hdri_dilate.dilate.engine import DilateParams
+
+# Settings that do not change the dilated components
+_RUNTIME_PARAMS = ("max_workers", "export_debug_interval", "iteration_cap")
+
+_HASH_BLOCK = 64 * 1024 * 1024
+
+
+def checkpoint_key(hdri: np.ndarray, params: DilateParams) -> str:
+    """Name of the checkpoint of an image dilated with some parameters
+
+    The pixels are hashed rather than the file, so a replaced file with the
+    same name never resumes from the checkpoint of the old one.
+
+    """
+    digest = hashlib.blake2b(digest_size=12)
+    digest.update(f"{hdri.shape}:{hdri.dtype}".encode())
+    digest.update(json.dumps(
+        {name: value for name, value in params.to_dict().items() if name not in _RUNTIME_PARAMS},
+        sort_keys=True,
+    ).encode())
+    flat = np.ascontiguousarray(hdri).reshape(-1).view(np.uint8)
+    for start in range(0, len(flat), _HASH_BLOCK):
+        digest.update(flat[start:start + _HASH_BLOCK])
+
+    return digest.hexdigest()
+
+
+@dataclass
+class CheckpointConfig:
+    """Where and how often a DilateEngine saves its finished components
+
+    Attributes
+    ----------
+    folder : str
+        The folder holding the checkpoints, one subfolder per image and
+        parameters.
+    every_components : int
+        Finished components between two saves.
+    every_minutes : float
+        Minutes between two saves, whichever comes first.
+
+    """
+    folder: str
+    every_components: int = 500
+    every_minutes: float = 5.0
+
+
+class ComponentCheckpoint:
+    """Finished components of a run, saved in chunks as they complete
+
+    Every chunk is a compressed .npz of the component results saved since
+    the previous chunk: their ROIs, boxes, fills and ROI sized masks, plus
+    the components they absorbed when merging. The composite is rebuilt
+    from them on resume, as compositing does not depend on the order
+    components are added in. Chunks are written aside and renamed, so a
+    crash while saving only loses the chunk being written.
+
+    Parameters
+    ----------
+    folder : str | Path
+        The folder of this image and parameters.
+    every_components : int
+        Finished components between two saves.
+    every_seconds : float
+        Seconds between two saves, whichever comes first.
+
+    """
+    def __init__(self, folder: str | Path, every_components: int = 500, every_seconds: float = 300.0):
+        self.folder = Path(folder)
+        self.every_components = max(every_components, 1)
+        self.every_seconds = every_seconds
+        self.lock = threading.Lock()
+        self.pending: list[tuple[ComponentResult, list[int]]] = []
+        self.chunk_index = 0
+        self.saved_count = 0
+        self.last_save_time = time.monotonic()
+
+    @classmethod
+    def for_run(cls, config: CheckpointConfig, hdri: np.ndarray, params: DilateParams) -> ComponentCheckpoint:
+        folder = Path(config.folder) / checkpoint_key(hdri, params)
+        return cls(folder, config.every_components, config.every_minutes * 60)
+
+    def _chunk_paths(self) -> list[Path]:
+        return sorted(self.folder.glob("chunk-*.npz"))
+
+    def load(self) -> list[tuple[ComponentResult, list[int]]]:
+        """Read the saved components and their absorbed labels
+
+        Unreadable chunks, such as one cut short by a full disk, are
+        skipped and their components are grown again.
+
+        """
+        components = []
+        for chunk_path in self._chunk_paths():
+            self.chunk_index = max(self.chunk_index, int(chunk_path.stem.split("-")[1]) + 1)
+            try:
+                components.extend(_read_chunk(chunk_path))
+            except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+                continue
+
+        self.saved_count = len(components)
+        return components
+
+    def record(self, result: ComponentResult, absorbed: list[int] = ()):
+        """Keep a finished component, saving a chunk when one is due
+
+        Called from the dilate threads.
+
+        """
+        with self.lock:
+            self.pending.append((result, list(absorbed)))
+            is_due = (
+                len(self.pending) >= self.every_components
+                or time.monotonic() - self.last_save_time >= self.every_seconds
+            )
+            if is_due:
+                self._save()
+
+    def save(self):
+        """Save the components finished since the last chunk"""
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        self.last_save_time = time.monotonic()
+        if not self.pending:
+            return
+
+        self.folder.mkdir(parents=True, exist_ok=True)
+        chunk_path = self.folder / f"chunk-{self.chunk_index:05}.npz"
+        temp_path = chunk_path.with_suffix(".tmp")
+        with open(temp_path, "wb") as f:
+            _write_chunk(f, self.pending)
+        os.replace(temp_path, chunk_path)
+
+        self.chunk_index += 1
+        self.saved_count += len(self.pending)
+        self.pending = []
+
+    def discard(self):
+        """Remove the checkpoint once the outputs are safely written"""
+        with self.lock:
+            self.pending = []
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def _write_chunk(f, components: list[tuple[ComponentResult, list[int]]]):
+    results = [result for result, _ in components]
+    absorbed = [labels for _, labels in components]
+    np.savez_compressed(
+        f,
+        labels=np.array([result.label for result in results], dtype=np.int64),
+        rois=np.array([result.roi for result in results], dtype=np.int64),
+        bboxes=np.array([result.bbox for result in results], dtype=np.int64),
+        fills=np.array([result.fill for result in results], dtype=np.float64),
+        iterations=np.array([result.iterations for result in results], dtype=np.int64),
+        fallbacks=np.array([result.fallback for result in results], dtype=bool),
+        terminated_early=np.array([result.terminated_early for result in results], dtype=bool),
+        masks=np.concatenate([result.mask.ravel() for result in results]),
+        mask_offsets=np.cumsum([0] + [result.mask.size for result in results]),
+        absorbed=np.array([label for labels in absorbed for label in labels], dtype=np.int64),
+        absorbed_offsets=np.cumsum([0] + [len(labels) for labels in absorbed]),
+    )
+
+
+def _read_chunk(chunk_path: Path) -> list[tuple[ComponentResult, list[int]]]:
+    with np.load(chunk_path) as chunk:
+        data = {name: chunk[name] for name in chunk.files}
+
+    components = []
+    for index, label in enumerate(data["labels"]):
+        x0, y0, x1, y1 = (int(v) for v in data["rois"][index])
+        mask = data["masks"][data["mask_offsets"][index]:data["mask_offsets"][index + 1]]
+        result = ComponentResult(
+            label=int(label),
+            roi=(x0, y0, x1, y1),
+            mask=mask.reshape(y1 - y0, x1 - x0),
+            bbox=tuple(int(v) for v in data["bboxes"][index]),
+            fill=tuple(float(v) for v in data["fills"][index]),
+            iterations=int(data["iterations"][index]),
+            fallback=bool(data["fallbacks"][index]),
+            terminated_early=bool(data["terminated_early"][index]),
+        )
+        absorbed = data["absorbed"][data["absorbed_offsets"][index]:data["absorbed_offsets"][index + 1]]
+        components.append((result, [int(label) for label in absorbed]))
+
+    return components
@@ -0,0 +1,529 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+
+# Boxes are (x0, y0, x1, y1) with exclusive x1/y1 in image pixel coordinates
+T_BOX = tuple[int, int, int, int]
+
+
+@dataclass
+class ComponentResult:
+    """Final state of a grown connected component
+
+    Attributes
+    ----------
+    label : int
+        The connected component label.
+    roi : T_BOX
+        The region of interest the mask was computed in.
+    mask : np.ndarray
+        The uint8 composite mask cropped to ``roi``. Values below 255 are
+        feathered edges and act as blend weights.
+    bbox : T_BOX
+        The bounding box of the non-zero pixels of ``mask``.
+    fill : tuple[float, float, float]
+        The averaged channel values used to fill the mask.
+    iterations : int
+        Number of growth steps taken.
+    fallback : bool
+        The component ran out of its growth budget and was finished with a
+        coarse estimate.
+    terminated_early : bool
+        The growth stopped because one channel fell below the threshold
+        while another was still above it, with ``terminate_early``.
+
+    """
+    label: int
+    roi: T_BOX
+    mask: np.ndarray
+    bbox: T_BOX
+    fill: tuple[float, float, float]
+    iterations: int
+    fallback: bool = False
+    terminated_early: bool = False
+
+
+def kernel_extents(kernel: np.ndarray) -> T_BOX:
+    """Kernel extents
+
+    Number of pixels a single ``cv2.dilate`` step can grow a mask towards
+    the left, top, right and bottom. ``cv2.dilate`` always anchors the
+    kernel at its center, so the extents are measured from there.
+
+    Parameters
+    ----------
+    kernel : np.ndarray
+        The structuring element.
+
+    Returns
+    -------
+    T_BOX
+        The (left, top, right, bottom) growth in pixels.
+
+    """
+    anchor_y, anchor_x = kernel.shape[0] // 2, kernel.shape[1] // 2
+    ys, xs = np.nonzero(kernel)
+    return (
+        int(xs.max() - anchor_x),
+        int(ys.max() - anchor_y),
+        int(anchor_x - xs.min()),
+        int(anchor_y - ys.min()),
+    )
+
+
+def expand_box(box: T_BOX, left: int, top: int, right: int, bottom: int, width: int, height: int) -> T_BOX:
+    x0, y0, x1, y1 = box
+    return (
+        max(x0 - left, 0),
+        max(y0 - top, 0),
+        min(x1 + right, width),
+        min(y1 + bottom, height),
+    )
+
+
+def box_contains(outer: T_BOX, inner: T_BOX) -> bool:
+    return (
+        outer[0] <= inner[0]
+        and outer[1] <= inner[1]
+        and outer[2] >= inner[2]
+        and outer[3] >= inner[3]
+    )
+
+
+def boxes_overlap(a: T_BOX, b: T_BOX) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def reembed_mask(mask: np.ndarray, roi: T_BOX, new_roi: T_BOX) -> np.ndarray:
+    """Copy a ROI-local mask into a larger ROI that contains it"""
+    new_mask = np.zeros((new_roi[3] - new_roi[1], new_roi[2] - new_roi[0]), dtype=mask.dtype)
+    x = roi[0] - new_roi[0]
+    y = roi[1] - new_roi[1]
+    new_mask[y:y + mask.shape[0], x:x + mask.shape[1]] = mask
+    return new_mask
+
+
+def mask_bbox(mask: np.ndarray, roi: T_BOX) -> T_BOX:
+    x, y, w, h = cv2.boundingRect(mask)
+    return roi[0] + x, roi[1] + y, roi[0] + x + w, roi[1] + y + h
+
+
+class ImageFrame:
+    """Image extent that boxes and ROIs are clipped to
+
+    With ``wrap_x`` the left and right edges are joined, as in equirectangular
+    panoramas. Boxes then keep unwrapped x coordinates that may fall outside
+    ``[0, width)``, crops gather their columns modulo the width, and a ROI
+    spanning the whole width is filtered with wrapped borders.
+
+    """
+    def __init__(self, width: int, height: int, wrap_x=False):
+        self.width = width
+        self.height = height
+        self.wrap_x = wrap_x
+
+    def expand(self, box: T_BOX, left: int, top: int, right: int, bottom: int) -> T_BOX:
+        if not self.wrap_x:
+            return expand_box(box, left, top, right, bottom, self.width, self.height)
+
+        x0, y0, x1, y1 = box
+        x0 -= left
+        x1 += right
+        if x1 - x0 >= self.width:
+            x0, x1 = 0, self.width
+
+        return x0, max(y0 - top, 0), x1, min(y1 + bottom, self.height)
+
+    def union(self, a: T_BOX, b: T_BOX) -> T_BOX:
+        """Smallest box holding both boxes
+
+        With ``wrap_x`` the second box is first shifted by whole image widths
+        to the side of the seam the first box is on.
+
+        """
+        if self.wrap_x and not self.is_full_width(a):
+            a_center = (a[0] + a[2]) / 2
+            b_center = (b[0] + b[2]) / 2
+            shift = round((a_center - b_center) / self.width) * self.width
+            b = (b[0] + shift, b[1], b[2] + shift, b[3])
+
+        x0, y0 = min(a[0], b[0]), min(a[1], b[1])
+        x1, y1 = max(a[2], b[2]), max(a[3], b[3])
+        if self.wrap_x and x1 - x0 >= self.width:
+            x0, x1 = 0, self.width
+
+        return x0, y0, x1, y1
+
+    def is_full_width(self, roi: T_BOX) -> bool:
+        return self.wrap_x and roi[2] - roi[0] >= self.width
+
+    def contains(self, outer: T_BOX, inner: T_BOX) -> bool:
+        if self.is_full_width(outer):
+            return outer[1] <= inner[1] and outer[3] >= inner[3]
+
+        return box_contains(outer, inner)
+
+    def columns(self, roi: T_BOX) -> slice | np.ndarray:
+        x0, x1 = roi[0], roi[2]
+        if 0 <= x0 and x1 <= self.width:
+            return slice(x0, x1)
+
+        return np.arange(x0, x1) % self.width
+
+    def crop(self, image: np.ndarray, roi: T_BOX) -> np.ndarray:
+        return image[roi[1]:roi[3], self.columns(roi)]
+
+    def reembed(self, mask: np.ndarray, roi: T_BOX, new_roi: T_BOX) -> np.ndarray:
+        if not self.is_full_width(new_roi) or self.is_full_width(roi):
+            return reembed_mask(mask, roi, new_roi)
+
+        new_mask = np.zeros((new_roi[3] - new_roi[1], self.width), dtype=mask.dtype)
+        y = roi[1] - new_roi[1]
+        new_mask[y:y + mask.shape[0], np.arange(roi[0], roi[2]) % self.width] = mask
+        return new_mask
+
+    def dilate(self, mask: np.ndarray, kernel: np.ndarray, roi: T_BOX, iterations: int = 1) -> np.ndarray:
+        if not self.is_full_width(roi):
+            return cv2.dilate(mask, kernel, iterations=iterations)
+
+        pad = max(kernel.shape)
+        for _ in range(iterations):
+            padded = cv2.copyMakeBorder(mask, 0, 0, pad, pad, cv2.BORDER_WRAP)
+            mask = cv2.dilate(padded, kernel)[:, pad:-pad]
+
+        return mask
+
+    def blur(self, mask: np.ndarray, blur_size: int, roi: T_BOX) -> np.ndarray:
+        kernel_sizes = (blur_size, blur_size)
+        if not self.is_full_width(roi):
+            return cv2.GaussianBlur(mask, kernel_sizes, 0)
+
+        pad = blur_size
+        padded = cv2.copyMakeBorder(mask, 0, 0, pad, pad, cv2.BORDER_WRAP)
+        return cv2.GaussianBlur(padded, kernel_sizes, 0)[:, pad:-pad]
+
+
+def split_wrapped_box(box: T_BOX, width: int) -> list[T_BOX]:
+    """Split an unwrapped box into the pieces it covers inside [0, width)"""
+    x0, y0, x1, y1 = box
+    if x1 - x0 >= width:
+        return [(0, y0, width, y1)]
+
+    if x0 < 0:
+        return [(x0 + width, y0, width, y1), (0, y0, x1, y1)]
+
+    if x1 > width:
+        return [(x0, y0, width, y1), (0, y0, x1 - width, y1)]
+
+    return [box]
+
+
+def wrapped_bbox(xs: np.ndarray, ys: np.ndarray, width: int) -> T_BOX:
+    """Wrapped bounding box
+
+    The tightest box around pixels on a horizontally wrapping image. It
+    starts after the widest run of empty columns, so a component crossing
+    the seam gets a negative x0.
+
+    """
+    columns = np.unique(xs)
+    gaps = np.diff(np.append(columns, columns[0] + width))
+    widest_gap = int(np.argmax(gaps))
+    x0 = int(columns[(widest_gap + 1) % len(columns)])
+    x1 = int(columns[widest_gap]) + 1
+    if x0 >= x1:
+        x0 -= width
+
+    return x0, int(ys.min()), x1, int(ys.max()) + 1
+
+
+class UnionFind:
+    """Disjoint set over integer labels with the smallest label as root"""
+    def __init__(self, size: int):
+        self.parents = np.arange(size)
+
+    def find(self, label: int) -> int:
+        root = label
+        while self.parents[root] != root:
+            root = self.parents[root]
+
+        while self.parents[label] != root:
+            self.parents[label], label = root, self.parents[label]
+
+        return int(root)
+
+    def union(self, a: int, b: int) -> int:
+        root_a = self.find(a)
+        root_b = self.find(b)
+        root = min(root_a, root_b)
+        self.parents[root_a] = root
+        self.parents[root_b] = root
+        return root
+
+    def roots(self) -> np.ndarray:
+        """The root of every label"""
+        roots = self.parents.copy()
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                return roots
+            roots = next_roots
+
+
+def merge_seam_labels(cc_labels: np.ndarray, stats: np.ndarray) -> int:
+    """Merge seam labels
+
+    Join connected components that touch across the left/right edge of an
+    equirectangular image, using the same 8-connectivity as
+    ``cv2.connectedComponentsWithStats``. ``cc_labels`` and ``stats`` are
+    updated in place. Merged labels keep the smallest label, the others are
+    left without pixels and with a zero area. The merged bounding boxes use
+    unwrapped x coordinates.
+
+    Parameters
+    ----------
+    cc_labels : np.ndarray
+        The label image.
+    stats : np.ndarray
+        The (N, 5) stats array.
+
+    Returns
+    -------
+    int
+        Number of labels merged away.
+
+    """
+    width = cc_labels.shape[1]
+    left = cc_labels[:, 0]
+    right = cc_labels[:, -1]
+    union_find = UnionFind(len(stats))
+    is_merged = False
+    for offset in (-1, 0, 1):
+        left_rows = left[max(offset, 0):len(left) + min(offset, 0)]
+        right_rows = right[max(-offset, 0):len(right) + min(-offset, 0)]
+        is_touching = (left_rows > 0) & (right_rows > 0)
+        for a, b in zip(left_rows[is_touching], right_rows[is_touching]):
+            if union_find.find(a) != union_find.find(b):
+                union_find.union(a, b)
+                is_merged = True
+
+    if not is_merged:
+        return 0
+
+    roots = union_find.roots()
+    np.take(roots.astype(cc_labels.dtype), cc_labels, out=cc_labels)
+
+    labels = np.arange(len(roots))
+    for root in np.unique(roots[roots != labels]):
+        members = roots == root
+        area = stats[members, cv2.CC_STAT_AREA].sum()
+        stats[members & (labels != root), cv2.CC_STAT_AREA] = 0
+
+        # Only the rows spanned by the merged components need to be searched
+        top = stats[members, cv2.CC_STAT_TOP].min()
+        bottom = (stats[members, cv2.CC_STAT_TOP] + stats[members, cv2.CC_STAT_HEIGHT]).max()
+        ys, xs = np.nonzero(cc_labels[top:bottom] == root)
+        x0, y0, x1, y1 = wrapped_bbox(xs, ys + top, width)
+        stats[root, cv2.CC_STAT_LEFT] = x0
+        stats[root, cv2.CC_STAT_TOP] = y0
+        stats[root, cv2.CC_STAT_WIDTH] = x1 - x0
+        stats[root, cv2.CC_STAT_HEIGHT] = y1 - y0
+        stats[root, cv2.CC_STAT_AREA] = area
+
+    return int(np.count_nonzero(roots != labels))
+
+
+def padded_bboxes(stats: np.ndarray, pad: int, width: int, height: int, wrap_x=False) -> np.ndarray:
+    """Padded bounding boxes
+
+    Convert ``cv2.connectedComponentsWithStats`` stats into (x0, y0, x1, y1)
+    boxes grown by ``pad`` on every side and clipped to the image. With
+    ``wrap_x`` the x coordinates are left unwrapped instead of clipped.
+
+    Parameters
+    ----------
+    stats : np.ndarray
+        The (N, 5) stats array.
+    pad : int
+        The maximum growth radius in pixels.
+    width : int
+        The image width.
+    height : int
+        The image height.
+    wrap_x : bool
+        The left and right image edges are joined.
+
+    Returns
+    -------
+    np.ndarray
+        The (N, 4) int64 boxes.
+
+    """
+    x = stats[:, cv2.CC_STAT_LEFT].astype(np.int64)
+    y = stats[:, cv2.CC_STAT_TOP].astype(np.int64)
+    w = stats[:, cv2.CC_STAT_WIDTH].astype(np.int64)
+    h = stats[:, cv2.CC_STAT_HEIGHT].astype(np.int64)
+    boxes = np.stack(
+        [
+            np.maximum(x - pad, 0),
+            np.maximum(y - pad, 0),
+            np.minimum(x + w + pad, width),
+            np.minimum(y + h + pad, height),
+        ],
+        axis=1,
+    )
+    if wrap_x:
+        boxes[:, 0] = x - pad
+        boxes[:, 2] = x + w + pad
+        is_full_width = boxes[:, 2] - boxes[:, 0] >= width
+        boxes[is_full_width, 0] = 0
+        boxes[is_full_width, 2] = width
+
+    return boxes
+
+
+class BBoxGridIndex:
+    """Uniform grid spatial index over bounding boxes
+
+    Every box is registered in each grid cell it covers, so an overlap query
+    only has to test the boxes sharing a cell with the query box. A key can
+    hold several boxes, e.g. both halves of a box crossing a wrapped seam.
+
+    """
+    def __init__(self, cell_size: int):
+        self.cell_size = max(int(cell_size), 1)
+        self.cells: defaultdict[tuple[int, int], list[int]] = defaultdict(list)
+        self.boxes: defaultdict[int, list[T_BOX]] = defaultdict(list)
+
+    def _cells(self, box: T_BOX):
+        size = self.cell_size
+        for cy in range(box[1] // size, (box[3] - 1) // size + 1):
+            for cx in range(box[0] // size, (box[2] - 1) // size + 1):
+                yield cx, cy
+
+    def insert(self, key: int, box: T_BOX):
+        self.boxes[key].append(box)
+        for cell in self._cells(box):
+            self.cells[cell].append(key)
+
+    def query(self, box: T_BOX) -> set[int]:
+        found = set()
+        for cell in self._cells(box):
+            for key in self.cells.get(cell, ()):
+                if key in found:
+                    continue
+
+                if any(boxes_overlap(box, other) for other in self.boxes[key]):
+                    found.add(key)
+        return found
+
+
+def conflict_free_batches(boxes: np.ndarray, labels: list[int], wrap_width: int = None) -> list[list[int]]:
+    """Conflict free batches
+
+    Group labels into batches whose boxes never overlap using greedy graph
+    coloring. Labels are colored in the given order and each takes the
+    lowest batch not already used by an overlapping box.
+
+    Parameters
+    ----------
+    boxes : np.ndarray
+        The (N, 4) padded boxes indexed by label.
+    labels : list[int]
+        The labels to batch.
+    wrap_width : int
+        The image width when boxes use unwrapped x coordinates.
+
+    Returns
+    -------
+    list[list[int]]
+        The batches, each holding labels in ascending order.
+
+    """
+    if not labels:
+        return []
+
+    sizes = np.concatenate([
+        boxes[labels, 2] - boxes[labels, 0],
+        boxes[labels, 3] - boxes[labels, 1],
+    ])
+    index = BBoxGridIndex(int(np.median(sizes)))
+    colors: dict[int, int] = {}
+    batches: list[list[int]] = []
+    for label in labels:
+        box = tuple(int(v) for v in boxes[label])
+        pieces = split_wrapped_box(box, wrap_width) if wrap_width else [box]
+        used = {colors[other] for piece in pieces for other in index.query(piece)}
+        color = 0
+        while color in used:
+            color += 1
+
+        colors[label] = color
+        for piece in pieces:
+            index.insert(label, piece)
+        if color == len(batches):
+            batches.append([])
+        batches[color].append(label)
+
+    return batches
+
+
+class ComponentPixelIndex:
+    """CSR style index of the pixels of every connected component label
+
+    The non-background pixels of the label image are sorted by label once,
+    so the pixels of any label are a contiguous slice of ``pixels`` between
+    ``offsets[label]`` and ``offsets[label + 1]``. Seed masks and ROI crops
+    are then built from that slice instead of comparing the whole label
+    image against every label.
+
+    """
+    def __init__(self, cc_labels: np.ndarray, total_labels: int):
+        self.height, self.width = cc_labels.shape
+        flat_labels = cc_labels.ravel()
+        flat_indices = np.flatnonzero(flat_labels)
+        labels = flat_labels[flat_indices]
+        self.pixels = flat_indices[np.argsort(labels, kind="stable")]
+
+        counts = np.bincount(labels, minlength=total_labels)
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+
+    def area(self, label: int) -> int:
+        return int(self.offsets[label + 1] - self.offsets[label])
+
+    def coordinates(self, label: int) -> tuple[np.ndarray, np.ndarray]:
+        """The (ys, xs) pixel coordinates of a label in row-major order"""
+        pixels = self.pixels[self.offsets[label]:self.offsets[label + 1]]
+        return np.divmod(pixels, self.width)
+
+    def seed_mask(self, label: int, roi: T_BOX) -> np.ndarray:
+        """Seed mask
+
+        Parameters
+        ----------
+        label : int
+            The connected component label.
+        roi : T_BOX
+            The region the mask is cropped to. It must contain the label and
+            may use unwrapped x coordinates.
+
+        Returns
+        -------
+        np.ndarray
+            The uint8 mask with 255 on the label pixels.
+
+        """
+        x0, y0, x1, y1 = roi
+        ys, xs = self.coordinates(label)
+        columns = xs - x0
+        if x0 < 0 or x1 > self.width:
+            columns %= self.width
+
+        mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        mask[ys - y0, columns] = 255
+        return mask
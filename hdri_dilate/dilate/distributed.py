@@ -0,0 +1,398 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import asdict
+from pathlib import Path
+
+from hdri_dilate.dilate.batch import FileReport, T_REPORT_CALLBACK, estimate_inputs, process_file
+from hdri_dilate.dilate.checkpoint import CheckpointConfig
+from hdri_dilate.dilate.engine import DilateParams
+from hdri_dilate.dilate.jobqueue import input_hash, outputs_exist, params_key
+from hdri_dilate.dilate.memory import MemoryBudget, admission_order
+
+
+def node_name() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def job_key(image_path: str | Path, output_folder: str | Path) -> str:
+    """Name of a job in the queue folder, the same on every node"""
+    image_path = Path(image_path).resolve()
+    digest = hashlib.sha1(f"{image_path}\0{Path(output_folder).resolve()}".encode()).hexdigest()
+    return f"{image_path.stem}-{digest[:12]}"
+
+
+def job_fingerprint(image_path: str | Path, params: DilateParams) -> dict[str, str]:
+    """What the result of a job has to match to count for this run
+
+    Changed params or a re-rendered input make the job run again.
+
+    """
+    return {"params_key": params_key(params.to_dict()), "input_hash": input_hash(image_path)}
+
+
+class SharedQueue:
+    """Coordinator-free job claiming in a folder on a shared filesystem
+
+    A node owns a job while it holds ``locks/<job>.lock``, created with
+    O_EXCL so only one node can create it, and keeps the lease alive by
+    touching it. A lock not touched for ``lease_seconds`` belongs to a dead
+    node and is stolen by renaming it away first, so only one node wins.
+    Outcomes go to ``results/<job>.json``, with the ``job_fingerprint`` of
+    the run. A result only settles a job with the same fingerprint, and a
+    success only while its outputs still exist, like ``JobQueue.add``.
+
+    Lease ages are measured against the mtime of a file this node just
+    touched, so they use the file server clock and tolerate clock skew
+    between the nodes.
+
+    Parameters
+    ----------
+    queue_folder : str | Path
+        The shared folder, created when missing.
+    lease_seconds : float
+        How long a lock may go without a heartbeat before it is stolen.
+    max_attempts : int
+        How many times a failing job is tried over all the nodes.
+
+    """
+    def __init__(self, queue_folder: str | Path, lease_seconds: float = 120.0, max_attempts: int = 3):
+        self.queue_folder = Path(queue_folder)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(max_attempts, 1)
+        self.node = node_name()
+
+        self.lock_folder = self.queue_folder / "locks"
+        self.result_folder = self.queue_folder / "results"
+        self.lock_folder.mkdir(parents=True, exist_ok=True)
+        self.result_folder.mkdir(parents=True, exist_ok=True)
+        self.clock_path = self.queue_folder / "nodes" / self.node
+        self.clock_path.parent.mkdir(exist_ok=True)
+
+        self.held: set[str] = set()
+        self.held_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.heartbeat_thread: threading.Thread | None = None
+
+    def _lock_path(self, key: str) -> Path:
+        return self.lock_folder / f"{key}.lock"
+
+    def _result_path(self, key: str) -> Path:
+        return self.result_folder / f"{key}.json"
+
+    def server_time(self) -> float:
+        """Current time of the file server, read back from a touched file"""
+        self.clock_path.touch()
+        return self.clock_path.stat().st_mtime
+
+    def result(self, key: str) -> dict | None:
+        try:
+            with open(self._result_path(key), encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def current_result(self, key: str, fingerprint: dict[str, str]) -> dict | None:
+        """The result of a job, unless it was for other params or another input"""
+        result = self.result(key)
+        if result is None or any(result.get(name) != value for name, value in fingerprint.items()):
+            return None
+
+        return result
+
+    def is_settled(self, key: str, fingerprint: dict[str, str]) -> bool:
+        """Done with its outputs still there, or failed on every attempt"""
+        result = self.current_result(key, fingerprint)
+        if result is None:
+            return False
+
+        if result["ok"]:
+            return outputs_exist(result["report"]["outputs"])
+
+        return result["attempts"] >= self.max_attempts
+
+    def claim(self, key: str, fingerprint: dict[str, str]) -> bool:
+        """Try to take a job, stealing an expired lease"""
+        if self.is_settled(key, fingerprint):
+            return False
+
+        lock_path = self._lock_path(key)
+        for _ in range(2):
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._steal(lock_path):
+                    return False
+                continue
+
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"node": self.node, "claimed_at": time.time()}, f)
+
+            # The job may have finished between the check and the lock
+            if self.is_settled(key, fingerprint):
+                lock_path.unlink(missing_ok=True)
+                return False
+
+            with self.held_lock:
+                self.held.add(key)
+            return True
+
+        return False
+
+    def _steal(self, lock_path: Path) -> bool:
+        """Take an expired lock away, returning whether to try creating it again
+
+        The lock is renamed away, so only one node gets it. When another
+        node stole and renewed it between the stat and the rename, it is a
+        fresh lock and is linked back. If a third node created a new lock
+        meanwhile, the link fails: the renamed lock is then left as is and
+        False returned, and the holder of the renamed lock stops renewing
+        ``lock_path`` as it no longer names it, see ``heartbeat``.
+
+        """
+        try:
+            age = self.server_time() - lock_path.stat().st_mtime
+        except FileNotFoundError:
+            # Released meanwhile, try creating it again
+            return True
+
+        if age < self.lease_seconds:
+            return False
+
+        stale_path = lock_path.with_name(f"{lock_path.name}.{self.node}.stale")
+        try:
+            os.rename(lock_path, stale_path)
+        except FileNotFoundError:
+            # Another node stole it first
+            return False
+
+        # Another node may have stolen and renewed the lock between the stat
+        # and the rename, in which case this is its fresh lock, put it back
+        if self.server_time() - stale_path.stat().st_mtime < self.lease_seconds:
+            try:
+                os.link(stale_path, lock_path)
+            except FileExistsError:
+                return False
+
+            stale_path.unlink(missing_ok=True)
+            return False
+
+        stale_path.unlink(missing_ok=True)
+        return True
+
+    def finish(self, key: str, report: FileReport, fingerprint: dict[str, str]):
+        """Record the outcome of a held job and release it"""
+        # Attempts only add up over failures of the same params and input
+        previous = self.current_result(key, fingerprint)
+        attempts = 1
+        if previous is not None and not previous["ok"]:
+            attempts += previous["attempts"]
+
+        result = {
+            "ok": report.ok,
+            "attempts": attempts,
+            "node": self.node,
+            **fingerprint,
+            "report": asdict(report),
+        }
+
+        # Written aside then renamed, so readers never see a partial file
+        result_path = self._result_path(key)
+        temp_path = result_path.with_name(f"{result_path.name}.{self.node}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        os.replace(temp_path, result_path)
+
+        self.release(key)
+
+    def _is_lock_owner(self, key: str) -> bool:
+        """Whether the lock of a job still names this node"""
+        try:
+            with open(self._lock_path(key), encoding="utf-8") as f:
+                return json.load(f).get("node") == self.node
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+
+    def release(self, key: str):
+        with self.held_lock:
+            self.held.discard(key)
+        if self._is_lock_owner(key):
+            self._lock_path(key).unlink(missing_ok=True)
+
+    def heartbeat(self):
+        """Renew the leases of the held jobs
+
+        A lock stolen after missing heartbeats, or replaced by the lock of
+        another node, is left alone, the job still finishes here.
+
+        """
+        with self.held_lock:
+            held = list(self.held)
+
+        for key in held:
+            if not self._is_lock_owner(key):
+                continue
+
+            try:
+                os.utime(self._lock_path(key))
+            except FileNotFoundError:
+                pass
+
+    def start_heartbeat(self):
+        def beat():
+            while not self.stop_event.wait(self.lease_seconds / 4):
+                self.heartbeat()
+
+        self.heartbeat_thread = threading.Thread(target=beat, name="heartbeat", daemon=True)
+        self.heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        self.stop_event.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+
+        self.clock_path.unlink(missing_ok=True)
+
+
+def append_node_log(output_folder: str | Path, node: str, report: FileReport):
+    """Append a report to the timing log of a node, next to the outputs"""
+    log_path = Path(output_folder) / "logs" / f"{node}.jsonl"
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(log_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"node": node, "finished_at": time.time(), **asdict(report)}) + "\n")
+
+
+def run_distributed(
+    inputs: list[Path],
+    output_folder: str | Path,
+    params: DilateParams,
+    queue_folder: str | Path,
+    jobs: int = 1,
+    lease_seconds: float = 120.0,
+    max_attempts: int = 3,
+    poll_interval: float = 2.0,
+    verbose=False,
+    on_report: T_REPORT_CALLBACK = None,
+    memory_budget: int = None,
+    checkpoint: CheckpointConfig = None,
+) -> list[FileReport]:
+    """Dilate files together with the other nodes sharing ``queue_folder``
+
+    Every node runs the same command. Each claims jobs as its ``jobs``
+    pool processes free up, and keeps waiting while other nodes hold the
+    remaining jobs, taking over the ones whose leases expire. It returns
+    once every job is done or out of attempts. With a ``memory_budget``,
+    each node only claims the jobs whose peak estimate fits next to its
+    running ones, largest first.
+
+    Parameters
+    ----------
+    inputs : list[Path]
+        The files to dilate, the same on every node.
+    output_folder : str | Path
+        The folder the outputs and the per-node timing logs are written to.
+    params : DilateParams
+        The dilate parameters.
+    queue_folder : str | Path
+        The shared folder holding the locks and results.
+    jobs : int
+        Number of pool processes on this node.
+    lease_seconds : float
+        How long a lock may go without a heartbeat before it is stolen.
+    max_attempts : int
+        How many times a failing job is tried over all the nodes.
+    poll_interval : float
+        Seconds between looks at the jobs held by other nodes.
+    verbose : bool
+        Keep the growth step prints.
+    on_report : T_REPORT_CALLBACK
+        Called as the files of this node finish.
+    memory_budget : int
+        Optional budget in bytes for the running jobs of this node.
+    checkpoint : CheckpointConfig
+        Optionally resume files interrupted mid file from their finished
+        components. On a shared folder, a node taking over the file of a
+        dead node resumes from its checkpoint.
+
+    Returns
+    -------
+    list[FileReport]
+        The reports of the jobs run by this node, in completion order.
+
+    """
+    jobs = max(jobs, 1)
+    queue = SharedQueue(queue_folder, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    budget = MemoryBudget(memory_budget)
+    estimates = estimate_inputs(inputs, params, memory_budget)
+    if memory_budget:
+        inputs = admission_order(inputs, estimates)
+
+    keys = {image_path: job_key(image_path, output_folder) for image_path in inputs}
+    fingerprints = {image_path: job_fingerprint(image_path, params) for image_path in inputs}
+    reports = []
+    running: dict[Future, Path] = {}
+
+    queue.start_heartbeat()
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            try:
+                while True:
+                    unsettled = [
+                        image_path for image_path, key in keys.items()
+                        if image_path not in running.values()
+                        and not queue.is_settled(key, fingerprints[image_path])
+                    ]
+                    for image_path in unsettled:
+                        if len(running) >= jobs:
+                            break
+
+                        if not budget.try_acquire(estimates[image_path]):
+                            continue
+
+                        if queue.claim(keys[image_path], fingerprints[image_path]):
+                            future = executor.submit(
+                                process_file, image_path, output_folder, params, verbose, checkpoint
+                            )
+                            running[future] = image_path
+                        else:
+                            budget.release(estimates[image_path])
+
+                    if not running:
+                        if not unsettled:
+                            break
+
+                        # Every remaining job is held by another node
+                        time.sleep(poll_interval)
+                        continue
+
+                    done, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        image_path = running.pop(future)
+                        budget.release(estimates[image_path])
+                        try:
+                            report = future.result()
+                        except Exception:
+                            report = FileReport(str(image_path), error=traceback.format_exc())
+
+                        queue.finish(keys[image_path], report, fingerprints[image_path])
+                        append_node_log(output_folder, queue.node, report)
+                        reports.append(report)
+                        if on_report:
+                            on_report(report)
+
+            except KeyboardInterrupt:
+                executor.shutdown(wait=False, cancel_futures=True)
+                for image_path in running.values():
+                    queue.release(keys[image_path])
+                raise
+    finally:
+        queue.stop_heartbeat()
+
+    return reports
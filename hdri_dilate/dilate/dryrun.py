@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from hdri_dilate.dilate.memory import format_size
+from hdri_dilate.dilate.strategy import StrategyEstimate
+
+# Lower bounds in px of the component area buckets of the report
+AREA_BUCKETS = (1, 10, 100, 1000, 10000)
+
+# More components than this usually means the intensity is too low
+MANY_COMPONENTS = 10000
+
+
+def area_bucket_names() -> list[str]:
+    names = [f"{low}-{high - 1} px" for low, high in zip(AREA_BUCKETS, AREA_BUCKETS[1:])]
+    return names + [f"{AREA_BUCKETS[-1]}+ px"]
+
+
+def area_bucket_indices(areas: np.ndarray) -> np.ndarray:
+    """Index of the AREA_BUCKETS bucket of every area"""
+    return np.digitize(areas, AREA_BUCKETS[1:])
+
+
+def sample_labels(labels: list[int], areas: np.ndarray, sample_size: int, seed: int = 0) -> list[int]:
+    """Pick the components whose growth is probed
+
+    The largest quarter of the sample is taken first, as the large
+    components dominate the run time, and the rest is drawn at random so
+    the many small ones are represented too.
+
+    Parameters
+    ----------
+    labels : list[int]
+        The candidate components.
+    areas : np.ndarray
+        The area of every candidate, in the same order.
+    sample_size : int
+        The number of components to pick at most.
+    seed : int
+        Seed of the random draw, so reports are reproducible.
+
+    """
+    if len(labels) <= sample_size:
+        return list(labels)
+
+    order = np.argsort(areas, kind="stable")[::-1]
+    largest_count = max(sample_size // 4, 1)
+    rest = order[largest_count:]
+    drawn = np.random.default_rng(seed).choice(rest, size=sample_size - largest_count, replace=False)
+    picked = np.sort(np.concatenate([order[:largest_count], drawn]))
+    return [labels[index] for index in picked]
+
+
+def impute_distances(areas: np.ndarray, sampled: dict[int, float]) -> np.ndarray:
+    """Growth distances of every component from the probed ones
+
+    A component that was not probed gets the median distance of the probed
+    components in its area bucket, or of all of them when its bucket has
+    none.
+
+    Parameters
+    ----------
+    areas : np.ndarray
+        The area of every component.
+    sampled : dict[int, float]
+        The probed distance by component index into ``areas``.
+
+    """
+    buckets = area_bucket_indices(areas)
+    overall = float(np.median(list(sampled.values()))) if sampled else 0.0
+    bucket_medians = {}
+    for bucket in np.unique(buckets):
+        distances = [distance for index, distance in sampled.items() if buckets[index] == bucket]
+        bucket_medians[bucket] = float(np.median(distances)) if distances else overall
+
+    distances = np.array([bucket_medians[bucket] for bucket in buckets], dtype=np.float64)
+    for index, distance in sampled.items():
+        distances[index] = distance
+
+    return distances
+
+
+@dataclass
+class DryRunReport:
+    """What a run would do, from the threshold mask and connected components only
+
+    Attributes
+    ----------
+    height, width : int
+        The image size.
+    proxy_levels : int
+        Pyramid levels the components were found on, 0 for full resolution.
+    component_count : int
+        The connected components found, without the background.
+    dilated_count : int
+        The components that would be grown, at least ``min_area``.
+    areas : np.ndarray
+        The full resolution area in px of every component.
+    sampled_count : int
+        The components whose growth was probed.
+    iterations : np.ndarray
+        The predicted growth iterations of every grown component.
+    estimates : list[StrategyEstimate]
+        The predicted cost of every strategy.
+    chosen : StrategyEstimate
+        The strategy the run would use.
+    reason : str
+        Why it would use it.
+    seconds : float
+        How long the dry run took.
+
+    """
+    height: int
+    width: int
+    proxy_levels: int
+    component_count: int
+    dilated_count: int
+    areas: np.ndarray
+    sampled_count: int
+    iterations: np.ndarray
+    estimates: list[StrategyEstimate] = field(default_factory=list)
+    chosen: StrategyEstimate | None = None
+    reason: str = ""
+    seconds: float = 0.0
+
+    @property
+    def warnings(self) -> list[str]:
+        warnings = []
+        if self.component_count > MANY_COMPONENTS:
+            warnings.append(
+                f"{self.component_count} connected components, the intensity is likely too low"
+            )
+        if self.component_count == 0:
+            warnings.append("No saturated pixels, the intensity is likely too high")
+
+        return warnings
+
+    def lines(self) -> list[str]:
+        """The report as log lines"""
+        scale = f", components found at 1/{2 ** self.proxy_levels} scale" if self.proxy_levels else ""
+        lines = [
+            f"Image {self.width}x{self.height}{scale}",
+            f"Connected components: {self.component_count}, {self.dilated_count} to dilate",
+        ]
+        if len(self.areas):
+            p50, p90, p99 = np.percentile(self.areas, (50, 90, 99))
+            lines.append(
+                f"Area px: min {int(self.areas.min())}, median {p50:0.0f}, p90 {p90:0.0f}, "
+                f"p99 {p99:0.0f}, max {int(self.areas.max())}"
+            )
+            counts = np.bincount(area_bucket_indices(self.areas), minlength=len(AREA_BUCKETS))
+            lines.append("Areas: " + ", ".join(
+                f"{name}: {count}" for name, count in zip(area_bucket_names(), counts)
+            ))
+
+        if len(self.iterations):
+            p50, p90 = np.percentile(self.iterations, (50, 90))
+            lines.append(
+                f"Predicted iterations from {self.sampled_count} probed components: "
+                f"median {p50:0.0f}, p90 {p90:0.0f}, max {int(self.iterations.max())}, "
+                f"total {int(self.iterations.sum())}"
+            )
+
+        for estimate in self.estimates:
+            lines.append(f"Strategy {estimate.describe()}")
+
+        if self.chosen is not None:
+            lines.append(
+                f"Would run {self.chosen.name} ({self.reason}): "
+                f"peak memory ~{format_size(self.chosen.peak_bytes)}, ETA ~{format_eta(self.chosen.seconds)}"
+            )
+
+        lines.extend(f"WARNING: {warning}" for warning in self.warnings)
+        lines.append(f"Dry run took {self.seconds:0.2f} secs")
+        return lines
+
+
+def format_eta(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:0.1f} secs"
+
+    minutes = math.ceil(seconds / 60)
+    if minutes < 60:
+        return f"{minutes} mins"
+
+    return f"{minutes // 60} h {minutes % 60:02d} mins"
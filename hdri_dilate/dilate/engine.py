@@ -0,0 +1,1311 @@
+from __future__ import annotations
+
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, field, fields
+from pathlib import Path
+from typing import Callable
+
+import cv2
+import numpy as np
+import OpenEXR
+
+from hdri_dilate.dilate.components import (
+    T_BOX,
+    ComponentPixelIndex,
+    ComponentResult,
+    ImageFrame,
+    UnionFind,
+    conflict_free_batches,
+    kernel_extents,
+    mask_bbox,
+    merge_seam_labels,
+    padded_bboxes,
+)
+from hdri_dilate.dilate.checkpoint import CheckpointConfig, ComponentCheckpoint
+from hdri_dilate.dilate.compositing import LabelCompositor
+from hdri_dilate.dilate.dryrun import DryRunReport, impute_distances, sample_labels
+from hdri_dilate.dilate.masks import saturation_mask
+from hdri_dilate.dilate.memory import process_memory
+from hdri_dilate.dilate.profiling import StageProfiler, profile_stage
+from hdri_dilate.dilate.pyramid import PyramidEstimator, downsample
+from hdri_dilate.dilate.strategy import (
+    PROBE_LEVELS,
+    available_memory,
+    choose_strategy,
+    estimate_strategies,
+)
+from hdri_dilate.dilate.telemetry import ComponentTelemetry
+from hdri_dilate.enums import MorphShape, SaturationCriterion
+from hdri_dilate.exr import load_exr
+
+# Called with the component label, the iteration and the four debug masks
+T_DEBUG_SINK = Callable[[int, int, tuple], None]
+
+
+def get_morph_shape(shape: str):
+    if shape == MorphShape.CROSS:
+        return cv2.MORPH_CROSS
+
+    if shape == MorphShape.ELLIPSIS:
+        return cv2.MORPH_ELLIPSE
+
+    return cv2.MORPH_RECT
+
+
+def get_distance_type(shape: str):
+    if shape == MorphShape.CROSS:
+        return cv2.DIST_L1
+
+    if shape == MorphShape.ELLIPSIS:
+        return cv2.DIST_L2
+
+    return cv2.DIST_C
+
+
+def load_hdri(image_path: str | Path, use_bgr_order=False, profiler: StageProfiler = None) -> np.ndarray:
+    """Load an .exr or .hdr image
+
+    The optional ``profiler`` times reading the EXR header and decoding the
+    pixels as the ``header`` and ``decode`` stages.
+
+    Raises
+    ------
+    FileNotFoundError
+        The image does not exist.
+
+    """
+    image_path = Path(image_path)
+    if not image_path.exists():
+        raise FileNotFoundError(f"The specified path does not exist: {image_path}")
+
+    if image_path.suffix.lower() == ".exr":
+        with profile_stage(profiler, "header"):
+            exr = OpenEXR.InputFile(str(image_path))
+
+        with profile_stage(profiler, "decode"):
+            return load_exr(
+                exr,
+                use_bgr_order=use_bgr_order,
+            )
+
+    # Assume valid .hdr file
+    with profile_stage(profiler, "decode"):
+        return cv2.imread(
+            str(image_path),
+            flags=cv2.IMREAD_ANYDEPTH,
+        )
+
+
+@dataclass
+class DilateParams:
+    """Dilate parameters
+
+    Attributes
+    ----------
+    intensity : float
+        The minimum value of a saturated pixel.
+    threshold : float
+        Components keep growing while their average exceeds this value.
+    final_intensity_multiplier : float
+        Multiplier applied to the averaged fill.
+    dilate_iteration : int
+        Kernel anchor and size factor.
+    dilate_size : int
+        Kernel size factor.
+    dilate_shape : str
+        The MorphShape of the kernel.
+    saturation_criterion : str
+        The SaturationCriterion of the threshold mask.
+    terminate_early : bool
+        Stop growing once any channel falls below the threshold.
+    use_bgr_order : bool
+        The image channels are in BGR order.
+    use_blur : bool
+        Feather the grown masks.
+    blur_size : int
+        The feathering Gaussian kernel size.
+    max_workers : int
+        Number of components grown in parallel.
+    max_radius : int
+        Padding around components used to batch them and to crop their ROI.
+    min_area : int
+        Components smaller than this are left as they are.
+    small_area : int
+        Components up to this area use the closed form growth.
+    wrap_seam : bool
+        The image is an equirectangular panorama wrapping horizontally.
+    merge_components : bool
+        Absorb the components a growing component reaches.
+    pyramid_levels : int
+        Levels of the growth estimation pre-pass, 0 to disable it.
+    auto_strategy : bool
+        Pick the pyramid levels with the shortest predicted run time
+        instead of ``pyramid_levels``. It does not lower the memory use.
+    export_debug_interval : int
+        Iterations between debug figures.
+    iteration_cap : int
+        Iterations between "taking longer than usual" messages.
+    max_iterations : int
+        Full resolution growth steps a component may take before it is
+        finished with a coarse estimate instead, 0 for no limit.
+    max_component_seconds : float
+        Seconds a component may grow before it is finished with a coarse
+        estimate instead, 0 for no limit.
+
+    """
+    intensity: float = 15.0
+    threshold: float = 1.0
+    final_intensity_multiplier: float = 1.0
+    dilate_iteration: int = 3
+    dilate_size: int = 2  # FIXME: Using high dilate size is slow...
+    dilate_shape: str = MorphShape.RECTANGLE
+    saturation_criterion: str = SaturationCriterion.OTSU
+    terminate_early: bool = False
+    use_bgr_order: bool = False
+    use_blur: bool = True
+    blur_size: int = 3
+    max_workers: int = field(default_factory=lambda: os.cpu_count() or 1)
+    max_radius: int = 64
+    min_area: int = 0
+    small_area: int = 0
+    wrap_seam: bool = False
+    merge_components: bool = False
+    pyramid_levels: int = 0
+    auto_strategy: bool = False
+    export_debug_interval: int = 10
+    iteration_cap: int = 100
+    max_iterations: int = 0
+    max_component_seconds: float = 0.0
+
+    @classmethod
+    def from_dict(cls, data: dict) -> DilateParams:
+        """Create from a dict such as a JSON preset, rejecting unknown keys"""
+        unknown = set(data) - {param.name for param in fields(cls)}
+        if unknown:
+            raise ValueError(f"Unknown dilate parameters: {', '.join(sorted(unknown))}")
+
+        return cls(**data)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class DilateProgress:
+    """Progress callbacks of a DilateEngine run
+
+    Every callback does nothing by default, override the ones needed. The
+    "taking longer than usual" messages are sent from the dilate threads.
+
+    """
+    def stage(self, message: str):
+        pass
+
+    def progress(self, value: int):
+        pass
+
+    def progress_max(self, value: int):
+        pass
+
+
+@dataclass
+class DilateOutput:
+    """Images produced by a DilateEngine run
+
+    Attributes
+    ----------
+    mask_thresh : np.ndarray
+        The (height, width) uint8 saturation mask.
+    mask_dilated : np.ndarray
+        The (height, width, 3) uint8 grown mask.
+    hdri_original : np.ndarray
+        The source HDRI.
+    hdri_dilated : np.ndarray
+        The HDRI with the grown components filled.
+    fallback_labels : list[int]
+        The components that ran out of their growth budget and were
+        finished with a coarse estimate.
+
+    """
+    mask_thresh: np.ndarray
+    mask_dilated: np.ndarray
+    hdri_original: np.ndarray
+    hdri_dilated: np.ndarray
+    fallback_labels: list[int] = field(default_factory=list)
+
+
+class DilateEngine:
+    """Fill saturated light sources with the average of their surroundings
+
+    Every connected component of saturated pixels is grown until the average
+    of the pixels it covers drops below the threshold, then filled with that
+    average. The engine does not depend on Qt: progress is reported through
+    a DilateProgress, and debug figures go to an optional debug sink that
+    also enables computing them.
+
+    Parameters
+    ----------
+    params : DilateParams
+        The dilate parameters.
+    progress : DilateProgress
+        Optional progress callbacks.
+    debug_sink : T_DEBUG_SINK
+        Optional receiver of the debug masks, called every
+        ``export_debug_interval`` iterations and once per finished component.
+        Components are processed one at a time while it is set.
+    checkpoint : CheckpointConfig
+        Optionally save the finished components as the run goes, and resume
+        from them when the same image is run again with the same parameters.
+        Call ``discard_checkpoint`` once the outputs are written.
+    profiler : StageProfiler
+        Receives the wall and CPU time of every stage of the run. A new one
+        is created when not given.
+
+    """
+    def __init__(
+        self,
+        params: DilateParams = None,
+        progress: DilateProgress = None,
+        debug_sink: T_DEBUG_SINK = None,
+        checkpoint: CheckpointConfig = None,
+        profiler: StageProfiler = None,
+    ):
+        self.params = params or DilateParams()
+        self.progress = progress or DilateProgress()
+        self.debug_sink = debug_sink
+        self.checkpoint_config = checkpoint
+        self.checkpoint: ComponentCheckpoint | None = None
+        self.profiler = profiler or StageProfiler()
+        self.telemetry: ComponentTelemetry | None = None
+        # Only ever cleared, so a cancel while the image loads is kept
+        self.active = True
+
+        self.threshold_mask = None
+        self.compositor: LabelCompositor | None = None
+        self.pixel_index: ComponentPixelIndex | None = None
+        self.frame: ImageFrame | None = None
+        self.cc_labels = None
+        self.cc_stats = None
+        self.merged_labels: UnionFind | None = None
+        self.pending_labels: set[int] = set()
+        # Components absorbed by each component still growing, for the checkpoint
+        self.absorbed_labels: dict[int, list[int]] = {}
+        self.start_iterations: dict[int, int] = {}
+        self.pyramid_levels = self.params.pyramid_levels
+        self.fallback_labels: set[int] = set()
+        self.budget_estimator: PyramidEstimator | None = None
+        self.budget_estimator_lock = threading.Lock()
+
+        self.total_cc = 0
+        self.cc_count = 0
+
+        self.structuring_element = None
+        self.kernel_extents = None
+
+    @property
+    def is_export_debug(self) -> bool:
+        return self.debug_sink is not None
+
+    def cancel(self):
+        """Stop the run, which then returns None
+
+        A run that has not started yet, e.g. while its image is loading,
+        returns None right away.
+
+        """
+        self.active = False
+
+    def discard_checkpoint(self):
+        if self.checkpoint is not None:
+            self.checkpoint.discard()
+
+    def run_file(self, image_path: str | Path) -> DilateOutput | None:
+        image_path = Path(image_path)
+        self.progress.stage(f"Loading image... {image_path.name}")
+        hdri = load_hdri(image_path, use_bgr_order=self.params.use_bgr_order, profiler=self.profiler)
+        self.progress.stage("Image loaded")
+        return self.run(hdri)
+
+    def run(self, hdri: np.ndarray) -> DilateOutput | None:
+        """Run
+
+        Parameters
+        ----------
+        hdri : np.ndarray
+            The (height, width, 3) HDRI. It is only read from.
+
+        Returns
+        -------
+        DilateOutput | None
+            The output images, or None when the run was cancelled.
+
+        """
+        if not self.active:
+            return None
+
+        params = self.params
+
+        self._prepare_kernel()
+        cc_labels, stats, merged_cc = self._find_components(hdri)
+
+        labels_mb_size = round(cc_labels.nbytes / 1024 / 1024, 2)
+        self.progress.stage(f"CC Labels Memory {labels_mb_size} MB")
+        threshold_mask_mb_size = round(self.threshold_mask.nbytes / 1024 / 1024, 2)
+        self.progress.stage(f"Threshold Mask Memory {threshold_mask_mb_size} MB")
+        memory = process_memory()
+        if memory is not None:
+            rss_mb_size, peak_mb_size = (round(size / 1024 / 1024, 2) for size in memory)
+            self.progress.stage(f"Process Memory {rss_mb_size} MB, peak {peak_mb_size} MB")
+
+        self.total_cc = len(stats)
+        self.progress.stage(f"Found {self.total_cc} connected components")
+        self.progress.stage("Processing and dilating connected components")
+
+        height, width = cc_labels.shape
+        self.cc_labels = cc_labels
+        self.cc_stats = stats
+        with self.profiler.stage("component index"):
+            self.pixel_index = ComponentPixelIndex(cc_labels, self.total_cc)
+            self.frame = ImageFrame(width, height, wrap_x=params.wrap_seam)
+            self.compositor = LabelCompositor(
+                height,
+                width,
+                self.total_cc,
+                dtype=hdri.dtype,
+                wrap_x=params.wrap_seam,
+            )
+            self.telemetry = ComponentTelemetry(self.total_cc, float(np.mean(self.kernel_extents)))
+        labels = [
+            cc_label for cc_label in range(1, self.total_cc)
+            if stats[cc_label, cv2.CC_STAT_AREA] >= max(params.min_area, 1)
+        ]
+        skipped_cc = self.total_cc - 1 - merged_cc - len(labels)
+        if skipped_cc:
+            self.progress.stage(f"Skipping {skipped_cc} connected components smaller than {params.min_area} px")
+
+        self.pending_labels = set(labels)
+        self.merged_labels = UnionFind(self.total_cc)
+        self.absorbed_labels = {}
+        self.fallback_labels = set()
+        self.budget_estimator = None
+        if self.checkpoint_config is not None:
+            with self.profiler.stage("checkpoint resume"):
+                self._resume_checkpoint(hdri)
+
+        # Debug figures are exported one component at a time, and merging
+        # needs to know which components are still waiting to be processed
+        max_workers = params.max_workers
+        if self.is_export_debug or params.merge_components:
+            max_workers = 1
+
+        padded_boxes = padded_bboxes(stats, params.max_radius, width, height, wrap_x=params.wrap_seam)
+        if max_workers > 1:
+            batches = conflict_free_batches(
+                padded_boxes,
+                labels,
+                wrap_width=width if params.wrap_seam else None,
+            )
+        else:
+            batches = [[cc_label] for cc_label in labels]
+
+        self.start_iterations = {}
+        self.pyramid_levels = params.pyramid_levels
+        remaining_labels = [cc_label for cc_label in labels if cc_label in self.pending_labels]
+        probe = None
+        if params.auto_strategy:
+            with self.profiler.stage("auto strategy"):
+                self.pyramid_levels, probe = self._choose_strategy(remaining_labels, hdri, max_workers)
+
+        if self.pyramid_levels > 0 and not params.merge_components:
+            self.progress.stage(f"Estimating growth on a 1/{2 ** self.pyramid_levels} scale image...")
+            with self.profiler.stage("pyramid pre-pass"):
+                self.start_iterations = self._estimate_start_iterations(remaining_labels, hdri, max_workers, probe)
+
+        self.progress.stage(f"Dilating in {len(batches)} batches using {max_workers} threads")
+        self.progress.progress_max(len(labels))
+
+        self.cc_count = 0
+        with self.profiler.stage("growth", sampled=True), ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for batch in batches:
+                futures = []
+                for cc_label in batch:
+                    # Already absorbed by a component it was merged into
+                    if cc_label not in self.pending_labels:
+                        self.cc_count += 1
+                        self.progress.progress(self.cc_count)
+                        continue
+
+                    self.pending_labels.discard(cc_label)
+                    x, y, w, h = stats[cc_label, :4]
+                    bbox = (int(x), int(y), int(x + w), int(y + h))
+                    padded_box = tuple(int(v) for v in padded_boxes[cc_label])
+                    futures.append(
+                        executor.submit(
+                            self._grow,
+                            cc_label,
+                            hdri,
+                            bbox,
+                            padded_box=padded_box,
+                        )
+                    )
+
+                # Components that outgrew their padded box may overlap another
+                # member of the batch, so they are recorded after it finishes
+                deferred_results = []
+                for future in as_completed(futures):
+                    result = future.result()
+                    if result is not None:
+                        deferred_results.append(result)
+
+                    self.cc_count += 1
+                    self.progress.progress(self.cc_count)
+
+                for result in deferred_results:
+                    self._add_result(result)
+
+                if not self.active:
+                    self.progress.stage("Aborting!")
+                    self._save_checkpoint()
+                    return None
+
+        self.progress.progress_max(len(stats))
+
+        if self.fallback_labels:
+            self.progress.stage(
+                f"{len(self.fallback_labels)} connected components ran out of their growth budget and were "
+                f"finished with a coarse estimate: {', '.join(str(label) for label in sorted(self.fallback_labels))}"
+            )
+
+        if params.merge_components:
+            roots = self.merged_labels.roots()[labels]
+            absorbed_cc = int(np.count_nonzero(roots != labels))
+            self.progress.stage(f"Merged {absorbed_cc} connected components into the components that reached them")
+
+        self._save_checkpoint()
+        self.progress.stage("Compositing dilated components...")
+        with self.profiler.stage("composite"):
+            hdri_dilated, dilated_threshold_mask = self.compositor.composite(hdri)
+
+        return DilateOutput(
+            mask_thresh=self.threshold_mask,
+            mask_dilated=dilated_threshold_mask,
+            hdri_original=hdri,
+            hdri_dilated=hdri_dilated,
+            fallback_labels=sorted(self.fallback_labels),
+        )
+
+    def dry_run_file(
+        self,
+        image_path: str | Path,
+        proxy_levels: int = 0,
+        sample_size: int = 64,
+    ) -> DryRunReport | None:
+        image_path = Path(image_path)
+        self.progress.stage(f"Loading image... {image_path.name}")
+        hdri = load_hdri(image_path, use_bgr_order=self.params.use_bgr_order, profiler=self.profiler)
+        self.progress.stage("Image loaded")
+        return self.dry_run(hdri, proxy_levels=proxy_levels, sample_size=sample_size)
+
+    def dry_run(self, hdri: np.ndarray, proxy_levels: int = 0, sample_size: int = 64) -> DryRunReport | None:
+        """Predict a run without dilating anything
+
+        Only the threshold mask and the connected components are computed,
+        optionally on a proxy downsampled by ``2 ** proxy_levels``. The growth
+        of a sample of components is probed on a 1/8 scale image, the other
+        components are assumed to grow like the probed ones of similar area,
+        and the strategy predictions give the peak memory and the ETA.
+
+        Parameters
+        ----------
+        hdri : np.ndarray
+            The (height, width, 3) HDRI. It is only read from.
+        proxy_levels : int
+            Pyramid levels of the proxy the components are found on, 0 for
+            the full resolution image.
+        sample_size : int
+            Number of components whose growth is probed.
+
+        Returns
+        -------
+        DryRunReport | None
+            The predictions, or None when the run was cancelled before it
+            started.
+
+        """
+        if not self.active:
+            return None
+
+        start_time = time.perf_counter()
+        params = self.params
+        height, width = hdri.shape[:2]
+        scale = 2 ** proxy_levels
+
+        self._prepare_kernel()
+        source = hdri
+        if proxy_levels:
+            with self.profiler.stage("proxy"):
+                source = downsample(hdri, proxy_levels, wrap_x=params.wrap_seam)
+        cc_labels, stats, _ = self._find_components(source)
+        self.cc_labels = cc_labels
+        self.cc_stats = stats
+        with self.profiler.stage("component index"):
+            self.pixel_index = ComponentPixelIndex(cc_labels, len(stats))
+
+        areas = stats[:, cv2.CC_STAT_AREA].astype(np.int64) * scale ** 2
+        components = [cc_label for cc_label in range(1, len(stats)) if areas[cc_label] > 0]
+        labels = [cc_label for cc_label in components if areas[cc_label] >= max(params.min_area, 1)]
+        self.progress.stage(f"Found {len(components)} connected components, {len(labels)} to dilate")
+
+        step_radius = float(np.mean(self.kernel_extents))
+        probe_levels = max(PROBE_LEVELS, proxy_levels)
+        sampled = sample_labels(labels, areas[labels], sample_size)
+        self.progress.stage(
+            f"Probing the growth of {len(sampled)} components on a 1/{2 ** probe_levels} scale image..."
+        )
+        with self.profiler.stage("probe"):
+            estimator = self._pyramid_estimator(hdri, probe_levels)
+
+            def probe(cc_label):
+                ys, xs = self.pixel_index.coordinates(cc_label)
+                return estimator.growth_distance(estimator.coarse_steps(ys * scale, xs * scale))
+
+            with ThreadPoolExecutor(max_workers=params.max_workers) as executor:
+                probed = dict(zip(sampled, executor.map(probe, sampled)))
+
+        index = {cc_label: i for i, cc_label in enumerate(labels)}
+        distances = impute_distances(
+            areas[labels],
+            {index[cc_label]: distance for cc_label, distance in probed.items()},
+        )
+        iterations = np.maximum(np.ceil(distances / step_radius), 1).astype(np.int64)
+
+        # The closed form growth is left out of the run time, as in the auto strategy
+        grown = [i for i, cc_label in enumerate(labels) if areas[cc_label] > params.small_area]
+        estimates = estimate_strategies(
+            height,
+            width,
+            [(int(stats[labels[i], 2]) * scale, int(stats[labels[i], 3]) * scale) for i in grown],
+            [float(distances[i]) for i in grown],
+            params,
+            step_radius,
+            1 if params.merge_components else params.max_workers,
+        )
+        if params.merge_components:
+            chosen = estimates[0]
+            reason = "merging components grows them step by step"
+        elif params.auto_strategy:
+            chosen, reason = choose_strategy(estimates, available_memory() + hdri.nbytes)
+        else:
+            chosen = min(estimates, key=lambda estimate: abs(estimate.pyramid_levels - params.pyramid_levels))
+            reason = "as configured"
+
+        return DryRunReport(
+            height=height,
+            width=width,
+            proxy_levels=proxy_levels,
+            component_count=len(components),
+            dilated_count=len(labels),
+            areas=areas[components],
+            sampled_count=len(sampled),
+            iterations=iterations,
+            estimates=estimates,
+            chosen=chosen,
+            reason=reason,
+            seconds=time.perf_counter() - start_time,
+        )
+
+    def _prepare_kernel(self):
+        params = self.params
+        self.structuring_element = cv2.getStructuringElement(
+            get_morph_shape(params.dilate_shape),
+            (params.dilate_size * params.dilate_iteration + 1, params.dilate_size * params.dilate_iteration + 1),
+            (params.dilate_iteration, params.dilate_iteration)
+        )
+        self.kernel_extents = kernel_extents(self.structuring_element)
+
+    def _find_components(self, hdri) -> tuple[np.ndarray, np.ndarray, int]:
+        """Threshold mask and connected components
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray, int]
+            The label image, the stats and the number of components merged
+            across the seam.
+
+        """
+        params = self.params
+
+        # Find saturated pixels (saturated here refers to
+        # pixel value intensity, not color saturation)
+        self.progress.stage("Processing mask...")
+        self.threshold_mask = saturation_mask(
+            hdri,
+            params.intensity,
+            criterion=params.saturation_criterion,
+            use_bgr_order=params.use_bgr_order,
+            profiler=self.profiler,
+        )
+        with self.profiler.stage("connected components"):
+            output = cv2.connectedComponentsWithStats(self.threshold_mask, connectivity=8)
+            _, cc_labels, stats, _ = output
+
+            # Components touching both sides of the seam are one light source
+            merged_cc = 0
+            if params.wrap_seam:
+                merged_cc = merge_seam_labels(cc_labels, stats)
+
+        if merged_cc:
+            self.progress.stage(f"Merged {merged_cc} connected components across the equirectangular seam")
+
+        return cc_labels, stats, merged_cc
+
+    def _resume_checkpoint(self, hdri):
+        """Composite the components a previous run of this image finished
+
+        They and the components they absorbed are no longer pending.
+
+        """
+        self.progress.stage("Looking for a checkpoint...")
+        self.checkpoint = ComponentCheckpoint.for_run(self.checkpoint_config, hdri, self.params)
+        resumed = self.checkpoint.load()
+        for result, absorbed in resumed:
+            self.compositor.add(result)
+            self._record_telemetry(result, resumed=True)
+            self.pending_labels.discard(result.label)
+            if result.fallback:
+                self.fallback_labels.add(result.label)
+            for label in absorbed:
+                self.merged_labels.union(result.label, label)
+                self.pending_labels.discard(label)
+
+        if resumed:
+            self.progress.stage(f"Resuming {len(resumed)} dilated components from {self.checkpoint.folder}")
+
+    def _add_result(self, result: ComponentResult):
+        self.compositor.add(result)
+        self._record_telemetry(result)
+        if result.fallback:
+            self.fallback_labels.add(result.label)
+        if self.checkpoint is not None:
+            self.checkpoint.record(result, self.absorbed_labels.pop(result.label, []))
+
+    def _record_telemetry(self, result: ComponentResult, resumed=False):
+        x, y, w, h, area = (int(v) for v in self.cc_stats[result.label, :5])
+        self.telemetry.record(result, (x, y, x + w, y + h), area, resumed=resumed)
+
+    def _save_checkpoint(self):
+        if self.checkpoint is None:
+            return
+
+        self.checkpoint.save()
+        self.progress.stage(
+            f"Checkpoint of {self.checkpoint.saved_count} dilated components saved in {self.checkpoint.folder}"
+        )
+
+    def _export_debug_step(self, cc_label: int, iteration: int, dilated_cc_mask, threshold_mask, intersection):
+        temp_dilated_cc_mask = cv2.subtract(threshold_mask, dilated_cc_mask)
+        self.debug_sink(
+            cc_label,
+            iteration,
+            (dilated_cc_mask, temp_dilated_cc_mask, threshold_mask, intersection),
+        )
+
+    def _grow(self, cc_label, hdri_input, bbox: T_BOX, padded_box: T_BOX = None) -> ComponentResult | None:
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        with self.profiler.stage("growth / component", per_thread=True):
+            result = self._dilate(cc_label, hdri_input, bbox, padded_box=padded_box)
+
+        self.telemetry.record_time(cc_label, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+        return result
+
+    def _dilate(
+        self,
+        cc_label,
+        hdri_input,
+        bbox: T_BOX,
+        padded_box: T_BOX = None,
+    ) -> ComponentResult | None:
+        """Grow a single connected component inside its own ROI
+
+        The component is dilated in a crop around its bounding box instead of
+        the full frame. The crop is enlarged whenever the next growth step
+        could leave it, so the result matches a full frame dilation.
+
+        With ``merge_components``, any not yet processed component the growth
+        reaches is absorbed: its pixels join the mask, so the average covers
+        the sums and counts of both, and they keep growing as one.
+
+        Components with a start iteration from the pyramid pre-pass jump
+        straight to it with a single multi-iteration dilation and refine one
+        step at a time from there.
+
+        When ``padded_box`` is given and the final mask stays inside it, the
+        result is added to the compositor straight away and None is returned.
+        Otherwise the result is returned so the caller can add it once no
+        other component of the same batch is running.
+
+        """
+        if not self.active:
+            return None
+
+        print("-----------------------------------------")
+        print(f"Connected Component Loop ", cc_label)
+        print("=========================================")
+
+        # The closed form growth cannot see other components to merge with
+        is_small = self.pixel_index.area(cc_label) <= self.params.small_area
+        if is_small and not self.params.merge_components:
+            grown = self._dilate_small(cc_label, hdri_input, bbox)
+            if grown is not None:
+                *grown, terminated_early = grown
+                return self._finish_component(
+                    cc_label,
+                    *grown,
+                    padded_box=padded_box,
+                    terminated_early=terminated_early,
+                )
+
+        frame = self.frame
+        pad = self.params.max_radius
+        roi = frame.expand(bbox, pad, pad, pad, pad)
+        cc_mask = self.pixel_index.seed_mask(cc_label, roi)
+
+        iteration = 0
+        start_iteration = self.start_iterations.get(cc_label, 0)
+        if start_iteration:
+            jumped = self._jump(cc_label, hdri_input, bbox, start_iteration)
+            if jumped is not None:
+                roi, cc_mask, bbox = jumped
+                iteration = start_iteration
+
+        checkpoint_iteration = iteration
+        first_iteration = iteration
+        start_time = time.perf_counter()
+        cc_area = cv2.countNonZero(cc_mask)
+        while True:
+            if not self.active:
+                return None
+
+            iteration += 1
+            if iteration > checkpoint_iteration + self.params.iteration_cap:
+                checkpoint_iteration += self.params.iteration_cap
+                self.progress.stage(
+                    "Average Pixel Value Iteration is taking longer than usual. "
+                    "Please wait..."
+                )
+                self.progress.progress(0)
+                self.progress.progress_max(0)
+
+            bbox = frame.expand(bbox, *self.kernel_extents)
+            if not frame.contains(roi, bbox):
+                new_roi = frame.expand(bbox, pad, pad, pad, pad)
+                cc_mask = frame.reembed(cc_mask, roi, new_roi)
+                roi = new_roi
+
+            dilated_cc_mask = frame.dilate(
+                cc_mask,
+                self.structuring_element,
+                roi,
+            )
+            # Saturated pixels of other components reached by this step are
+            # only looked for when merging or exporting debug figures
+            is_intersect = None
+            if self.params.merge_components or self.is_export_debug:
+                threshold_mask = frame.crop(self.threshold_mask, roi)
+                grown_mask = cv2.subtract(dilated_cc_mask, cc_mask)
+                intersection = cv2.bitwise_and(grown_mask, threshold_mask)
+                is_intersect = cv2.countNonZero(intersection) > 0
+
+            if is_intersect and self.params.merge_components:
+                merged_roi, dilated_cc_mask, bbox = self._merge_reached(
+                    cc_label,
+                    roi,
+                    dilated_cc_mask,
+                    bbox,
+                    intersection,
+                )
+                if merged_roi != roi:
+                    intersection = frame.reembed(intersection, roi, merged_roi)
+                    roi = merged_roi
+                    threshold_mask = frame.crop(self.threshold_mask, roi)
+
+            if self.is_export_debug and iteration % self.params.export_debug_interval == 0:
+                self._export_debug_step(cc_label, iteration, dilated_cc_mask, threshold_mask, intersection)
+
+            hdri_channels_averaged = cv2.mean(frame.crop(hdri_input, roi), mask=dilated_cc_mask)[:3]
+            hdri_channels_averaged = tuple(
+                channel * self.params.final_intensity_multiplier
+                for channel in hdri_channels_averaged
+            )
+            is_exceeded_threshold, terminated_early = self._check_threshold(hdri_channels_averaged)
+
+            intersect_msg = "" if is_intersect is None else f"Intersect? {'Y' if is_intersect else 'N'} - "
+            print(
+                f"Iteration {iteration} - CC {cc_label} = "
+                f"Exceed Threshold {self.params.threshold}? {'Y' if is_exceeded_threshold else 'N'} - "
+                f"{intersect_msg}"
+                f"Average Pixel Value: {hdri_channels_averaged}"
+            )
+
+            if not is_exceeded_threshold:
+                break
+
+            # Nothing is left to grow into once the mask fills the whole frame,
+            # and a kernel that does not reach past its anchor never grows it
+            dilated_area = cv2.countNonZero(dilated_cc_mask)
+            if dilated_area == cc_area:
+                print(f"CC {cc_label} stopped growing. Stopping at iteration {iteration}.")
+                break
+
+            cc_mask = dilated_cc_mask
+            cc_area = dilated_area
+
+            exceeded_budget = self._exceeded_budget(iteration - first_iteration, start_time)
+            if exceeded_budget:
+                return self._finish_over_budget(
+                    cc_label,
+                    hdri_input,
+                    roi,
+                    cc_mask,
+                    bbox,
+                    iteration,
+                    exceeded_budget,
+                    padded_box=padded_box,
+                )
+
+        if self.is_export_debug:
+            self._export_debug_step(cc_label, iteration, dilated_cc_mask, threshold_mask, intersection)
+
+        return self._finish_component(
+            cc_label,
+            roi,
+            dilated_cc_mask,
+            bbox,
+            hdri_channels_averaged,
+            iteration,
+            padded_box=padded_box,
+            terminated_early=terminated_early,
+        )
+
+    def _jump(
+        self,
+        cc_label,
+        hdri_input,
+        bbox: T_BOX,
+        iterations: int,
+    ) -> tuple[T_BOX, np.ndarray, T_BOX] | None:
+        """Dilate the seed by several growth steps at once
+
+        Returns None when the average already dropped below the threshold at
+        ``iterations``, in which case the pyramid estimate overshot and the
+        component is grown from its seed instead.
+
+        """
+        frame = self.frame
+        left, top, right, bottom = self.kernel_extents
+        bbox = frame.expand(bbox, left * iterations, top * iterations, right * iterations, bottom * iterations)
+        pad = self.params.max_radius
+        roi = frame.expand(bbox, pad, pad, pad, pad)
+        jumped_cc_mask = frame.dilate(
+            self.pixel_index.seed_mask(cc_label, roi),
+            self.structuring_element,
+            roi,
+            iterations=iterations,
+        )
+
+        hdri_channels_averaged = cv2.mean(frame.crop(hdri_input, roi), mask=jumped_cc_mask)[:3]
+        hdri_channels_averaged = tuple(
+            channel * self.params.final_intensity_multiplier
+            for channel in hdri_channels_averaged
+        )
+        if not self._is_exceeded_threshold(hdri_channels_averaged):
+            print(f"CC {cc_label} pyramid estimate overshot at iteration {iterations}. Growing from the seed.")
+            return None
+
+        print(f"CC {cc_label} jumped to iteration {iterations}")
+        return roi, jumped_cc_mask, bbox
+
+    def _exceeded_budget(self, steps: int, start_time: float) -> str | None:
+        """Describe the growth budget a component ran out of, if any"""
+        max_iterations = self.params.max_iterations
+        if max_iterations and steps >= max_iterations:
+            return f"its budget of {max_iterations} iterations"
+
+        max_seconds = self.params.max_component_seconds
+        if max_seconds and time.perf_counter() - start_time >= max_seconds:
+            return f"its budget of {max_seconds:g} secs"
+
+        return None
+
+    def _finish_over_budget(
+        self,
+        cc_label,
+        hdri_input,
+        roi: T_BOX,
+        cc_mask,
+        bbox: T_BOX,
+        iteration: int,
+        exceeded_budget: str,
+        padded_box: T_BOX = None,
+    ) -> ComponentResult | None:
+        """Finish a component that ran out of budget with a coarse radius jump
+
+        The growth left is searched from the current mask on a 1/8 scale
+        image, then the mask jumps there with a single multi-iteration
+        dilation, without checking the threshold on the way. The result is
+        flagged as a fallback.
+
+        """
+        frame = self.frame
+        with self.budget_estimator_lock:
+            if self.budget_estimator is None:
+                self.budget_estimator = self._pyramid_estimator(hdri_input, PROBE_LEVELS)
+            estimator = self.budget_estimator
+
+        rows, columns = np.nonzero(cc_mask)
+        coarse_steps = estimator.coarse_steps(rows + roi[1], (columns + roi[0]) % frame.width)
+        jump = max(math.ceil(coarse_steps * estimator.steps_per_coarse_step), 1)
+
+        left, top, right, bottom = self.kernel_extents
+        bbox = frame.expand(bbox, left * jump, top * jump, right * jump, bottom * jump)
+        if not frame.contains(roi, bbox):
+            pad = self.params.max_radius
+            new_roi = frame.expand(bbox, pad, pad, pad, pad)
+            cc_mask = frame.reembed(cc_mask, roi, new_roi)
+            roi = new_roi
+
+        dilated_cc_mask = frame.dilate(cc_mask, self.structuring_element, roi, iterations=jump)
+        hdri_channels_averaged = cv2.mean(frame.crop(hdri_input, roi), mask=dilated_cc_mask)[:3]
+        hdri_channels_averaged = tuple(
+            channel * self.params.final_intensity_multiplier
+            for channel in hdri_channels_averaged
+        )
+        self.progress.stage(
+            f"CC {cc_label} ran out of {exceeded_budget} at iteration {iteration}, "
+            f"jumping {jump} iterations ahead from a 1/{estimator.factor} scale estimate"
+        )
+
+        return self._finish_component(
+            cc_label,
+            roi,
+            dilated_cc_mask,
+            bbox,
+            hdri_channels_averaged,
+            iteration + jump,
+            padded_box=padded_box,
+            fallback=True,
+        )
+
+    def _pyramid_estimator(self, hdri_input, levels: int) -> PyramidEstimator:
+        def is_exceeded(channels_averaged):
+            return self._is_exceeded_threshold(
+                tuple(channel * self.params.final_intensity_multiplier for channel in channels_averaged)
+            )
+
+        return PyramidEstimator(
+            hdri_input,
+            levels,
+            get_morph_shape(self.params.dilate_shape),
+            self.structuring_element,
+            is_exceeded,
+            self.params.max_radius,
+            wrap_x=self.params.wrap_seam,
+        )
+
+    def _choose_strategy(
+        self,
+        labels: list[int],
+        hdri_input,
+        max_workers: int,
+    ) -> tuple[int, tuple[PyramidEstimator, dict[int, int]] | None]:
+        """Pick the pyramid levels from the predicted cost of every strategy
+
+        A probe on the most downsampled image predicts how far every
+        component grows, which drives the run time predictions. Merging
+        grows step by step, so it always runs in-memory.
+
+        Returns
+        -------
+        tuple[int, tuple[PyramidEstimator, dict[int, int]] | None]
+            The pyramid levels, and the probe estimator with its coarse
+            steps per component when they can be reused as the pre-pass.
+
+        """
+        if self.params.merge_components:
+            self.progress.stage("Auto strategy: in-memory, merging components grows them step by step")
+            return 0, None
+
+        labels = [
+            cc_label for cc_label in labels
+            if self.pixel_index.area(cc_label) > self.params.small_area
+        ]
+        self.progress.stage(f"Auto strategy: probing growth on a 1/{2 ** PROBE_LEVELS} scale image...")
+        estimator = self._pyramid_estimator(hdri_input, PROBE_LEVELS)
+
+        def probe(cc_label):
+            return estimator.coarse_steps(*self.pixel_index.coordinates(cc_label))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            probed_steps = dict(zip(labels, executor.map(probe, labels)))
+
+        height, width = self.cc_labels.shape
+        estimates = estimate_strategies(
+            height,
+            width,
+            [tuple(int(v) for v in self.cc_stats[cc_label, 2:4]) for cc_label in labels],
+            [estimator.growth_distance(probed_steps[cc_label]) for cc_label in labels],
+            self.params,
+            float(np.mean(self.kernel_extents)),
+            max_workers,
+        )
+        # What the process already holds counts as available
+        held_bytes = hdri_input.nbytes + self.cc_labels.nbytes + self.threshold_mask.nbytes
+        chosen, reason = choose_strategy(estimates, available_memory() + held_bytes)
+        for estimate in estimates:
+            self.progress.stage(f"Auto strategy: {estimate.describe()}")
+        self.progress.stage(f"Auto strategy: {chosen.name}, {reason}")
+
+        probe = (estimator, probed_steps) if chosen.pyramid_levels == PROBE_LEVELS else None
+        return chosen.pyramid_levels, probe
+
+    def _estimate_start_iterations(
+        self,
+        labels: list[int],
+        hdri_input,
+        max_workers: int,
+        probe: tuple[PyramidEstimator, dict[int, int]] = None,
+    ) -> dict[int, int]:
+        """Run the growth search on a downsampled image first
+
+        Components the fast path or merging handle step by step are left
+        out, as are the ones the estimate puts at the very start. The coarse
+        steps of an auto strategy probe at the same levels are reused.
+
+        """
+        if probe is not None:
+            estimator, probed_steps = probe
+        else:
+            estimator, probed_steps = self._pyramid_estimator(hdri_input, self.pyramid_levels), None
+
+        labels = [
+            cc_label for cc_label in labels
+            if self.pixel_index.area(cc_label) > self.params.small_area
+        ]
+
+        def estimate(cc_label):
+            if probed_steps is not None:
+                return estimator.start_iteration_from_steps(probed_steps[cc_label])
+
+            return estimator.start_iteration(*self.pixel_index.coordinates(cc_label))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            start_iterations = executor.map(estimate, labels)
+            return {
+                cc_label: start_iteration
+                for cc_label, start_iteration in zip(labels, start_iterations)
+                if start_iteration > 0
+            }
+
+    def _merge_reached(
+        self,
+        cc_label,
+        roi: T_BOX,
+        dilated_cc_mask,
+        bbox: T_BOX,
+        intersection,
+    ) -> tuple[T_BOX, np.ndarray, T_BOX]:
+        """Absorb the pending components a growth step reached
+
+        The seeds of every reached component that was not processed yet are
+        added to the dilated mask and its box to the growth box. The ROI is
+        enlarged when an absorbed component reaches outside of it. Components
+        that were already processed are left alone.
+
+        """
+        frame = self.frame
+        reached_labels = np.unique(frame.crop(self.cc_labels, roi)[intersection > 0])
+        absorbed_labels = [
+            int(label) for label in reached_labels
+            if label != cc_label and label in self.pending_labels
+        ]
+        if not absorbed_labels:
+            return roi, dilated_cc_mask, bbox
+
+        self.absorbed_labels.setdefault(cc_label, []).extend(absorbed_labels)
+        for label in absorbed_labels:
+            self.pending_labels.discard(label)
+            self.merged_labels.union(cc_label, label)
+            x, y, w, h = self.cc_stats[label, :4]
+            bbox = frame.union(bbox, (int(x), int(y), int(x + w), int(y + h)))
+
+        if not frame.contains(roi, bbox):
+            pad = self.params.max_radius
+            new_roi = frame.expand(bbox, pad, pad, pad, pad)
+            dilated_cc_mask = frame.reembed(dilated_cc_mask, roi, new_roi)
+            roi = new_roi
+
+        for label in absorbed_labels:
+            cv2.bitwise_or(dilated_cc_mask, self.pixel_index.seed_mask(label, roi), dst=dilated_cc_mask)
+
+        print(f"CC {cc_label} absorbed CC {', '.join(str(label) for label in absorbed_labels)}")
+        return roi, dilated_cc_mask, bbox
+
+    def _is_exceeded_threshold(self, hdri_channels_averaged) -> bool:
+        return self._check_threshold(hdri_channels_averaged)[0]
+
+    def _check_threshold(self, hdri_channels_averaged) -> tuple[bool, bool]:
+        """Whether the growth goes on, and whether ``terminate_early`` stopped it
+
+        Returns
+        -------
+        tuple[bool, bool]
+            Whether the averaged channels still exceed the threshold, and
+            whether they only stop because one channel fell below it while
+            another was still above it.
+
+        """
+        is_exceeded_threshold = any(channel >= self.params.threshold for channel in hdri_channels_averaged)
+        if self.params.terminate_early:
+            for c in hdri_channels_averaged:
+                if c <= self.params.threshold:
+                    print(f"Terminating early. Found channel value {c} below threshold.")
+                    return False, is_exceeded_threshold
+
+        return is_exceeded_threshold, False
+
+    def _dilate_small(self, cc_label, hdri_input, bbox: T_BOX):
+        """Closed form growth for small connected components
+
+        Instead of dilating step by step, a distance transform of the seed
+        gives the growth step every pixel of the ROI is reached at. Summing
+        the pixels per step and accumulating them yields the average after
+        every step in one pass, and the first step below the threshold is
+        picked directly.
+
+        The distance metric follows the dilate shape (chessboard for
+        Rectangle, city block for Cross, euclidean for Ellipsis), which is
+        exact for Rectangle and close for the others.
+
+        Returns None when the kernel is not centered and symmetric, does not
+        grow the mask, or the threshold is not reached within the ROI, so the
+        component falls back to the regular growth.
+
+        """
+        kernel = self.structuring_element
+        left, top, right, bottom = self.kernel_extents
+        is_symmetric = np.array_equal(kernel, kernel[::-1, ::-1])
+        if not is_symmetric or not left == top == right == bottom or not left:
+            return None
+
+        frame = self.frame
+        step_radius = left
+        pad = max(self.params.max_radius, step_radius)
+        roi = frame.expand(bbox, pad, pad, pad, pad)
+        if frame.is_full_width(roi):
+            return None
+
+        # Growth is only known up to the ROI edges that are not image borders
+        x0, y0, x1, y1 = roi
+        margins = [
+            bbox[0] - x0 if x0 > 0 or frame.wrap_x else None,
+            bbox[1] - y0 if y0 > 0 else None,
+            x1 - bbox[2] if x1 < frame.width or frame.wrap_x else None,
+            y1 - bbox[3] if y1 < frame.height else None,
+        ]
+        margins = [margin for margin in margins if margin is not None]
+        if margins:
+            max_steps = min(margins) // step_radius
+        else:
+            max_steps = -(-max(x1 - x0, y1 - y0) // step_radius)
+
+        if max_steps < 1:
+            return None
+
+        seed_mask = self.pixel_index.seed_mask(cc_label, roi)
+        distance_type = get_distance_type(self.params.dilate_shape)
+        mask_size = cv2.DIST_MASK_PRECISE if distance_type == cv2.DIST_L2 else 3
+        distances = cv2.distanceTransform(cv2.bitwise_not(seed_mask), distance_type, mask_size)
+        steps = np.ceil(distances / step_radius).astype(np.int32)
+        np.minimum(steps, max_steps + 1, out=steps)
+
+        flat_steps = steps.ravel()
+        bins = max_steps + 2
+        counts = np.cumsum(np.bincount(flat_steps, minlength=bins))
+        roi_pixels = frame.crop(hdri_input, roi).reshape(-1, 3)
+        sums = np.stack(
+            [
+                np.cumsum(np.bincount(flat_steps, weights=roi_pixels[:, channel], minlength=bins))
+                for channel in range(3)
+            ],
+            axis=1,
+        )
+        averages = sums[1:max_steps + 1] / counts[1:max_steps + 1, np.newaxis] * self.params.final_intensity_multiplier
+
+        for step, channels_averaged in enumerate(averages, start=1):
+            hdri_channels_averaged = tuple(float(channel) for channel in channels_averaged)
+            is_exceeded_threshold, terminated_early = self._check_threshold(hdri_channels_averaged)
+            if is_exceeded_threshold:
+                continue
+
+            print(
+                f"Fast Path - CC {cc_label} = "
+                f"Below Threshold {self.params.threshold} at iteration {step} - "
+                f"Average Pixel Value: {hdri_channels_averaged}"
+            )
+            dilated_cc_mask = np.where(steps <= step, 255, 0).astype(np.uint8)
+            growth = step_radius * step
+            bbox = frame.expand(bbox, growth, growth, growth, growth)
+            return roi, dilated_cc_mask, bbox, hdri_channels_averaged, step, terminated_early
+
+        return None
+
+    def _finish_component(
+        self,
+        cc_label,
+        roi: T_BOX,
+        dilated_cc_mask,
+        bbox: T_BOX,
+        hdri_channels_averaged,
+        iteration: int,
+        padded_box: T_BOX = None,
+        fallback=False,
+        terminated_early=False,
+    ) -> ComponentResult | None:
+        frame = self.frame
+
+        # Feather the edges inside the ROI only. The blurred mask is kept as
+        # the blend weight instead of being thresholded back to a hard mask.
+        # Twice the blur radius is kept around the mask so the reflected
+        # border GaussianBlur uses at the ROI edges only ever samples zeros.
+        if self.params.use_blur:
+            blur_margin = self.params.blur_size // 2 * 2
+            blur_bbox = frame.expand(bbox, blur_margin, blur_margin, blur_margin, blur_margin)
+            if not frame.contains(roi, blur_bbox):
+                # The ROI may reach further than the margin on some sides,
+                # after merging or a pyramid jump, so it is kept whole
+                blur_roi = frame.union(roi, blur_bbox)
+                dilated_cc_mask = frame.reembed(dilated_cc_mask, roi, blur_roi)
+                roi = blur_roi
+
+            with self.profiler.stage("growth / blur", per_thread=True):
+                dilated_cc_mask = frame.blur(dilated_cc_mask, self.params.blur_size, roi)
+
+        result = ComponentResult(
+            label=cc_label,
+            roi=roi,
+            mask=dilated_cc_mask,
+            bbox=mask_bbox(dilated_cc_mask, roi),
+            fill=hdri_channels_averaged,
+            iterations=iteration,
+            fallback=fallback,
+            terminated_early=terminated_early,
+        )
+        if padded_box is not None and frame.contains(padded_box, result.bbox):
+            self._add_result(result)
+            return None
+
+        return result
@@ -0,0 +1,462 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from pathlib import Path
+
+from hdri_dilate.dilate.batch import FileReport, T_REPORT_CALLBACK, process_file
+from hdri_dilate.dilate.checkpoint import CheckpointConfig
+from hdri_dilate.dilate.engine import DilateParams
+from hdri_dilate.dilate.memory import MemoryBudget, estimate_file_peak_bytes
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Only the threads differ between runs of the same job, they do not change the outputs
+_RUNTIME_PARAMS = ("max_workers",)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    image_path TEXT NOT NULL,
+    output_folder TEXT NOT NULL,
+    params TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    claimed_by TEXT,
+    outputs TEXT NOT NULL DEFAULT '[]',
+    seconds REAL,
+    load_seconds REAL,
+    dilate_seconds REAL,
+    write_seconds REAL,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    UNIQUE (image_path, output_folder)
+)
+"""
+
+_HASH_CHUNK = 1024 * 1024
+
+
+def input_hash(image_path: str | Path) -> str:
+    """Quick fingerprint of an input file
+
+    Hashes the size, the modification time and the first and last MiB
+    instead of whole multi GB plates, which is enough to notice a replaced
+    or re-rendered file.
+
+    """
+    image_path = Path(image_path)
+    stat = image_path.stat()
+    digest = hashlib.sha256(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    with open(image_path, "rb") as f:
+        digest.update(f.read(_HASH_CHUNK))
+        if stat.st_size > _HASH_CHUNK:
+            f.seek(max(stat.st_size - _HASH_CHUNK, _HASH_CHUNK))
+            digest.update(f.read(_HASH_CHUNK))
+
+    return digest.hexdigest()
+
+
+def params_key(params: dict) -> str:
+    """The params of a job that change its outputs, comparable as a string"""
+    return json.dumps(
+        {name: value for name, value in params.items() if name not in _RUNTIME_PARAMS},
+        sort_keys=True,
+    )
+
+
+def outputs_exist(outputs: list[str]) -> bool:
+    """Every output of a finished job is still there and not empty"""
+    return bool(outputs) and all(
+        Path(output).is_file() and Path(output).stat().st_size > 0
+        for output in outputs
+    )
+
+
+def _worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+@dataclass
+class QueuedJob:
+    """A job claimed from the JobQueue"""
+    id: int
+    image_path: str
+    output_folder: str
+    params: DilateParams
+
+
+class JobQueue:
+    """Durable SQLite queue of batch jobs
+
+    Records the state, parameters, input hash, outputs, timings and errors
+    of every file, so an interrupted batch resumes where it stopped. Several
+    processes may share one queue: jobs are claimed in an immediate
+    transaction, so every job is handed to a single worker.
+
+    Parameters
+    ----------
+    db_path : str | Path
+        The SQLite file, created when missing.
+    max_attempts : int
+        How many times a job is tried per run before it is left failed.
+
+    """
+    def __init__(self, db_path: str | Path, max_attempts: int = 3):
+        self.db_path = Path(db_path)
+        self.max_attempts = max(max_attempts, 1)
+        self.worker_id = _worker_id()
+        # Transactions are managed explicitly to claim jobs atomically
+        self.connection = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _transaction(self):
+        return _ImmediateTransaction(self.connection)
+
+    def add(self, inputs: list[Path], output_folder: str | Path, params: DilateParams) -> dict[str, int]:
+        """Queue files, keeping the valid results of previous runs
+
+        A file already queued for the same output folder is queued again
+        when its hash or the parameters changed, when it failed or when an
+        output of its last run is missing. Failed files start over with no
+        attempts.
+
+        Returns
+        -------
+        dict[str, int]
+            How many files are ``queued`` to run and how many were
+            ``skipped`` as completed.
+
+        """
+        counts = {"queued": 0, "skipped": 0}
+        output_folder = str(Path(output_folder).resolve())
+        params_dict = params.to_dict()
+        params_json = json.dumps(params_dict)
+        job_params_key = params_key(params_dict)
+        now = time.time()
+        # Hashed before the transaction, which holds the write lock of every
+        # process sharing the queue
+        file_hashes = {str(Path(image_path).resolve()): input_hash(image_path) for image_path in inputs}
+
+        with self._transaction() as connection:
+            for image_path, file_hash in file_hashes.items():
+                row = connection.execute(
+                    "SELECT * FROM jobs WHERE image_path = ? AND output_folder = ?",
+                    (image_path, output_folder),
+                ).fetchone()
+
+                if row is None:
+                    connection.execute(
+                        "INSERT INTO jobs (image_path, output_folder, params, input_hash, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (image_path, output_folder, params_json, file_hash, now),
+                    )
+                    counts["queued"] += 1
+                    continue
+
+                is_unchanged = (
+                    row["input_hash"] == file_hash
+                    and params_key(json.loads(row["params"])) == job_params_key
+                )
+                if row["state"] == DONE and is_unchanged and self._outputs_exist(row):
+                    counts["skipped"] += 1
+                    continue
+
+                if row["state"] in (PENDING, RUNNING) and is_unchanged:
+                    # Running ones are left to their worker, or to recover()
+                    counts["queued"] += row["state"] == PENDING
+                    continue
+
+                connection.execute(
+                    "UPDATE jobs SET params = ?, input_hash = ?, state = ?, attempts = 0, "
+                    "claimed_by = NULL, error = NULL, updated_at = ? WHERE id = ?",
+                    (params_json, file_hash, PENDING, now, row["id"]),
+                )
+                counts["queued"] += 1
+
+        return counts
+
+    @staticmethod
+    def _outputs_exist(row: sqlite3.Row) -> bool:
+        return outputs_exist(json.loads(row["outputs"]))
+
+    def recover(self) -> int:
+        """Requeue the running jobs of workers on this host that died
+
+        Returns
+        -------
+        int
+            The number of requeued jobs.
+
+        """
+        hostname = socket.gethostname()
+        recovered = 0
+        with self._transaction() as connection:
+            rows = connection.execute(
+                "SELECT id, claimed_by FROM jobs WHERE state = ?", (RUNNING,)
+            ).fetchall()
+            for row in rows:
+                host, _, pid = (row["claimed_by"] or "").rpartition(":")
+                if host != hostname or not pid.isdigit() or _is_process_alive(int(pid)):
+                    continue
+
+                connection.execute(
+                    "UPDATE jobs SET state = ?, claimed_by = NULL, updated_at = ? WHERE id = ?",
+                    (PENDING, time.time(), row["id"]),
+                )
+                recovered += 1
+
+        return recovered
+
+    def claim(self) -> QueuedJob | None:
+        """Take the next pending job, or a failed one with attempts left
+
+        Returns
+        -------
+        QueuedJob | None
+            The job, now running for this worker, or None when there is
+            nothing left to claim.
+
+        """
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT id, image_path, output_folder, params FROM jobs "
+                "WHERE state = ? OR (state = ? AND attempts < ?) "
+                "ORDER BY id LIMIT 1",
+                (PENDING, FAILED, self.max_attempts),
+            ).fetchone()
+            if row is None:
+                return None
+
+            connection.execute(
+                "UPDATE jobs SET state = ?, attempts = attempts + 1, claimed_by = ?, updated_at = ? "
+                "WHERE id = ?",
+                (RUNNING, self.worker_id, time.time(), row["id"]),
+            )
+
+        return QueuedJob(
+            row["id"],
+            row["image_path"],
+            row["output_folder"],
+            DilateParams.from_dict(json.loads(row["params"])),
+        )
+
+    def finish(self, job_id: int, report: FileReport):
+        """Record the outcome of a claimed job"""
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET state = ?, claimed_by = NULL, outputs = ?, seconds = ?, "
+                "load_seconds = ?, dilate_seconds = ?, write_seconds = ?, error = ?, updated_at = ? "
+                "WHERE id = ?",
+                (
+                    DONE if report.ok else FAILED,
+                    json.dumps(report.outputs),
+                    report.seconds,
+                    report.load_seconds,
+                    report.dilate_seconds,
+                    report.write_seconds,
+                    report.error,
+                    time.time(),
+                    job_id,
+                ),
+            )
+
+    def release(self, job_id: int):
+        """Put back a claimed job that was not run, without using an attempt"""
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET state = ?, attempts = MAX(attempts - 1, 0), claimed_by = NULL, updated_at = ? "
+                "WHERE id = ? AND state = ?",
+                (PENDING, time.time(), job_id, RUNNING),
+            )
+
+    def counts(self) -> dict[str, int]:
+        counts = dict.fromkeys((PENDING, RUNNING, DONE, FAILED), 0)
+        for row in self.connection.execute("SELECT state, COUNT(*) AS count FROM jobs GROUP BY state"):
+            counts[row["state"]] = row["count"]
+
+        return counts
+
+
+class _ImmediateTransaction:
+    """Write transaction taking the database lock up front
+
+    A deferred transaction would only lock on its first write, letting two
+    workers read the same pending job before either claims it.
+
+    """
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+def run_queue(
+    queue: JobQueue,
+    jobs: int = 1,
+    max_workers: int = None,
+    verbose=False,
+    on_report: T_REPORT_CALLBACK = None,
+    memory_budget: int = None,
+    checkpoint: CheckpointConfig = None,
+) -> list[FileReport]:
+    """Process the queued jobs with a pool of ``jobs`` processes
+
+    Jobs are claimed one at a time as pool processes free up, so other
+    processes sharing the queue get their share. Failed jobs are claimed
+    again until they run out of attempts. With a ``memory_budget``, a
+    claimed job whose peak estimate does not fit next to the running ones
+    is put back until one of them finishes.
+
+    A pool process dying, say to the OOM killer, breaks the pool and loses
+    every job in flight. The one that crashed it cannot be told apart, so
+    they are put back without using an attempt, the pool is rebuilt and
+    jobs run one at a time until one finishes. A job breaking the pool on
+    its own fails, so a file that always crashes it runs out of attempts.
+
+    Parameters
+    ----------
+    queue : JobQueue
+        The queue, with the files of this run already added.
+    jobs : int
+        Number of pool processes.
+    max_workers : int
+        Dilate threads per file, replacing the queued value, as it only
+        depends on the machine running the job.
+    verbose : bool
+        Keep the growth step prints.
+    on_report : T_REPORT_CALLBACK
+        Called as files finish.
+    memory_budget : int
+        Optional budget in bytes for the running jobs.
+    checkpoint : CheckpointConfig
+        Optionally resume jobs interrupted mid file from their finished
+        components.
+
+    Returns
+    -------
+    list[FileReport]
+        The reports of the jobs run by this process, in completion order.
+
+    """
+    jobs = max(jobs, 1)
+    reports = []
+    running: dict[Future, QueuedJob] = {}
+    budget = MemoryBudget(memory_budget)
+    estimates: dict[int, int] = {}
+
+    def finish(job: QueuedJob, report: FileReport):
+        queue.finish(job.id, report)
+        reports.append(report)
+        if on_report:
+            on_report(report)
+
+    executor = ProcessPoolExecutor(max_workers=jobs)
+    # Whether a job finished since the pool last broke
+    is_progressing = True
+    try:
+        while True:
+            is_pool_broken = False
+            while len(running) < (jobs if is_progressing else 1) and (job := queue.claim()) is not None:
+                params = job.params
+                if max_workers is not None:
+                    params.max_workers = max_workers
+
+                estimates[job.id] = estimate_file_peak_bytes(job.image_path, params) if memory_budget else 0
+                if not budget.try_acquire(estimates[job.id]):
+                    queue.release(job.id)
+                    break
+
+                try:
+                    future = executor.submit(
+                        process_file, job.image_path, job.output_folder, params, verbose, checkpoint
+                    )
+                except BrokenProcessPool:
+                    budget.release(estimates.pop(job.id))
+                    queue.release(job.id)
+                    is_pool_broken = True
+                    break
+
+                running[future] = job
+
+            if not is_pool_broken:
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if isinstance(future.exception(), BrokenProcessPool):
+                        is_pool_broken = True
+                        continue
+
+                    job = running.pop(future)
+                    budget.release(estimates.pop(job.id))
+                    try:
+                        report = future.result()
+                    except Exception:
+                        report = FileReport(job.image_path, error=traceback.format_exc())
+
+                    finish(job, report)
+                    is_progressing = True
+
+            if is_pool_broken:
+                executor.shutdown(wait=True, cancel_futures=True)
+                for job in running.values():
+                    budget.release(estimates.pop(job.id))
+                    if is_progressing:
+                        queue.release(job.id)
+                    else:
+                        finish(job, FileReport(job.image_path, error="A pool process died while it ran on its own"))
+
+                running.clear()
+                is_progressing = False
+                executor = ProcessPoolExecutor(max_workers=jobs)
+
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False, cancel_futures=True)
+        for job in running.values():
+            queue.release(job.id)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+
+    return reports
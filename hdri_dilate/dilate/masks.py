@@ -0,0 +1,243 @@
+from __future__ import annotations
+
+import cv2
+import numpy as np
+
+from hdri_dilate.dilate.profiling import StageProfiler, profile_stage
+from hdri_dilate.enums import SaturationCriterion
+
+DEFAULT_BAND_ROWS = 256
+
+# Rec. 709 luminance weights in RGB order
+LUMINANCE_WEIGHTS = (0.2126, 0.7152, 0.0722)
+
+
+def channel_codes(band: np.ndarray, intensity: float, out: np.ndarray = None) -> np.ndarray:
+    """Channel codes
+
+    Pack which channels of every pixel exceed ``intensity`` into the lower
+    three bits of a uint8, bit 0 being the first channel.
+
+    Parameters
+    ----------
+    band : np.ndarray
+        The (rows, width, 3) HDRI rows.
+    intensity : float
+        The minimum value of a saturated channel.
+    out : np.ndarray
+        Optional (rows, width) uint8 output.
+
+    Returns
+    -------
+    np.ndarray
+        The (rows, width) uint8 codes from 0 to 7.
+
+    """
+    if out is None:
+        out = np.empty(band.shape[:2], dtype=np.uint8)
+
+    is_over = np.empty(band.shape[:2], dtype=bool)
+    np.greater(band[..., 0], intensity, out=out.view(bool))
+    for channel in (1, 2):
+        np.greater(band[..., channel], intensity, out=is_over)
+        out |= is_over.view(np.uint8) << channel
+
+    return out
+
+
+def otsu_code_lut(code_counts: np.ndarray) -> np.ndarray:
+    """Otsu code lookup table
+
+    Reproduce the legacy mask, which converted the 3-channel 0/255 mask to
+    grayscale with ``cv2.COLOR_BGR2GRAY`` and ran an Otsu threshold on it.
+    The grayscale image can only hold one level per channel code, so the
+    Otsu histogram is built from the code counts instead of the image.
+
+    Parameters
+    ----------
+    code_counts : np.ndarray
+        The number of pixels for each of the 8 channel codes.
+
+    Returns
+    -------
+    np.ndarray
+        The uint8 lookup table mapping a channel code to 0 or 255.
+
+    """
+    codes = np.arange(8, dtype=np.uint8)
+    code_masks = np.stack([(codes >> channel) & 1 for channel in range(3)], axis=1) * 255
+    gray_levels = cv2.cvtColor(
+        code_masks.astype(np.uint8).reshape(1, 8, 3),
+        cv2.COLOR_BGR2GRAY,
+    ).ravel()
+
+    histogram = np.zeros(256, dtype=np.float64)
+    np.add.at(histogram, gray_levels, code_counts)
+    thresh = _otsu_threshold(histogram)
+
+    return np.where(gray_levels > thresh, 255, 0).astype(np.uint8)
+
+
+def _otsu_threshold(histogram: np.ndarray) -> int:
+    """Same search as OpenCV's ``getThreshVal_Otsu_8u``"""
+    total = histogram.sum()
+    if total == 0:
+        return 0
+
+    probabilities = histogram / total
+    mu = float(np.dot(np.arange(256), probabilities))
+    epsilon = float(np.finfo(np.float32).eps)
+    q1 = 0.0
+    mu1 = 0.0
+    max_sigma = 0.0
+    max_val = 0
+    for i, p_i in enumerate(probabilities):
+        mu1 *= q1
+        q1 += p_i
+        q2 = 1.0 - q1
+        if min(q1, q2) < epsilon or max(q1, q2) > 1.0 - epsilon:
+            continue
+
+        mu1 = (mu1 + i * p_i) / q1
+        mu2 = (mu - q1 * mu1) / q2
+        sigma = q1 * q2 * (mu1 - mu2) * (mu1 - mu2)
+        if sigma > max_sigma:
+            max_sigma = sigma
+            max_val = i
+
+    return max_val
+
+
+def saturation_mask_band(
+    band: np.ndarray,
+    intensity: float,
+    criterion: str,
+    use_bgr_order=False,
+    out: np.ndarray = None,
+) -> np.ndarray:
+    """Saturation mask band
+
+    Threshold a band (or tile) of rows into a single channel mask. Unlike
+    the legacy Otsu criterion, these criteria only look at the pixels of the
+    band, so tiles can be thresholded independently.
+
+    - Any Channel: any channel is above ``intensity``.
+    - Max Channel: the brightest channel is above ``intensity``. This selects
+      the same pixels as Any Channel from a per-pixel maximum.
+    - Luminance: the Rec. 709 luminance is above ``intensity``.
+
+    Parameters
+    ----------
+    band : np.ndarray
+        The (rows, width, 3) HDRI rows.
+    intensity : float
+        The minimum value of a saturated pixel.
+    criterion : str
+        The SaturationCriterion except OTSU.
+    use_bgr_order : bool
+        The band channels are in BGR order.
+    out : np.ndarray
+        Optional (rows, width) uint8 output.
+
+    Returns
+    -------
+    np.ndarray
+        The (rows, width) uint8 mask with 255 on saturated pixels.
+
+    """
+    if out is None:
+        out = np.empty(band.shape[:2], dtype=np.uint8)
+
+    is_saturated = out.view(bool)
+    if criterion == SaturationCriterion.ANY_CHANNEL:
+        is_over = np.empty(band.shape[:2], dtype=bool)
+        np.greater(band[..., 0], intensity, out=is_saturated)
+        for channel in (1, 2):
+            np.greater(band[..., channel], intensity, out=is_over)
+            is_saturated |= is_over
+
+    elif criterion == SaturationCriterion.MAX_CHANNEL:
+        np.greater(band.max(axis=2), intensity, out=is_saturated)
+
+    elif criterion == SaturationCriterion.LUMINANCE:
+        weights = LUMINANCE_WEIGHTS[::-1] if use_bgr_order else LUMINANCE_WEIGHTS
+        luminance = np.dot(band, np.asarray(weights, dtype=band.dtype))
+        np.greater(luminance, intensity, out=is_saturated)
+
+    else:
+        raise ValueError(f"Unsupported saturation criterion: {criterion}")
+
+    out *= 255
+    return out
+
+
+def saturation_mask(
+    hdri: np.ndarray,
+    intensity: float,
+    criterion: str = SaturationCriterion.OTSU,
+    use_bgr_order=False,
+    band_rows: int = DEFAULT_BAND_ROWS,
+    profiler: StageProfiler = None,
+) -> np.ndarray:
+    """Saturation mask
+
+    Find the saturated pixels (saturated here refers to pixel value
+    intensity, not color saturation) and write them straight into a single
+    channel mask, one band of rows at a time. No full frame 3-channel or
+    grayscale temporaries are created.
+
+    The legacy Otsu criterion needs the histogram of the whole frame, so it
+    stores the channel codes in the output on a first pass and maps them
+    through the Otsu lookup table on a second one.
+
+    Parameters
+    ----------
+    hdri : np.ndarray
+        The (height, width, 3) HDRI.
+    intensity : float
+        The minimum value of a saturated pixel.
+    criterion : str
+        The SaturationCriterion.
+    use_bgr_order : bool
+        The HDRI channels are in BGR order.
+    band_rows : int
+        Number of rows processed at a time.
+    profiler : StageProfiler
+        Optionally times the ``mask`` stage, and the ``otsu`` lookup pass
+        apart.
+
+    Returns
+    -------
+    np.ndarray
+        The (height, width) uint8 mask with 255 on saturated pixels.
+
+    """
+    height = hdri.shape[0]
+    band_rows = max(int(band_rows), 1)
+    threshold_mask = np.empty(hdri.shape[:2], dtype=np.uint8)
+
+    if criterion != SaturationCriterion.OTSU:
+        with profile_stage(profiler, "mask"):
+            for y in range(0, height, band_rows):
+                saturation_mask_band(
+                    hdri[y:y + band_rows],
+                    intensity,
+                    criterion,
+                    use_bgr_order=use_bgr_order,
+                    out=threshold_mask[y:y + band_rows],
+                )
+        return threshold_mask
+
+    with profile_stage(profiler, "mask"):
+        code_counts = np.zeros(8, dtype=np.int64)
+        for y in range(0, height, band_rows):
+            codes = channel_codes(hdri[y:y + band_rows], intensity, out=threshold_mask[y:y + band_rows])
+            code_counts += np.bincount(codes.ravel(), minlength=8)
+
+    with profile_stage(profiler, "otsu"):
+        code_lut = otsu_code_lut(code_counts)
+        for y in range(0, height, band_rows):
+            band = threshold_mask[y:y + band_rows]
+            np.take(code_lut, band, out=band)
+
+    return threshold_mask
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import os
+import re
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from hdri_dilate.dilate.engine import DilateParams
+
+# Peak resident bytes per pixel of a run, measured on 2K plates and assumed to
+# scale linearly with the pixel count, which a 4K plate stays under. Every
+# input is decoded to float32 RGB whatever its pixel type, and the peak is
+# reached while compositing, with the source, the labels, the owner map, the
+# dilated HDRI and the masks all alive. Loading an EXR peaks lower, at
+# about 49 bytes per pixel.
+RUN_BYTES_PER_PIXEL = 80
+
+# Interpreter, NumPy, OpenCV and OpenEXR of a pool process
+PROCESS_OVERHEAD_BYTES = 128 * 1024 ** 2
+
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+_HDR_RESOLUTION = re.compile(rb"^([-+])([XY]) (\d+) ([-+])([XY]) (\d+)$")
+
+
+def parse_size(text: str) -> int:
+    """Parse a byte size such as ``96G``, ``512M`` or ``1073741824``
+
+    ``auto`` is 80% of the physical memory.
+
+    Raises
+    ------
+    ValueError
+        The size cannot be parsed.
+
+    """
+    text = text.strip().upper()
+    if text == "AUTO":
+        return int(total_memory() * 0.8)
+
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMGT]?)I?B?", text)
+    if match is None:
+        raise ValueError(f"Invalid size: {text}")
+
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2)])
+
+
+def format_size(size: int) -> str:
+    return f"{size / 1024 ** 3:0.1f} GB"
+
+
+def total_memory() -> int:
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def process_memory() -> tuple[int, int] | None:
+    """Current and peak resident bytes of this process
+
+    Read from /proc/self/status on Linux, or from psutil when it is
+    installed elsewhere. The peak is the current value when the platform
+    does not keep one.
+
+    Returns
+    -------
+    tuple[int, int] | None
+        The resident bytes and their high-water mark, or None when neither
+        source is available.
+
+    """
+    try:
+        values = {}
+        with open("/proc/self/status", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    name, value = line.split(":", 1)
+                    values[name] = int(value.split()[0]) * 1024
+
+        if "VmRSS" in values:
+            return values["VmRSS"], values.get("VmHWM", values["VmRSS"])
+    except (OSError, ValueError):
+        pass
+
+    try:
+        import psutil
+    except ImportError:
+        return None
+
+    info = psutil.Process().memory_info()
+    return info.rss, getattr(info, "peak_wset", info.rss)
+
+
+def image_size(image_path: str | Path) -> tuple[int, int]:
+    """Read the (height, width) of an image from its header only
+
+    EXR sizes come from the ``dataWindow`` of ``get_exr_header``, Radiance
+    .hdr sizes from the resolution line after the text header.
+
+    Raises
+    ------
+    ValueError
+        The header holds no size.
+
+    """
+    image_path = Path(image_path)
+    if image_path.suffix.lower() == ".exr":
+        from hdri_dilate.exr import get_exr_header
+
+        data_window = get_exr_header(str(image_path))["dataWindow"]
+        return data_window.max.y - data_window.min.y + 1, data_window.max.x - data_window.min.x + 1
+
+    with open(image_path, "rb") as f:
+        header = f.read(64 * 1024)
+
+    for line in header.split(b"\n"):
+        match = _HDR_RESOLUTION.match(line.strip())
+        if match:
+            sizes = {match.group(2): int(match.group(3)), match.group(5): int(match.group(6))}
+            return sizes[b"Y"], sizes[b"X"]
+
+    raise ValueError(f"No resolution found in the header of {image_path}")
+
+
+def estimate_peak_bytes(height: int, width: int, params: DilateParams) -> int:
+    """Estimate the peak memory of dilating an image in a pool process
+
+    The pyramid pre-pass adds its downsampled float32 copy and mask.
+
+    """
+    pixels = height * width
+    bytes_per_pixel = RUN_BYTES_PER_PIXEL
+    if params.pyramid_levels:
+        bytes_per_pixel += 13 / 4 ** params.pyramid_levels
+
+    return int(PROCESS_OVERHEAD_BYTES + pixels * bytes_per_pixel)
+
+
+def estimate_file_peak_bytes(image_path: str | Path, params: DilateParams) -> int:
+    """Estimate from the file header, or as a 16K plate when it is unreadable"""
+    try:
+        height, width = image_size(image_path)
+    except Exception:
+        height, width = 8192, 16384
+
+    return estimate_peak_bytes(height, width, params)
+
+
+class MemoryBudget:
+    """Admit jobs while the sum of their estimated peaks fits the budget
+
+    A job larger than the whole budget is still admitted once nothing else
+    runs, so it runs alone instead of never.
+
+    Parameters
+    ----------
+    budget_bytes : int | None
+        The budget, None admits everything.
+
+    """
+    def __init__(self, budget_bytes: int = None):
+        self.budget_bytes = budget_bytes
+        self.in_use = 0
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def _fits(self, size: int) -> bool:
+        return self.budget_bytes is None or self.running == 0 or self.in_use + size <= self.budget_bytes
+
+    def try_acquire(self, size: int) -> bool:
+        with self.condition:
+            if not self._fits(size):
+                return False
+
+            self.in_use += size
+            self.running += 1
+            return True
+
+    def acquire(self, size: int, timeout: float = None) -> bool:
+        """Wait until the job fits, returns False on timeout"""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self._fits(size), timeout=timeout):
+                return False
+
+            self.in_use += size
+            self.running += 1
+            return True
+
+    def release(self, size: int):
+        with self.condition:
+            self.in_use -= size
+            self.running -= 1
+            self.condition.notify_all()
+
+
+def admission_order(inputs: list[Path], estimates: dict[Path, int]) -> list[Path]:
+    """Largest jobs first, so large plates start alone and small ones fill the gaps"""
+    return sorted(inputs, key=lambda image_path: estimates[image_path], reverse=True)
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+
+import cv2
+
+from hdri_dilate.dilate.engine import DilateOutput
+from hdri_dilate.dilate.profiling import StageProfiler, profile_stage
+from hdri_dilate.dilate.telemetry import ComponentTelemetry
+from hdri_dilate.exr import get_exr_header, write_exr
+
+INPUT_SUFFIXES = (".exr", ".hdr")
+
+
+def output_paths(image_path: str | Path, output_folder: str | Path) -> dict[str, Path]:
+    """Output paths
+
+    Parameters
+    ----------
+    image_path : str | Path
+        The source HDRI path.
+    output_folder : str | Path
+        The folder the outputs are written to.
+
+    Returns
+    -------
+    dict[str, Path]
+        The threshold mask, dilated mask and dilated HDRI paths keyed by
+        ``mask_thresh``, ``mask_dilated`` and ``hdri_dilated``. They keep the
+        source extension.
+
+    """
+    image_path = Path(image_path)
+    output_folder = Path(output_folder)
+    suffix = ".exr" if image_path.suffix.casefold().endswith("exr") else ".hdr"
+    return {
+        "mask_thresh": output_folder / f"{image_path.stem}_mask_threshold{suffix}",
+        "mask_dilated": output_folder / f"{image_path.stem}_mask_dilated{suffix}",
+        "hdri_dilated": output_folder / f"{image_path.stem}_dilated{suffix}",
+    }
+
+
+def write_outputs(
+    output: DilateOutput,
+    image_path: str | Path,
+    output_folder: str | Path,
+    profiler: StageProfiler = None,
+) -> list[Path]:
+    """Write the threshold mask, dilated mask and dilated HDRI
+
+    EXR sources pass their header on to the outputs. Every write is timed as
+    its own stage of the optional ``profiler``.
+
+    Returns
+    -------
+    list[Path]
+        The written paths.
+
+    """
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    paths = output_paths(image_path, output_folder)
+
+    if paths["hdri_dilated"].suffix == ".exr":
+        with profile_stage(profiler, "write header"):
+            exr_header = get_exr_header(str(image_path))
+        mask_thresh_exr_header = exr_header.copy()
+
+        with profile_stage(profiler, "write mask_thresh"):
+            write_exr(
+                output.mask_thresh,
+                paths["mask_thresh"],
+                mask_thresh_exr_header,
+            )
+        with profile_stage(profiler, "write mask_dilated"):
+            write_exr(
+                output.mask_dilated,
+                paths["mask_dilated"],
+                exr_header,
+            )
+        with profile_stage(profiler, "write hdri_dilated"):
+            write_exr(
+                output.hdri_dilated,
+                paths["hdri_dilated"],
+                exr_header,
+            )
+
+    else:
+        for name, path in paths.items():
+            with profile_stage(profiler, f"write {name}"):
+                cv2.imwrite(str(path), getattr(output, name))
+
+    return list(paths.values())
+
+
+def run_report_path(image_path: str | Path, output_folder: str | Path) -> Path:
+    return Path(output_folder) / f"{Path(image_path).stem}_run_report.json"
+
+
+def write_run_report(report: dict, image_path: str | Path, output_folder: str | Path) -> Path:
+    """Write a ``run_report`` beside the outputs, replacing it atomically"""
+    report_path = run_report_path(image_path, output_folder)
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = report_path.with_name(f"{report_path.name}.tmp")
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    os.replace(temp_path, report_path)
+    return report_path
+
+
+def component_telemetry_path(image_path: str | Path, output_folder: str | Path) -> Path:
+    return Path(output_folder) / f"{Path(image_path).stem}_components.jsonl"
+
+
+def write_component_telemetry(
+    telemetry: ComponentTelemetry,
+    image_path: str | Path,
+    output_folder: str | Path,
+) -> Path:
+    """Write the per-component telemetry beside the outputs as JSON lines"""
+    telemetry_path = component_telemetry_path(image_path, output_folder)
+    telemetry_path.parent.mkdir(parents=True, exist_ok=True)
+    telemetry.write_jsonl(telemetry_path)
+    return telemetry_path
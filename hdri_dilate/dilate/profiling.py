@@ -0,0 +1,270 @@
+from __future__ import annotations
+
+import contextlib
+import socket
+import threading
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable
+
+from hdri_dilate.dilate.memory import process_memory
+
+if TYPE_CHECKING:
+    from hdri_dilate.dilate.engine import DilateParams
+    from hdri_dilate.dilate.telemetry import ComponentTelemetry
+
+
+@dataclass
+class StageTiming:
+    """Accumulated time of a named stage
+
+    Attributes
+    ----------
+    name : str
+        The stage name. Stages nested in another one are named
+        ``parent / child``.
+    wall_seconds : float
+        Wall clock time.
+    cpu_seconds : float
+        CPU time of the whole process, or of the calling thread only for
+        per-thread stages.
+    calls : int
+        How many times the stage ran.
+    per_thread : bool
+        The stage runs on several threads at once, so its times are summed
+        over the threads and may exceed the wall time of its parent.
+    peak_rss_bytes : int
+        The highest resident memory of the process seen during the stage, 0
+        for per-thread stages or when it cannot be read.
+    peak_traced_bytes : int
+        The tracemalloc peak of the stage, 0 unless tracemalloc is tracing.
+
+    """
+    name: str
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    calls: int = 0
+    per_thread: bool = False
+    peak_rss_bytes: int = 0
+    peak_traced_bytes: int = 0
+
+
+class MemorySampler:
+    """Background thread calling ``sample`` every ``interval`` seconds
+
+    Catches the peaks of long stages that are gone by the time they end.
+
+    """
+    def __init__(self, sample: Callable[[], None], interval: float = 0.05):
+        self.sample = sample
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="memory-sampler", daemon=True)
+
+    def __enter__(self) -> MemorySampler:
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+
+class StageProfiler:
+    """Wall and CPU time of the named stages of a run
+
+    Top level stages run one after the other and are timed with the CPU
+    time of the whole process, which includes the threads OpenCV and the
+    dilate pool start. Per-thread stages, such as growing a component, run
+    concurrently and use the CPU time of their own thread, so they do not
+    count each other.
+
+    The resident memory of the process is also read when top level stages
+    start and end, and keeps being sampled in the background during
+    ``sampled`` stages. A stage raising the high-water mark of the process
+    gets that mark as its peak, so short spikes between two samples are
+    not missed. When tracemalloc is tracing, e.g. with
+    ``PYTHONTRACEMALLOC=1``, its peak is kept per stage as well.
+
+    Parameters
+    ----------
+    sample_interval : float
+        Seconds between two background samples.
+
+    """
+    def __init__(self, sample_interval: float = 0.05):
+        self.sample_interval = sample_interval
+        self.timings: dict[str, StageTiming] = {}
+        # Highest resident bytes seen so far by every open top level stage
+        self.open_peaks: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, per_thread=False, sampled=False):
+        if per_thread:
+            with self._timed(name, per_thread=True):
+                yield
+            return
+
+        start_memory = self._open(name)
+        is_tracing = tracemalloc.is_tracing()
+        if is_tracing:
+            tracemalloc.reset_peak()
+
+        peak_rss_bytes = 0
+        peak_traced_bytes = 0
+        try:
+            with self._timed(name) as timing:
+                if sampled:
+                    with MemorySampler(self.sample_memory, self.sample_interval):
+                        yield
+                else:
+                    yield
+        finally:
+            end_memory = self.sample_memory()
+            with self.lock:
+                peak_rss_bytes = self.open_peaks.pop(name, 0)
+            if start_memory is not None and end_memory is not None and end_memory[1] > start_memory[1]:
+                peak_rss_bytes = max(peak_rss_bytes, end_memory[1])
+            if is_tracing and tracemalloc.is_tracing():
+                peak_traced_bytes = tracemalloc.get_traced_memory()[1]
+
+            with self.lock:
+                timing.peak_rss_bytes = max(timing.peak_rss_bytes, peak_rss_bytes)
+                timing.peak_traced_bytes = max(timing.peak_traced_bytes, peak_traced_bytes)
+
+    @contextlib.contextmanager
+    def _timed(self, name: str, per_thread=False):
+        cpu_clock = time.thread_time if per_thread else time.process_time
+        # Listed from when the stage starts, so parents come before the stages nested in them
+        timing = self._timing(name, per_thread)
+        wall_start = time.perf_counter()
+        cpu_start = cpu_clock()
+        try:
+            yield timing
+        finally:
+            self.add(name, time.perf_counter() - wall_start, cpu_clock() - cpu_start, per_thread=per_thread)
+
+    def _open(self, name: str) -> tuple[int, int] | None:
+        with self.lock:
+            self.open_peaks[name] = 0
+
+        return self.sample_memory()
+
+    def sample_memory(self) -> tuple[int, int] | None:
+        """Read the resident memory into the peaks of the open stages"""
+        memory = process_memory()
+        if memory is None:
+            return None
+
+        with self.lock:
+            for name, peak in self.open_peaks.items():
+                self.open_peaks[name] = max(peak, memory[0])
+
+        return memory
+
+    def _timing(self, name: str, per_thread: bool) -> StageTiming:
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = StageTiming(name, per_thread=per_thread)
+
+            return timing
+
+    def add(self, name: str, wall_seconds: float, cpu_seconds: float, per_thread=False):
+        timing = self._timing(name, per_thread)
+        with self.lock:
+            timing.wall_seconds += wall_seconds
+            timing.cpu_seconds += cpu_seconds
+            timing.calls += 1
+
+    def top_level(self) -> list[StageTiming]:
+        return [timing for timing in self.timings.values() if not timing.per_thread]
+
+    @property
+    def wall_seconds(self) -> float:
+        return sum(timing.wall_seconds for timing in self.top_level())
+
+    @property
+    def cpu_seconds(self) -> float:
+        return sum(timing.cpu_seconds for timing in self.top_level())
+
+    @property
+    def peak_rss_bytes(self) -> int:
+        return max((timing.peak_rss_bytes for timing in self.top_level()), default=0)
+
+    def lines(self) -> list[str]:
+        """The stages as an aligned table, in the order they first ran"""
+        with self.lock:
+            timings = list(self.timings.values())
+
+        if not timings:
+            return []
+
+        def megabytes(size: int) -> str:
+            return f"{size / 1024 ** 2:>9.1f}" if size else f"{'':>9}"
+
+        is_traced = any(timing.peak_traced_bytes for timing in timings)
+        name_width = max(len(timing.name) for timing in timings)
+        header = f"{'Stage':<{name_width}}  {'Wall':>9}  {'CPU':>9}  {'Calls':>6}  {'RSS MB':>9}"
+        lines = [header + (f"  {'Traced MB':>9}" if is_traced else "")]
+        for timing in timings:
+            line = (
+                f"{timing.name:<{name_width}}  {timing.wall_seconds:>9.3f}  "
+                f"{timing.cpu_seconds:>9.3f}  {timing.calls:>6}  {megabytes(timing.peak_rss_bytes)}"
+            )
+            lines.append(line + (f"  {megabytes(timing.peak_traced_bytes)}" if is_traced else ""))
+
+        lines.append(
+            f"{'total':<{name_width}}  {self.wall_seconds:>9.3f}  {self.cpu_seconds:>9.3f}  "
+            f"{'':>6}  {megabytes(self.peak_rss_bytes)}"
+        )
+        return lines
+
+    def to_list(self) -> list[dict]:
+        with self.lock:
+            return [asdict(timing) for timing in self.timings.values()]
+
+
+def profile_stage(profiler: StageProfiler | None, name: str, per_thread=False, sampled=False):
+    """Time a stage when there is a profiler"""
+    if profiler is None:
+        return contextlib.nullcontext()
+
+    return profiler.stage(name, per_thread=per_thread, sampled=sampled)
+
+
+def run_report(
+    image_path: str | Path,
+    params: DilateParams,
+    profiler: StageProfiler,
+    fallback_labels: list[int] = (),
+    telemetry: ComponentTelemetry = None,
+) -> dict:
+    """Structured report of a run, for ``write_run_report``
+
+    With the ``telemetry`` of the run, the slowest components are listed
+    too.
+
+    """
+    report = {
+        "image": str(image_path),
+        "host": socket.gethostname(),
+        "created_at": time.time(),
+        "params": params.to_dict(),
+        "wall_seconds": profiler.wall_seconds,
+        "cpu_seconds": profiler.cpu_seconds,
+        "peak_rss_bytes": profiler.peak_rss_bytes,
+        "stages": profiler.to_list(),
+        "fallback_labels": list(fallback_labels),
+    }
+    if telemetry is not None:
+        report["slowest_components"] = [telemetry.row(label) for label in telemetry.slowest()]
+
+    return report
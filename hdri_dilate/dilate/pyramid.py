@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import math
+from typing import Callable
+
+import cv2
+import numpy as np
+
+from hdri_dilate.dilate.components import ImageFrame, kernel_extents, wrapped_bbox
+
+
+def downsample(image: np.ndarray, levels: int, wrap_x=False) -> np.ndarray:
+    """Downsample
+
+    Average blocks of ``2 ** levels`` pixels per side, so the mean of any
+    region is kept. The image is first padded to a multiple of the block
+    size, wrapping horizontally with ``wrap_x`` and replicating otherwise.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The (height, width, 3) image.
+    levels : int
+        Number of pyramid levels, every level halving the size.
+    wrap_x : bool
+        The left and right edges are joined.
+
+    Returns
+    -------
+    np.ndarray
+        The downsampled image.
+
+    """
+    factor = 2 ** levels
+    height, width = image.shape[:2]
+    pad_y = -height % factor
+    pad_x = -width % factor
+    if pad_y:
+        image = cv2.copyMakeBorder(image, 0, pad_y, 0, 0, cv2.BORDER_REPLICATE)
+    if pad_x:
+        border_type = cv2.BORDER_WRAP if wrap_x else cv2.BORDER_REPLICATE
+        image = cv2.copyMakeBorder(image, 0, 0, 0, pad_x, border_type)
+
+    size = ((width + pad_x) // factor, (height + pad_y) // factor)
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+class PyramidEstimator:
+    """Estimate the growth of connected components on a downsampled image
+
+    The growth search runs with a kernel scaled down by the same factor as
+    the image, so every coarse step stands for ``steps_per_coarse_step``
+    full resolution steps. The coarse step the average first drops below the
+    threshold gives the full resolution iteration a component can jump to.
+
+    The estimate is only a starting point: the caller checks the jumped mask
+    still exceeds the threshold and refines from there step by step.
+
+    """
+    def __init__(
+        self,
+        hdri: np.ndarray,
+        levels: int,
+        morph_shape: int,
+        kernel: np.ndarray,
+        is_exceeded: Callable[[tuple], bool],
+        pad: int,
+        wrap_x=False,
+    ):
+        self.factor = 2 ** levels
+        self.image = downsample(hdri, levels, wrap_x=wrap_x)
+        height, width = self.image.shape[:2]
+        self.frame = ImageFrame(width, height, wrap_x=wrap_x)
+        # Every coarse step grows the mask by at least a pixel along both
+        # axes, so it covers the frame well before this many steps
+        self.max_steps = width + height
+        self.is_exceeded = is_exceeded
+        self.pad = max(pad // self.factor, 1)
+
+        radius = np.mean(kernel_extents(kernel))
+        coarse_radius = max(round(radius / self.factor), 1)
+        coarse_size = 2 * coarse_radius + 1
+        self.kernel = cv2.getStructuringElement(morph_shape, (coarse_size, coarse_size))
+        self.kernel_extents = kernel_extents(self.kernel)
+        self.steps_per_coarse_step = coarse_radius * self.factor / radius if radius else 0
+
+    def coarse_steps(self, ys: np.ndarray, xs: np.ndarray) -> int:
+        """Number of coarse growth steps until the average drops below the threshold
+
+        Parameters
+        ----------
+        ys : np.ndarray
+            The full resolution row coordinates of the component pixels.
+        xs : np.ndarray
+            The full resolution column coordinates of the component pixels.
+
+        Returns
+        -------
+        int
+            The first coarse step that no longer exceeds the threshold, or
+            the step the mask stopped growing at, at most ``max_steps``.
+
+        """
+        frame = self.frame
+        ys = ys // self.factor
+        xs = xs // self.factor
+        if frame.wrap_x:
+            bbox = wrapped_bbox(xs, ys, frame.width)
+        else:
+            bbox = (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+
+        pad = self.pad
+        roi = frame.expand(bbox, pad, pad, pad, pad)
+        columns = xs - roi[0]
+        if frame.wrap_x:
+            columns %= frame.width
+
+        mask = np.zeros((roi[3] - roi[1], roi[2] - roi[0]), dtype=np.uint8)
+        mask[ys - roi[1], columns] = 255
+
+        area = cv2.countNonZero(mask)
+        for step in range(1, self.max_steps + 1):
+            bbox = frame.expand(bbox, *self.kernel_extents)
+            if not frame.contains(roi, bbox):
+                new_roi = frame.expand(bbox, pad, pad, pad, pad)
+                mask = frame.reembed(mask, roi, new_roi)
+                roi = new_roi
+
+            dilated_mask = frame.dilate(mask, self.kernel, roi)
+            channels_averaged = cv2.mean(frame.crop(self.image, roi), mask=dilated_mask)[:3]
+            if not self.is_exceeded(channels_averaged):
+                return step
+
+            dilated_area = cv2.countNonZero(dilated_mask)
+            if dilated_area == area:
+                return step
+
+            mask = dilated_mask
+            area = dilated_area
+
+        return self.max_steps
+
+    def start_iteration(self, ys: np.ndarray, xs: np.ndarray) -> int:
+        """Full resolution iteration a component can safely jump to
+
+        One coarse step before the predicted stop, less one step for the
+        rounding of the scaled kernel.
+
+        """
+        if not self.steps_per_coarse_step:
+            return 0
+
+        return self.start_iteration_from_steps(self.coarse_steps(ys, xs))
+
+    def start_iteration_from_steps(self, coarse_steps: int) -> int:
+        if not self.steps_per_coarse_step:
+            return 0
+
+        return max(math.floor((coarse_steps - 1) * self.steps_per_coarse_step) - 1, 0)
+
+    def growth_distance(self, coarse_steps: int) -> float:
+        """Full resolution distance in px covered by ``coarse_steps``"""
+        return coarse_steps * np.mean(self.kernel_extents) * self.factor
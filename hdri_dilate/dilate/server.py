@@ -0,0 +1,388 @@
+from __future__ import annotations
+
+import json
+import queue
+import threading
+import time
+import traceback
+import uuid
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from hdri_dilate.dilate.engine import DilateEngine, DilateParams, DilateProgress, load_hdri
+from hdri_dilate.dilate.outputs import (
+    INPUT_SUFFIXES,
+    write_component_telemetry,
+    write_outputs,
+    write_run_report,
+)
+from hdri_dilate.dilate.profiling import run_report
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+@dataclass
+class Job:
+    """A dilation submitted to the JobServer
+
+    The timestamps are seconds since the epoch, the durations are seconds.
+
+    """
+    id: str
+    image_path: str
+    output_folder: str
+    params: DilateParams
+    status: str = QUEUED
+    stage: str = ""
+    progress: int = 0
+    progress_max: int = 0
+    submitted_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+    load_seconds: float = 0.0
+    dilate_seconds: float = 0.0
+    write_seconds: float = 0.0
+    outputs: list[str] = field(default_factory=list)
+    fallback_labels: list[int] = field(default_factory=list)
+    stages: list[dict] = field(default_factory=list)
+    error: str | None = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "input": self.image_path,
+            "output": self.output_folder,
+            "params": self.params.to_dict(),
+            "status": self.status,
+            "stage": self.stage,
+            "progress": self.progress,
+            "progress_max": self.progress_max,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "load_seconds": self.load_seconds,
+            "dilate_seconds": self.dilate_seconds,
+            "write_seconds": self.write_seconds,
+            "outputs": self.outputs,
+            "fallback_labels": self.fallback_labels,
+            "stages": self.stages,
+            "error": self.error,
+        }
+
+
+class JobProgress(DilateProgress):
+    """Store the progress of an engine run on its job"""
+    def __init__(self, job: Job, lock: threading.Lock):
+        self.job = job
+        self.lock = lock
+
+    def stage(self, message: str):
+        with self.lock:
+            self.job.stage = message
+
+    def progress(self, value: int):
+        with self.lock:
+            self.job.progress = value
+
+    def progress_max(self, value: int):
+        with self.lock:
+            self.job.progress_max = value
+
+
+class JobRunner:
+    """Queue jobs on a fixed set of worker threads
+
+    The threads live as long as the runner, so every job runs in an already
+    warm process. OpenCV and OpenEXR release the GIL for the heavy lifting,
+    and running in-process lets the engine report its progress directly.
+
+    Parameters
+    ----------
+    params : DilateParams
+        The defaults jobs override with their own parameters.
+    workers : int
+        Number of jobs dilated at the same time. Each uses
+        ``max_workers`` threads of its own.
+
+    """
+    def __init__(self, params: DilateParams = None, workers: int = 1):
+        self.params = params or DilateParams()
+        self.workers = max(workers, 1)
+        self.lock = threading.Lock()
+        self.jobs: dict[str, Job] = {}
+        self.engines: dict[str, DilateEngine] = {}
+        self.pending: queue.Queue[str | None] = queue.Queue()
+        self.threads: list[threading.Thread] = []
+
+    def start(self):
+        self.threads = [
+            threading.Thread(target=self._work, name=f"job-{index}", daemon=True)
+            for index in range(self.workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """Cancel the running jobs and wait for the worker threads"""
+        with self.lock:
+            for engine in self.engines.values():
+                engine.cancel()
+
+        for _ in self.threads:
+            self.pending.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+    def submit(self, image_path: str, output_folder: str, params: dict = None) -> Job:
+        """Queue a job
+
+        Parameters
+        ----------
+        image_path : str
+            The .exr/.hdr file to dilate.
+        output_folder : str
+            The folder the outputs are written to.
+        params : dict
+            DilateParams fields overriding the runner defaults.
+
+        Raises
+        ------
+        ValueError
+            The input is not an .exr/.hdr file or a parameter is unknown.
+        FileNotFoundError
+            The input does not exist.
+
+        """
+        path = Path(image_path)
+        if path.suffix.lower() not in INPUT_SUFFIXES:
+            raise ValueError(f"Not an .exr/.hdr file: {image_path}")
+
+        if not path.is_file():
+            raise FileNotFoundError(f"File not found: {image_path}")
+
+        job_params = DilateParams.from_dict({**self.params.to_dict(), **(params or {})})
+        job = Job(uuid.uuid4().hex, str(path), str(output_folder), job_params)
+        with self.lock:
+            self.jobs[job.id] = job
+
+        self.pending.put(job.id)
+        return job
+
+    def get(self, job_id: str) -> dict | None:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return job.to_dict() if job else None
+
+    def list(self) -> list[dict]:
+        with self.lock:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def cancel(self, job_id: str) -> dict | None:
+        """Cancel a queued or running job, finished jobs are left as they are"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+
+            if job.status == QUEUED:
+                job.status = CANCELLED
+                job.finished_at = time.time()
+            elif job.id in self.engines:
+                self.engines[job.id].cancel()
+
+            return job.to_dict()
+
+    def counts(self) -> dict[str, int]:
+        with self.lock:
+            counts = dict.fromkeys((QUEUED, RUNNING, DONE, FAILED, CANCELLED), 0)
+            for job in self.jobs.values():
+                counts[job.status] += 1
+
+            return counts
+
+    def _work(self):
+        while True:
+            job_id = self.pending.get()
+            if job_id is None:
+                return
+
+            with self.lock:
+                job = self.jobs[job_id]
+                if job.status != QUEUED:
+                    continue
+
+                engine = DilateEngine(job.params, progress=JobProgress(job, self.lock))
+                self.engines[job_id] = engine
+                job.status = RUNNING
+                job.started_at = time.time()
+
+            try:
+                self._run(job, engine)
+            except Exception:
+                with self.lock:
+                    job.status = FAILED
+                    job.error = traceback.format_exc()
+            finally:
+                with self.lock:
+                    del self.engines[job_id]
+                    job.finished_at = time.time()
+
+    def _run(self, job: Job, engine: DilateEngine):
+        start_time = time.perf_counter()
+        engine.progress.stage(f"Loading image... {Path(job.image_path).name}")
+        hdri = load_hdri(job.image_path, use_bgr_order=job.params.use_bgr_order, profiler=engine.profiler)
+        load_seconds = time.perf_counter() - start_time
+        with self.lock:
+            job.load_seconds = load_seconds
+
+        dilate_start_time = time.perf_counter()
+        output = engine.run(hdri)
+        dilate_seconds = time.perf_counter() - dilate_start_time
+        with self.lock:
+            job.dilate_seconds = dilate_seconds
+            if output is None:
+                job.status = CANCELLED
+                return
+
+            job.fallback_labels = output.fallback_labels
+
+        write_start_time = time.perf_counter()
+        engine.progress.stage("Writing outputs...")
+        outputs = write_outputs(output, job.image_path, job.output_folder, profiler=engine.profiler)
+        write_seconds = time.perf_counter() - write_start_time
+        outputs.append(write_run_report(
+            run_report(job.image_path, job.params, engine.profiler, output.fallback_labels, engine.telemetry),
+            job.image_path,
+            job.output_folder,
+        ))
+        outputs.append(write_component_telemetry(engine.telemetry, job.image_path, job.output_folder))
+        with self.lock:
+            job.write_seconds = write_seconds
+            job.outputs = [str(path) for path in outputs]
+            job.stages = engine.profiler.to_list()
+            job.stage = "Done"
+            job.status = DONE
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """JSON endpoints of the JobServer
+
+    ``GET /health``
+        Server status and job counts.
+    ``GET /jobs``
+        Every job.
+    ``POST /jobs``
+        Submit ``{"input": path, "output": folder, "params": {...}}``,
+        ``params`` being optional DilateParams fields.
+    ``GET /jobs/<id>``
+        A job status, progress and timings.
+    ``DELETE /jobs/<id>``
+        Cancel a job.
+
+    """
+    server: JobServer
+
+    def _send_json(self, status: HTTPStatus, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: HTTPStatus, message: str):
+        self._send_json(status, {"error": message})
+
+    def _job_id(self) -> str | None:
+        parts = self.path.rstrip("/").split("/")
+        if len(parts) == 3 and parts[1] == "jobs":
+            return parts[2]
+
+        return None
+
+    def do_GET(self):
+        runner = self.server.runner
+        if self.path == "/health":
+            self._send_json(HTTPStatus.OK, {"status": "ok", "workers": runner.workers, "jobs": runner.counts()})
+        elif self.path.rstrip("/") == "/jobs":
+            self._send_json(HTTPStatus.OK, runner.list())
+        elif (job_id := self._job_id()) is not None:
+            job = runner.get(job_id)
+            if job is None:
+                self._send_error(HTTPStatus.NOT_FOUND, f"Unknown job {job_id}")
+            else:
+                self._send_json(HTTPStatus.OK, job)
+        else:
+            self._send_error(HTTPStatus.NOT_FOUND, f"Unknown endpoint {self.path}")
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self._send_error(HTTPStatus.NOT_FOUND, f"Unknown endpoint {self.path}")
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(body, dict):
+                raise ValueError("The body must be a JSON object")
+
+            image_path = body["input"]
+            output_folder = body["output"]
+            params = body.get("params") or {}
+            if not isinstance(params, dict):
+                raise ValueError("params must be a JSON object")
+
+            job = self.server.runner.submit(image_path, output_folder, params)
+        except KeyError as e:
+            self._send_error(HTTPStatus.BAD_REQUEST, f"Missing field {e}")
+        except FileNotFoundError as e:
+            self._send_error(HTTPStatus.NOT_FOUND, str(e))
+        except (TypeError, ValueError) as e:
+            self._send_error(HTTPStatus.BAD_REQUEST, str(e))
+        else:
+            self._send_json(HTTPStatus.CREATED, self.server.runner.get(job.id))
+
+    def do_DELETE(self):
+        job_id = self._job_id()
+        job = self.server.runner.cancel(job_id) if job_id is not None else None
+        if job is None:
+            self._send_error(HTTPStatus.NOT_FOUND, f"Unknown job {job_id}")
+        else:
+            self._send_json(HTTPStatus.OK, job)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class JobServer(ThreadingHTTPServer):
+    """Local HTTP server queueing dilation jobs on a JobRunner
+
+    Meant for pipeline tools and DCC plugins on the same workstation, there
+    is no authentication, so keep it bound to localhost.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], runner: JobRunner, verbose=False):
+        super().__init__(address, JobRequestHandler)
+        self.runner = runner
+        self.verbose = verbose
+
+    def serve_forever(self, poll_interval=0.5):
+        self.runner.start()
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self.runner.stop()
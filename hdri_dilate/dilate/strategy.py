@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import os
+from dataclasses import dataclass, replace
+from typing import TYPE_CHECKING
+
+from hdri_dilate.dilate.memory import estimate_peak_bytes, format_size
+
+if TYPE_CHECKING:
+    from hdri_dilate.dilate.engine import DilateParams
+
+# Levels of the downsampled probe predicting how far every component grows
+PROBE_LEVELS = 3
+
+# Cost model of a growth step, calibrated single threaded: a fixed part for
+# the bookkeeping and the threshold check, and a part per ROI pixel for the
+# dilation and the masked mean
+STEP_SECONDS = 25e-6
+PIXEL_STEP_SECONDS = 1.0e-9
+# A dilation alone, as repeated by the jump after a pyramid pre-pass
+JUMP_PIXEL_STEP_SECONDS = 0.1e-9
+# Averaging the image down for the pyramid pre-pass
+DOWNSAMPLE_PIXEL_SECONDS = 2e-9
+# Thresholding, labelling and compositing, the same for every strategy
+FRAME_PIXEL_SECONDS = 40e-9
+
+
+@dataclass
+class StrategyEstimate:
+    """Predicted cost of running with a strategy
+
+    Attributes
+    ----------
+    name : str
+        The strategy name.
+    pyramid_levels : int
+        The pyramid pre-pass levels it runs with, 0 for in-memory.
+    peak_bytes : int
+        The predicted peak memory of the process.
+    seconds : float
+        The predicted run time.
+
+    """
+    name: str
+    pyramid_levels: int
+    peak_bytes: int
+    seconds: float
+
+    def describe(self) -> str:
+        return f"{self.name}: ~{format_size(self.peak_bytes)} peak, ~{self.seconds:0.2f} secs"
+
+
+def available_memory() -> int:
+    """Memory the process can still get without swapping, from /proc/meminfo on Linux"""
+    try:
+        with open("/proc/meminfo", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+
+def roi_pixels(width: float, height: float, distance: float, frame_size: tuple[int, int]) -> float:
+    """Pixels of a component ROI grown by ``distance``, at most the frame"""
+    frame_height, frame_width = frame_size
+    return min(width + 2 * distance, frame_width) * min(height + 2 * distance, frame_height)
+
+
+def growth_seconds(
+    width: float,
+    height: float,
+    start: float,
+    stop: float,
+    step_radius: float,
+    frame_size: tuple[int, int],
+) -> float:
+    """Predicted time to grow a component from ``start`` to ``stop`` px away
+
+    Every step covers ``step_radius`` px and dilates a ROI as large as the
+    component grown by the distance so far, taken at the middle distance.
+
+    """
+    if stop <= start or step_radius <= 0:
+        return 0.0
+
+    steps = (stop - start) / step_radius
+    pixels = roi_pixels(width, height, (start + stop) / 2, frame_size)
+    return steps * (STEP_SECONDS + pixels * PIXEL_STEP_SECONDS)
+
+
+def estimate_strategies(
+    height: int,
+    width: int,
+    sizes: list[tuple[int, int]],
+    distances: list[float],
+    params: DilateParams,
+    step_radius: float,
+    threads: int,
+) -> list[StrategyEstimate]:
+    """Predict the memory and run time of every available strategy
+
+    The strategies are the in-memory engine and the pyramid pre-pass at 1
+    to 3 levels. A pre-pass grows every component on an image downsampled
+    by ``2 ** levels`` and jumps to one coarse step before where it stops,
+    so only that last stretch is grown at full resolution.
+
+    Parameters
+    ----------
+    height, width : int
+        The image size.
+    sizes : list[tuple[int, int]]
+        The (width, height) of the component bounding boxes.
+    distances : list[float]
+        The predicted growth distance in px of each component.
+    params : DilateParams
+        The dilate parameters.
+    step_radius : float
+        The distance in px of one full resolution growth step.
+    threads : int
+        The threads growing components at the same time.
+
+    """
+    pixels = height * width
+    frame_size = (height, width)
+    frame_seconds = pixels * FRAME_PIXEL_SECONDS
+    # Components are spread over the threads, while there are enough of them
+    parallelism = max(min(threads, len(sizes), os.cpu_count() or 1), 1)
+
+    estimates = []
+    for levels in range(0, PROBE_LEVELS + 1):
+        factor = 2 ** levels
+        seconds = 0.0
+        for (component_width, component_height), distance in zip(sizes, distances):
+            if levels == 0:
+                seconds += growth_seconds(component_width, component_height, 0, distance, step_radius, frame_size)
+                continue
+
+            coarse_step_radius = max(round(step_radius / factor), 1)
+            seconds += growth_seconds(
+                component_width / factor,
+                component_height / factor,
+                0,
+                distance / factor,
+                coarse_step_radius,
+                (height / factor, width / factor),
+            )
+            refine_start = max(distance - coarse_step_radius * factor - step_radius, 0)
+            seconds += (
+                refine_start / step_radius
+                * roi_pixels(component_width, component_height, refine_start, frame_size)
+                * JUMP_PIXEL_STEP_SECONDS
+            )
+            seconds += growth_seconds(
+                component_width,
+                component_height,
+                refine_start,
+                distance,
+                step_radius,
+                frame_size,
+            )
+
+        seconds /= parallelism
+        if levels:
+            seconds += pixels * DOWNSAMPLE_PIXEL_SECONDS
+
+        estimates.append(StrategyEstimate(
+            f"pyramid/{factor}" if levels else "in-memory",
+            levels,
+            estimate_peak_bytes(height, width, replace(params, pyramid_levels=levels)),
+            frame_seconds + seconds,
+        ))
+
+    return estimates
+
+
+def choose_strategy(estimates: list[StrategyEstimate], available_bytes: int) -> tuple[StrategyEstimate, str]:
+    """Pick the strategy with the shortest predicted run time
+
+    Every strategy holds the full resolution image, and the pyramid
+    pre-pass only adds its downsampled copy, so none of them needs less
+    memory than in-memory. The choice is made on time alone, and the
+    reason warns when the predicted peak exceeds ``available_bytes``.
+
+    Returns
+    -------
+    tuple[StrategyEstimate, str]
+        The strategy and why it was picked.
+
+    """
+    fastest = min(estimates, key=lambda estimate: estimate.seconds)
+    if fastest.peak_bytes > available_bytes:
+        return fastest, (
+            f"fastest, but its ~{format_size(fastest.peak_bytes)} peak exceeds the "
+            f"{format_size(available_bytes)} available and no strategy needs less than in-memory"
+        )
+
+    return fastest, "fastest"
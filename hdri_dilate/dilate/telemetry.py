@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from hdri_dilate.dilate.components import T_BOX, ComponentResult
+
+
+class ComponentTelemetry:
+    """What every grown component of a run did, one row per label
+
+    The rows live in arrays allocated once for all the labels, so recording
+    from the dilate threads only writes into the row of the component, and
+    images with hundreds of thousands of components stay cheap to track.
+
+    Attributes
+    ----------
+    recorded : np.ndarray
+        Whether every label has a row.
+    bbox : np.ndarray
+        The (x0, y0, x1, y1) seed bounding boxes.
+    seed_area : np.ndarray
+        The saturated pixels of the seeds.
+    iterations : np.ndarray
+        The growth steps taken, including the ones jumped over.
+    mean : np.ndarray
+        The averaged channel values the components are filled with.
+    dilated_bbox : np.ndarray
+        The bounding boxes of the final masks, blur included.
+    dilated_area : np.ndarray
+        The non-zero pixels of the final masks, blur included.
+    seconds, cpu_seconds : np.ndarray
+        Wall and thread CPU time of growing the components.
+    terminated_early : np.ndarray
+        The growth stopped because one channel fell below the threshold
+        while another was still above it, with ``terminate_early``.
+    fallback : np.ndarray
+        The component ran out of its growth budget and was finished with a
+        coarse estimate.
+    resumed : np.ndarray
+        The component was read back from a checkpoint, so it has no time.
+
+    Parameters
+    ----------
+    label_count : int
+        The number of labels, background included.
+    step_radius : float
+        The distance in px of one growth step.
+
+    """
+    def __init__(self, label_count: int, step_radius: float):
+        self.step_radius = step_radius
+        self.recorded = np.zeros(label_count, dtype=bool)
+        self.bbox = np.zeros((label_count, 4), dtype=np.int32)
+        self.seed_area = np.zeros(label_count, dtype=np.int64)
+        self.iterations = np.zeros(label_count, dtype=np.int32)
+        self.mean = np.zeros((label_count, 3), dtype=np.float64)
+        self.dilated_bbox = np.zeros((label_count, 4), dtype=np.int32)
+        self.dilated_area = np.zeros(label_count, dtype=np.int64)
+        self.seconds = np.zeros(label_count, dtype=np.float64)
+        self.cpu_seconds = np.zeros(label_count, dtype=np.float64)
+        self.terminated_early = np.zeros(label_count, dtype=bool)
+        self.fallback = np.zeros(label_count, dtype=bool)
+        self.resumed = np.zeros(label_count, dtype=bool)
+
+    def record(
+        self,
+        result: ComponentResult,
+        seed_bbox: T_BOX,
+        seed_area: int,
+        resumed=False,
+    ):
+        label = result.label
+        self.bbox[label] = seed_bbox
+        self.seed_area[label] = seed_area
+        self.iterations[label] = result.iterations
+        self.mean[label] = result.fill
+        self.dilated_bbox[label] = result.bbox
+        self.dilated_area[label] = np.count_nonzero(result.mask)
+        self.terminated_early[label] = result.terminated_early
+        self.fallback[label] = result.fallback
+        self.resumed[label] = resumed
+        self.recorded[label] = True
+
+    def record_time(self, label: int, seconds: float, cpu_seconds: float):
+        self.seconds[label] = seconds
+        self.cpu_seconds[label] = cpu_seconds
+
+    def labels(self) -> np.ndarray:
+        return np.flatnonzero(self.recorded)
+
+    def slowest(self, count: int = 10) -> list[int]:
+        labels = self.labels()
+        order = np.argsort(self.seconds[labels], kind="stable")[::-1]
+        return [int(label) for label in labels[order[:count]]]
+
+    def row(self, label: int) -> dict:
+        return {
+            "label": int(label),
+            "bbox": self.bbox[label].tolist(),
+            "seed_area": int(self.seed_area[label]),
+            "iterations": int(self.iterations[label]),
+            "radius": float(self.iterations[label] * self.step_radius),
+            "mean": self.mean[label].tolist(),
+            "dilated_bbox": self.dilated_bbox[label].tolist(),
+            "dilated_area": int(self.dilated_area[label]),
+            "seconds": float(self.seconds[label]),
+            "cpu_seconds": float(self.cpu_seconds[label]),
+            "terminated_early": bool(self.terminated_early[label]),
+            "fallback": bool(self.fallback[label]),
+            "resumed": bool(self.resumed[label]),
+        }
+
+    def write_jsonl(self, path: str | Path):
+        """Write a JSON object per recorded component, by label, replacing ``path`` atomically"""
+        path = Path(path)
+        temp_path = path.with_name(f"{path.name}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for label in self.labels():
+                f.write(json.dumps(self.row(label)))
+                f.write("\n")
+
+        os.replace(temp_path, path)
@@ -0,0 +1,377 @@
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import numpy as np
+
+from hdri_dilate.dilate.batch import FileReport, T_REPORT_CALLBACK, process_file, quiet_stdout
+from hdri_dilate.dilate.engine import DilateEngine, DilateParams
+from hdri_dilate.dilate.outputs import INPUT_SUFFIXES, output_paths
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+# Pool crashes a file is retried after before it is reported as failed
+MAX_CRASH_RETRIES = 2
+
+
+def is_watched_file(path: Path) -> bool:
+    """Inputs worth looking at, skipping hidden and temporary files"""
+    return path.suffix.lower() in INPUT_SUFFIXES and not path.name.startswith(".")
+
+
+class PollingWatcher:
+    """Find new or changed files by comparing directory scans
+
+    Works everywhere, including network shares that inotify does not see
+    remote writes on. Files already present when it starts are not
+    reported until they change.
+
+    """
+    def __init__(self, folder: str | Path):
+        self.folder = Path(folder)
+        self.signatures = self._scan()
+
+    def _scan(self) -> dict[Path, tuple[int, int]]:
+        signatures = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                path = Path(entry.path)
+                if not is_watched_file(path):
+                    continue
+
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                signatures[path] = (stat.st_size, stat.st_mtime_ns)
+
+        return signatures
+
+    def poll(self, timeout: float) -> set[Path]:
+        time.sleep(timeout)
+        signatures = self._scan()
+        changed = {
+            path for path, signature in signatures.items()
+            if self.signatures.get(path) != signature
+        }
+        self.signatures = signatures
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Find new or changed files with Linux inotify through ctypes
+
+    Raises
+    ------
+    OSError
+        inotify is not available.
+
+    """
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, folder: str | Path):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+
+        self.folder = Path(folder)
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available in libc")
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        watch = libc.inotify_add_watch(self.fd, os.fsencode(self.folder), self.MASK)
+        if watch < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, os.strerror(error), str(self.folder))
+
+    def poll(self, timeout: float) -> set[Path]:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset + _INOTIFY_EVENT.size <= len(data):
+            _, mask, _, name_size = _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            name = data[offset:offset + name_size].rstrip(b"\0")
+            offset += name_size
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, fall back to everything in the folder
+                changed.update(path for path in PollingWatcher(self.folder).signatures)
+                continue
+
+            path = self.folder / os.fsdecode(name)
+            if name and is_watched_file(path):
+                changed.add(path)
+
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(folder: str | Path, use_inotify=True) -> InotifyWatcher | PollingWatcher:
+    if use_inotify:
+        try:
+            return InotifyWatcher(folder)
+        except OSError:
+            pass
+
+    return PollingWatcher(folder)
+
+
+class StableFileTracker:
+    """Hold back files until their size and mtime stop changing
+
+    A file is ready once it is not empty and has kept the same size and
+    modification time for ``settle_seconds``, so files still being copied
+    or written are not picked up half way.
+
+    """
+    def __init__(self, settle_seconds: float):
+        self.settle_seconds = settle_seconds
+        self.pending: dict[Path, tuple[int, int, float]] = {}
+
+    def touch(self, path: Path):
+        self.pending.setdefault(path, (-1, -1, time.monotonic()))
+
+    def pop_ready(self) -> list[Path]:
+        now = time.monotonic()
+        ready = []
+        for path, (size, mtime_ns, stable_since) in list(self.pending.items()):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                del self.pending[path]
+                continue
+
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                self.pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+            elif stat.st_size > 0 and now - stable_since >= self.settle_seconds:
+                del self.pending[path]
+                ready.append(path)
+
+        return sorted(ready)
+
+
+def _warm_up(params: DilateParams):
+    """Pool initializer running a tiny dilation to load and warm every module"""
+    hdri = np.zeros((16, 16, 3), dtype=np.float32)
+    hdri[8, 8] = params.intensity + 1
+    with quiet_stdout():
+        DilateEngine(params).run(hdri)
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+class WatchDaemon:
+    """Dilate the HDRIs landing in a folder
+
+    New or changed .exr/.hdr files are dilated once their size is stable,
+    on a process pool that is started and warmed up once, so every file
+    only pays for its own processing. Files already in the folder are
+    dilated at start unless all their outputs exist.
+
+    A pool process dying, say to the OOM killer, breaks the whole pool and
+    every file in flight with it. The pool is then rebuilt and warmed up
+    again, and the files it lost are retried, up to ``MAX_CRASH_RETRIES``
+    times each, since the one that crashed it cannot be told apart.
+
+    Parameters
+    ----------
+    watch_folder : str | Path
+        The folder to watch, not recursively.
+    output_folder : str | Path
+        The folder the outputs are written to. It may be the watched
+        folder, the outputs are never picked up as inputs.
+    params : DilateParams
+        The dilate parameters.
+    jobs : int
+        Number of pool processes.
+    settle_seconds : float
+        How long a file has to stay unchanged before it is processed.
+    poll_interval : float
+        Seconds between checks for new and settled files.
+    use_inotify : bool
+        Use inotify where available instead of polling.
+    verbose : bool
+        Keep the growth step prints.
+    on_report : T_REPORT_CALLBACK
+        Called as files finish.
+
+    """
+    def __init__(
+        self,
+        watch_folder: str | Path,
+        output_folder: str | Path,
+        params: DilateParams,
+        jobs: int = 1,
+        settle_seconds: float = 2.0,
+        poll_interval: float = 1.0,
+        use_inotify=True,
+        verbose=False,
+        on_report: T_REPORT_CALLBACK = None,
+    ):
+        self.watch_folder = Path(watch_folder)
+        self.output_folder = Path(output_folder)
+        self.params = params
+        self.jobs = max(jobs, 1)
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.verbose = verbose
+        self.on_report = on_report
+
+        self.tracker = StableFileTracker(settle_seconds)
+        self.watcher: InotifyWatcher | PollingWatcher | None = None
+        self.executor: ProcessPoolExecutor | None = None
+        self.running: dict[Path, Future] = {}
+        self.crash_counts: dict[Path, int] = {}
+        self.is_pool_broken = False
+        self.outputs: set[Path] = set()
+        self.stop_event = threading.Event()
+
+    @property
+    def watcher_name(self) -> str:
+        return "inotify" if isinstance(self.watcher, InotifyWatcher) else "polling"
+
+    def _is_output(self, path: Path) -> bool:
+        if path.resolve() in self.outputs:
+            return True
+
+        # Outputs of other files written into the watched folder
+        stem = path.stem
+        for suffix in ("_mask_threshold", "_mask_dilated", "_dilated"):
+            source_stem = stem.removesuffix(suffix)
+            if source_stem != stem and (path.parent / f"{source_stem}{path.suffix}").exists():
+                return True
+
+        return False
+
+    def _has_outputs(self, path: Path) -> bool:
+        return all(output.exists() for output in output_paths(path, self.output_folder).values())
+
+    def start(self):
+        self.watcher = create_watcher(self.watch_folder, use_inotify=self.use_inotify)
+        self._start_pool()
+        for path in sorted(self.watch_folder.iterdir()):
+            if is_watched_file(path) and not self._is_output(path) and not self._has_outputs(path):
+                self.tracker.touch(path)
+
+    def _start_pool(self):
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.jobs,
+            initializer=_warm_up,
+            initargs=(self.params,),
+        )
+        # Workers are spawned on demand, so start all of them up front
+        for future in [self.executor.submit(_ping) for _ in range(self.jobs)]:
+            future.result()
+
+        self.is_pool_broken = False
+
+    def _restart_pool(self):
+        """Replace a broken pool once every file it lost is collected"""
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self._start_pool()
+
+    def _submit(self, path: Path):
+        if path in self.running or self.is_pool_broken:
+            # Changed again while being processed, or the pool is being
+            # replaced, look at it again once that is done
+            self.tracker.touch(path)
+            return
+
+        try:
+            future = self.executor.submit(process_file, path, self.output_folder, self.params, self.verbose)
+        except BrokenProcessPool:
+            self.is_pool_broken = True
+            self.tracker.touch(path)
+            return
+
+        self.running[path] = future
+
+    def _collect(self):
+        for path, future in list(self.running.items()):
+            if not future.done():
+                continue
+
+            del self.running[path]
+            try:
+                report = future.result()
+            except BrokenProcessPool as e:
+                self.is_pool_broken = True
+                crash_count = self.crash_counts.get(path, 0) + 1
+                if crash_count <= MAX_CRASH_RETRIES:
+                    self.crash_counts[path] = crash_count
+                    self.tracker.touch(path)
+                    continue
+
+                report = FileReport(str(path), error=f"{e!r} after {crash_count} pool crashes")
+            except Exception as e:
+                report = FileReport(str(path), error=repr(e))
+
+            self.crash_counts.pop(path, None)
+            self.outputs.update(Path(output).resolve() for output in report.outputs)
+            if self.on_report:
+                self.on_report(report)
+
+    def run(self):
+        """Watch until stop() is called, starting first if needed"""
+        if self.executor is None:
+            self.start()
+
+        try:
+            while not self.stop_event.is_set():
+                for path in self.watcher.poll(self.poll_interval):
+                    if not self._is_output(path):
+                        self.tracker.touch(path)
+
+                for path in self.tracker.pop_ready():
+                    self._submit(path)
+
+                self._collect()
+                if self.is_pool_broken and not self.running:
+                    self._restart_pool()
+        finally:
+            self.watcher.close()
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self._collect()
+
+    def stop(self):
+        self.stop_event.set()
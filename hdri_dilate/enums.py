@@ -2,3 +2,10 @@ class MorphShape:
     RECTANGLE = "Rectangle"
     CROSS = "Cross"
     ELLIPSIS = "Ellipsis"
+
+
+class SaturationCriterion:
+    OTSU = "Otsu (Legacy)"
+    ANY_CHANNEL = "Any Channel"
+    MAX_CHANNEL = "Max Channel"
+    LUMINANCE = "Luminance"
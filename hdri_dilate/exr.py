@@ -18,8 +18,8 @@ def get_exr_header(exr_path: str) -> dict:
     return exr_header
 
 
-def load_exr(exr_path: str, use_bgr_order=False):
-    exr = OpenEXR.InputFile(exr_path)
+def load_exr(exr_path: str | OpenEXR.InputFile, use_bgr_order=False):
+    exr = exr_path if isinstance(exr_path, OpenEXR.InputFile) else OpenEXR.InputFile(exr_path)
 
     dw = exr.header()["dataWindow"]
     image_size = (dw.max.x - dw.min.x + 1, dw.max.y - dw.min.y + 1)
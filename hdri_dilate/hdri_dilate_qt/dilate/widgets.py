@@ -8,12 +8,13 @@ if TYPE_CHECKING:
         MainWindow,
     )
 
-import cv2
 import numpy as np
 from PySide6.QtWidgets import *
 
 from hdri_dilate.constants import DOUBLE_LINEBREAKS
-from hdri_dilate.exr import get_exr_header, write_exr
+from hdri_dilate.dilate.engine import DilateOutput
+from hdri_dilate.dilate.outputs import write_component_telemetry, write_outputs, write_run_report
+from hdri_dilate.dilate.profiling import run_report
 from hdri_dilate.hdri_dilate_qt import tr
 from hdri_dilate.hdri_dilate_qt.dilate.workers import (
     DilateWorker,
@@ -28,14 +29,15 @@ from hdri_dilate.plotting import (
 
 
 class DilateProgressDialog(QDialog):
-    def __init__(self, parent: "MainWindow"):
+    def __init__(self, parent: "MainWindow", dry_run=False):
         super().__init__(parent)
         self.parent_ = parent
-        self.setWindowTitle(tr("Generating HDRI Dilate"))
+        self.dry_run = dry_run
+        self.setWindowTitle(tr("HDRI Dilate Dry Run") if dry_run else tr("Generating HDRI Dilate"))
         self.setup_ui()
 
         self.result_duration = 0.0
-        self.worker = DilateWorker(self.parent_)
+        self.worker = DilateWorker(self.parent_, dry_run=dry_run)
         self.run_worker()
 
     def _set_output_mask_thresh(self, output):
@@ -103,6 +105,13 @@ class DilateProgressDialog(QDialog):
             return
 
         self.progress_bar.setValue(self.progress_bar.maximum())
+        # Nothing was dilated, the report is already in the log
+        if self.dry_run:
+            self.progress_bar.setMaximum(1)
+            self.progress_bar.setValue(1)
+            self._change_abort_to_close()
+            return
+
         images = (
             self.output_mask_thresh,
             self.output_mask_dilated,
@@ -140,43 +149,38 @@ class DilateProgressDialog(QDialog):
             )
             show_four_way(images, title, texts)
 
-        if self.parent_.save_output_checkbox.isChecked():
-            output_path = Path(self.parent_.output_folder_lineedit.get_path())
-            output_path.mkdir(parents=True, exist_ok=True)
-
-            image_path = Path(self.parent_.image_path_lineedit.get_path())
-            if image_path.suffix.casefold().endswith("exr"):
-                exr_header = get_exr_header(
-                    self.parent_.image_path_lineedit.get_path()
-                )
-                mask_thresh_exr_header = exr_header.copy()
-
-                mask_thresh = output_path / f"{image_path.stem}_mask_threshold.exr"
-                mask_dilated = output_path / f"{image_path.stem}_mask_dilated.exr"
-                hdri_dilated = output_path / f"{image_path.stem}_dilated.exr"
-
-                write_exr(
-                    self.output_mask_thresh,
-                    mask_thresh,
-                    mask_thresh_exr_header,
-                )
-                write_exr(
-                    self.output_mask_dilated,
-                    mask_dilated,
-                    exr_header,
-                )
-                write_exr(
-                    self.output_hdri_dilated,
-                    hdri_dilated,
-                    exr_header,
-                )
-
-            else:
-                mask_thresh = output_path / f"{image_path.stem}_mask_threshold.hdr"
-                mask_dilated = output_path / f"{image_path.stem}_mask_dilated.hdr"
-                hdri_dilated = output_path / f"{image_path.stem}_dilated.hdr"
-                cv2.imwrite(str(mask_thresh), self.output_mask_thresh)
-                cv2.imwrite(str(mask_dilated), self.output_mask_dilated)
-                cv2.imwrite(str(hdri_dilated), self.output_hdri_dilated)
+        engine = self.worker.engine
+        image_path = self.parent_.image_path_lineedit.get_path()
+        output_folder = self.parent_.output_folder_lineedit.get_path()
+        is_save_output = self.parent_.save_output_checkbox.isChecked()
+        if is_save_output:
+            output = DilateOutput(
+                mask_thresh=self.output_mask_thresh,
+                mask_dilated=self.output_mask_dilated,
+                hdri_original=self.output_hdri_original,
+                hdri_dilated=self.output_hdri_dilated,
+            )
+            write_outputs(output, image_path, output_folder, profiler=engine.profiler)
+
+        for line in engine.profiler.lines():
+            self.progress_textedit.appendPlainText(line)
+
+        slowest = ", ".join(
+            f"{label} ({engine.telemetry.seconds[label]:0.2f} secs)" for label in engine.telemetry.slowest(5)
+        )
+        if slowest:
+            self.progress_textedit.appendPlainText(tr("Slowest components: {0}").format(slowest))
+
+        if is_save_output:
+            report = run_report(
+                image_path,
+                engine.params,
+                engine.profiler,
+                sorted(engine.fallback_labels),
+                engine.telemetry,
+            )
+            write_run_report(report, image_path, output_folder)
+            write_component_telemetry(engine.telemetry, image_path, output_folder)
 
+        engine.discard_checkpoint()
         self._change_abort_to_close()
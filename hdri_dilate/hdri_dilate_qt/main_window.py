@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 import cv2
@@ -7,7 +8,7 @@ from PySide6.QtCore import *
 from PySide6.QtGui import *
 from PySide6.QtWidgets import *
 
-from hdri_dilate.enums import MorphShape
+from hdri_dilate.enums import MorphShape, SaturationCriterion
 from hdri_dilate.hdri_dilate_qt import tr
 from hdri_dilate.hdri_dilate_qt.checkbox import CheckBox
 from hdri_dilate.hdri_dilate_qt.collapsible import (
@@ -118,6 +119,7 @@ class MainWindow(ComelMainWindowWrapper):
 
         self.dilate_iteration_spinbox = QSpinBox(self)
         self.dilate_iteration_spinbox.setValue(3)
+        self.dilate_iteration_spinbox.setMinimum(1)
         self.dilate_iteration_spinbox.setMaximum(50)
 
         self.dilate_size_spinbox = QSpinBox(self)
@@ -125,6 +127,66 @@ class MainWindow(ComelMainWindowWrapper):
         self.dilate_size_spinbox.setMinimum(2)
         self.dilate_size_spinbox.setMaximum(50)
 
+        self.dilate_threads_spinbox = QSpinBox(self)
+        self.dilate_threads_spinbox.setMinimum(1)
+        self.dilate_threads_spinbox.setMaximum(os.cpu_count() or 1)
+        self.dilate_threads_spinbox.setValue(os.cpu_count() or 1)
+
+        self.max_radius_spinbox = QSpinBox(self)
+        self.max_radius_spinbox.setMinimum(1)
+        self.max_radius_spinbox.setMaximum(4096)
+        self.max_radius_spinbox.setValue(64)
+
+        self.min_area_spinbox = QSpinBox(self)
+        self.min_area_spinbox.setMaximum(100000)
+        self.min_area_spinbox.setValue(0)
+
+        self.small_area_spinbox = QSpinBox(self)
+        self.small_area_spinbox.setMaximum(100000)
+        self.small_area_spinbox.setValue(0)
+
+        self.wrap_seam_checkbox = CheckBox(self)
+        self.wrap_seam_checkbox.setChecked(False)
+
+        self.merge_components_checkbox = CheckBox(self)
+        self.merge_components_checkbox.setChecked(False)
+
+        self.pyramid_levels_spinbox = QSpinBox(self)
+        self.pyramid_levels_spinbox.setMaximum(3)
+        self.pyramid_levels_spinbox.setValue(0)
+
+        self.auto_strategy_checkbox = CheckBox(self)
+        self.auto_strategy_checkbox.setChecked(False)
+        self.auto_strategy_checkbox.toggled.connect(self._auto_strategy_toggled)
+
+        self.max_iterations_spinbox = QSpinBox(self)
+        self.max_iterations_spinbox.setMaximum(1000000)
+        self.max_iterations_spinbox.setValue(0)
+        self.max_iterations_spinbox.setSpecialValueText(tr("Unlimited"))
+
+        self.max_component_seconds_spinbox = QSpinBox(self)
+        self.max_component_seconds_spinbox.setMaximum(86400)
+        self.max_component_seconds_spinbox.setValue(0)
+        self.max_component_seconds_spinbox.setSpecialValueText(tr("Unlimited"))
+
+        self.dry_run_proxy_levels_spinbox = QSpinBox(self)
+        self.dry_run_proxy_levels_spinbox.setMaximum(4)
+        self.dry_run_proxy_levels_spinbox.setValue(0)
+
+        self.checkpoint_checkbox = CheckBox(self)
+        self.checkpoint_checkbox.setChecked(True)
+        self.checkpoint_checkbox.toggled.connect(self._checkpoint_toggled)
+
+        self.checkpoint_components_spinbox = QSpinBox(self)
+        self.checkpoint_components_spinbox.setMinimum(1)
+        self.checkpoint_components_spinbox.setMaximum(100000)
+        self.checkpoint_components_spinbox.setValue(500)
+
+        self.checkpoint_minutes_spinbox = QSpinBox(self)
+        self.checkpoint_minutes_spinbox.setMinimum(1)
+        self.checkpoint_minutes_spinbox.setMaximum(240)
+        self.checkpoint_minutes_spinbox.setValue(5)
+
         self.final_intensity_multiplier_spinbox = QDoubleSpinBox(self)
         self.final_intensity_multiplier_spinbox.setValue(1.00)
         self.final_intensity_multiplier_spinbox.setSingleStep(0.01)
@@ -149,6 +211,17 @@ class MainWindow(ComelMainWindowWrapper):
         )
         self.dilate_shape_combobox.setCurrentText(MorphShape.ELLIPSIS)
 
+        self.saturation_criterion_combobox = QComboBox(self)
+        self.saturation_criterion_combobox.addItems(
+            [
+                SaturationCriterion.OTSU,
+                SaturationCriterion.ANY_CHANNEL,
+                SaturationCriterion.MAX_CHANNEL,
+                SaturationCriterion.LUMINANCE,
+            ]
+        )
+        self.saturation_criterion_combobox.setCurrentText(SaturationCriterion.OTSU)
+
         form.addRow(tr("EXR/HDR Path"), self.image_path_lineedit)
         form.addRow(tr("Output Folder"), self.output_folder_lineedit)
         form.addRow(tr("Save Output"), self.save_output_checkbox)
@@ -156,9 +229,20 @@ class MainWindow(ComelMainWindowWrapper):
         form.addRow(tr("Threshold"), self.threshold_spinbox)
         form.addRow(tr("Final Intensity Multiplier"), self.final_intensity_multiplier_spinbox)
 
+        self.advanced_form.addRow(tr("Saturation Criterion"), self.saturation_criterion_combobox)
         self.advanced_form.addRow(tr("Dilate Size (px)"), self.dilate_size_spinbox)
         self.advanced_form.addRow(tr("Dilate Iteration"), self.dilate_iteration_spinbox)
         self.advanced_form.addRow(tr("Dilate Shape"), self.dilate_shape_combobox)
+        self.advanced_form.addRow(tr("Dilate Threads"), self.dilate_threads_spinbox)
+        self.advanced_form.addRow(tr("Parallel Max Radius (px)"), self.max_radius_spinbox)
+        self.advanced_form.addRow(tr("Min Component Area (px)"), self.min_area_spinbox)
+        self.advanced_form.addRow(tr("Small Component Fast Path Area (px)"), self.small_area_spinbox)
+        self.advanced_form.addRow(tr("Equirectangular Wrap"), self.wrap_seam_checkbox)
+        self.advanced_form.addRow(tr("Merge Colliding Components"), self.merge_components_checkbox)
+        self.advanced_form.addRow(tr("Pyramid Pre-Pass Levels"), self.pyramid_levels_spinbox)
+        self.advanced_form.addRow(tr("Auto Strategy"), self.auto_strategy_checkbox)
+        self.advanced_form.addRow(tr("Max Iterations Per Component"), self.max_iterations_spinbox)
+        self.advanced_form.addRow(tr("Max Seconds Per Component"), self.max_component_seconds_spinbox)
         self.advanced_form.addRow(tr("Terminate Early When Any Channel Hit Threshold"), self.terminate_early_checkbox)
         self.advanced_form.addRow(tr("Use BGR Order"), self.use_bgr_order_checkbox)
         self.advanced_form.addRow(tr("Use Blur"), self.use_blur_checkbox)
@@ -166,10 +250,21 @@ class MainWindow(ComelMainWindowWrapper):
         self.advanced_form.addRow(tr("Export Debug Dilate Figures?"), self.export_debug_dilate_checkbox)
         self.advanced_form.addRow(tr("Export Debug Dilate Interval"), self.export_debug_dilate_interval_spinbox)
         self.advanced_form.addRow(tr("Show Debug Preview?"), self.show_debug_preview_checkbox)
+        self.advanced_form.addRow(tr("Dry Run Proxy Levels"), self.dry_run_proxy_levels_spinbox)
+        self.advanced_form.addRow(tr("Checkpoint And Resume"), self.checkpoint_checkbox)
+        self.advanced_form.addRow(tr("Checkpoint Every N Components"), self.checkpoint_components_spinbox)
+        self.advanced_form.addRow(tr("Checkpoint Every N Minutes"), self.checkpoint_minutes_spinbox)
 
         self.generate_btn = QPushButton(tr("Generate"))
         self.generate_btn.clicked.connect(self.generate)
 
+        self.dry_run_btn = QPushButton(tr("Dry Run"))
+        self.dry_run_btn.setToolTip(tr(
+            "Only find the connected components and report their count and areas, "
+            "the predicted iterations, peak memory and ETA"
+        ))
+        self.dry_run_btn.clicked.connect(self.dry_run)
+
         advanced_settings = CollapsibleWidget("Advanced Settings", self)
         advanced_settings.addWidget(self.advanced_form)
         advanced_settings.collapse()
@@ -177,6 +272,7 @@ class MainWindow(ComelMainWindowWrapper):
         self.central_widget.addWidget(form)
         self.central_widget.addWidget(advanced_settings)
         self.central_widget.addWidget(self.generate_btn)
+        self.central_widget.addWidget(self.dry_run_btn)
         self.central_widget.addStretch()
 
     def show_exr_raw_metadata_dialog(self):
@@ -196,10 +292,19 @@ class MainWindow(ComelMainWindowWrapper):
         if blur_size % 2 == 0:
             self.blur_size_spinbox.setValue(blur_size - 1)
 
+    def _auto_strategy_toggled(self):
+        checked = self.auto_strategy_checkbox.isChecked()
+        self.pyramid_levels_spinbox.setEnabled(not checked)
+
+    def _checkpoint_toggled(self):
+        checked = self.checkpoint_checkbox.isChecked()
+        self.checkpoint_components_spinbox.setEnabled(checked)
+        self.checkpoint_minutes_spinbox.setEnabled(checked)
+
     def setup_toolbar(self):
         ...
 
-    def generate(self):
+    def _validate_hdri_input(self) -> bool:
         hdri_input = self.image_path_lineedit.get_path()
         if not hdri_input:
             msg = tr(
@@ -209,7 +314,7 @@ class MainWindow(ComelMainWindowWrapper):
                 title=tr("Blank EXR/HDR Path"),
                 text=msg
             )
-            return
+            return False
 
         is_valid_hdri_path = self.image_path_lineedit.validate_path()
         if not is_valid_hdri_path:
@@ -221,7 +326,7 @@ class MainWindow(ComelMainWindowWrapper):
                 title=tr("Warning"),
                 text=msg
             )
-            return
+            return False
 
         if not Path(hdri_input).exists():
             msg = tr(
@@ -232,6 +337,12 @@ class MainWindow(ComelMainWindowWrapper):
                 title=tr("Warning"),
                 text=msg
             )
+            return False
+
+        return True
+
+    def generate(self):
+        if not self._validate_hdri_input():
             return
 
         is_save_output = self.save_output_checkbox.isChecked()
@@ -260,3 +371,10 @@ class MainWindow(ComelMainWindowWrapper):
 
         dialog = DilateProgressDialog(self)
         dialog.show()
+
+    def dry_run(self):
+        if not self._validate_hdri_input():
+            return
+
+        dialog = DilateProgressDialog(self, dry_run=True)
+        dialog.show()
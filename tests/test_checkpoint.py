@@ -0,0 +1,68 @@
+import numpy as np
+
+from hdri_dilate.dilate.checkpoint import ComponentCheckpoint, checkpoint_key
+from hdri_dilate.dilate.components import ComponentResult
+from hdri_dilate.dilate.engine import DilateParams
+
+
+def _result(label: int, **kwargs) -> ComponentResult:
+    mask = np.zeros((4, 6), dtype=np.uint8)
+    mask[1:3, 2:5] = 128
+    return ComponentResult(label, (10, 20, 16, 24), mask, (12, 21, 15, 23), (1.5, 2.5, 3.5), label * 2, **kwargs)
+
+
+def test_chunks_round_trip_every_component(tmp_path):
+    checkpoint = ComponentCheckpoint(tmp_path, every_components=2)
+    saved = [
+        _result(1),
+        _result(2, fallback=True),
+        _result(3, terminated_early=True),
+    ]
+    checkpoint.record(saved[0], [7])
+    checkpoint.record(saved[1])
+    checkpoint.record(saved[2], [8, 9])
+    checkpoint.save()
+
+    resumed = ComponentCheckpoint(tmp_path)
+    loaded = resumed.load()
+
+    assert resumed.saved_count == 3
+    assert resumed.chunk_index == 2
+    assert [absorbed for _, absorbed in loaded] == [[7], [], [8, 9]]
+    for expected, (result, _) in zip(saved, loaded):
+        assert np.array_equal(result.mask, expected.mask)
+        assert (result.label, result.roi, result.bbox, result.fill, result.iterations) == (
+            expected.label, expected.roi, expected.bbox, expected.fill, expected.iterations
+        )
+        assert (result.fallback, result.terminated_early) == (expected.fallback, expected.terminated_early)
+
+
+def test_unreadable_chunks_are_skipped(tmp_path):
+    checkpoint = ComponentCheckpoint(tmp_path, every_components=1)
+    checkpoint.record(_result(1))
+    checkpoint.record(_result(2))
+    (tmp_path / "chunk-00001.npz").write_bytes(b"cut short")
+
+    resumed = ComponentCheckpoint(tmp_path)
+
+    assert [result.label for result, _ in resumed.load()] == [1]
+    # New chunks never overwrite the skipped one
+    assert resumed.chunk_index == 2
+
+
+def test_discard_removes_the_checkpoint(tmp_path):
+    checkpoint = ComponentCheckpoint(tmp_path / "run", every_components=1)
+    checkpoint.record(_result(1))
+    checkpoint.discard()
+
+    assert not (tmp_path / "run").exists()
+
+
+def test_key_ignores_runtime_params_only():
+    hdri = np.ones((8, 8, 3), dtype=np.float32)
+    key = checkpoint_key(hdri, DilateParams())
+
+    assert checkpoint_key(hdri, DilateParams(max_workers=3)) == key
+    assert checkpoint_key(hdri, DilateParams(threshold=2.0)) != key
+    hdri[0, 0] = 2.0
+    assert checkpoint_key(hdri, DilateParams()) != key
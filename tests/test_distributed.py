@@ -0,0 +1,105 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from hdri_dilate.dilate.batch import FileReport
+from hdri_dilate.dilate.distributed import SharedQueue
+
+FINGERPRINT = {"params_key": "params", "input_hash": "input"}
+
+
+def _node(queue_folder, name: str, **kwargs) -> SharedQueue:
+    queue = SharedQueue(queue_folder, **kwargs)
+    queue.node = name
+    return queue
+
+
+def _backdate(path, seconds: float):
+    mtime = time.time() - seconds
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def nodes(tmp_path):
+    return _node(tmp_path / "queue", "a", lease_seconds=60), _node(tmp_path / "queue", "b", lease_seconds=60)
+
+
+def test_racing_nodes_claim_every_job_once(nodes):
+    keys = [f"job-{index}" for index in range(50)]
+    claimed = {node.node: [] for node in nodes}
+    barrier = threading.Barrier(len(nodes))
+
+    def claim_all(node: SharedQueue):
+        barrier.wait()
+        claimed[node.node] = [key for key in keys if node.claim(key, FINGERPRINT)]
+
+    threads = [threading.Thread(target=claim_all, args=(node,)) for node in nodes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed["a"] + claimed["b"]) == sorted(keys)
+
+
+def test_held_lease_is_not_stolen(nodes):
+    a, b = nodes
+    assert a.claim("job", FINGERPRINT)
+
+    assert not b.claim("job", FINGERPRINT)
+
+
+def test_expired_lease_is_stolen(nodes):
+    a, b = nodes
+    assert a.claim("job", FINGERPRINT)
+    _backdate(a._lock_path("job"), 120)
+
+    assert b.claim("job", FINGERPRINT)
+    with open(b._lock_path("job"), encoding="utf-8") as f:
+        assert json.load(f)["node"] == "b"
+
+
+def test_heartbeat_leaves_the_lock_of_another_node(nodes):
+    a, b = nodes
+    assert a.claim("job", FINGERPRINT)
+    _backdate(a._lock_path("job"), 120)
+    assert b.claim("job", FINGERPRINT)
+    _backdate(b._lock_path("job"), 30)
+    mtime = b._lock_path("job").stat().st_mtime
+
+    a.heartbeat()
+    a.release("job")
+
+    assert b._lock_path("job").stat().st_mtime == mtime
+
+
+def test_success_settles_only_the_same_fingerprint_with_its_outputs(nodes, tmp_path):
+    a, b = nodes
+    output = tmp_path / "job_dilated.exr"
+    output.write_bytes(b"output")
+    assert a.claim("job", FINGERPRINT)
+    a.finish("job", FileReport("job.exr", outputs=[str(output)]), FINGERPRINT)
+
+    assert b.is_settled("job", FINGERPRINT)
+    assert not b.is_settled("job", {**FINGERPRINT, "params_key": "other params"})
+    assert not b.is_settled("job", {**FINGERPRINT, "input_hash": "re-rendered"})
+
+    output.unlink()
+    assert not b.is_settled("job", FINGERPRINT)
+    assert b.claim("job", FINGERPRINT)
+
+
+def test_failures_settle_once_out_of_attempts(tmp_path):
+    a = _node(tmp_path / "queue", "a", max_attempts=2)
+    for attempts in (1, 2):
+        assert a.claim("job", FINGERPRINT)
+        a.finish("job", FileReport("job.exr", error="boom"), FINGERPRINT)
+        assert a.result("job")["attempts"] == attempts
+
+    assert a.is_settled("job", FINGERPRINT)
+    assert not a.claim("job", FINGERPRINT)
+    # Other params start over
+    assert a.claim("job", {**FINGERPRINT, "params_key": "other params"})
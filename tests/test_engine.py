@@ -0,0 +1,77 @@
+import numpy as np
+
+from hdri_dilate.dilate.components import ImageFrame
+from hdri_dilate.dilate.engine import DilateEngine, DilateParams
+
+
+def _hdri() -> np.ndarray:
+    hdri = np.full((32, 32, 3), 0.5, dtype=np.float32)
+    hdri[14:18, 14:18] = 20.0
+    return hdri
+
+
+def test_run_cancelled_before_start_returns_none():
+    engine = DilateEngine(DilateParams(max_workers=1))
+    engine.cancel()
+
+    assert engine.run(_hdri()) is None
+
+
+def test_dry_run_cancelled_before_start_returns_none():
+    engine = DilateEngine(DilateParams(max_workers=1))
+    engine.cancel()
+
+    assert engine.dry_run(_hdri()) is None
+
+
+def test_run_not_cancelled_returns_output():
+    output = DilateEngine(DilateParams(max_workers=1)).run(_hdri())
+
+    assert output is not None
+    assert output.hdri_dilated.shape == (32, 32, 3)
+
+
+def test_growth_stops_when_the_kernel_does_not_grow_the_mask():
+    # A zero iteration kernel is a single pixel, so no step ever grows the seed
+    for small_area in (0, 1000):
+        engine = DilateEngine(DilateParams(max_workers=1, dilate_iteration=0, use_blur=False, small_area=small_area))
+        output = engine.run(_hdri())
+
+        assert output is not None
+        assert engine.telemetry.iterations[1] == 1
+        assert engine.telemetry.dilated_area[1] == 16
+
+
+def test_blur_keeps_roi_reaching_past_the_margin():
+    engine = DilateEngine(DilateParams(blur_size=9))
+    engine.frame = ImageFrame(100, 100)
+    mask = np.zeros((60, 70), dtype=np.uint8)
+    mask[0:10, 10:20] = 255
+
+    # The ROI starts on the bbox top edge but reaches far past the blur margin on the right
+    result = engine._finish_component(1, (30, 40, 100, 100), mask, (40, 40, 50, 50), (2.0, 2.0, 2.0), 1)
+
+    assert result.roi == (30, 32, 100, 100)
+    assert result.mask.shape == (68, 70)
+    assert result.bbox == (36, 36, 54, 54)
+
+
+def test_terminated_early_comes_from_the_growth_loop():
+    # Blue stays above the threshold while red and green fall below it
+    hdri = np.full((32, 32, 3), (0.5, 0.5, 5.0), dtype=np.float32)
+    hdri[14:18, 14:18] = 20.0
+
+    for small_area in (0, 1000):
+        engine = DilateEngine(DilateParams(max_workers=1, terminate_early=True, small_area=small_area))
+        engine.run(hdri)
+
+        assert engine.telemetry.labels().tolist() == [1]
+        assert engine.telemetry.terminated_early[1]
+
+
+def test_not_terminated_early_when_every_channel_falls():
+    engine = DilateEngine(DilateParams(max_workers=1, terminate_early=True))
+    engine.run(_hdri())
+
+    assert engine.telemetry.labels().tolist() == [1]
+    assert not engine.telemetry.terminated_early[1]
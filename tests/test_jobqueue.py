@@ -0,0 +1,115 @@
+import socket
+import subprocess
+import sys
+
+import pytest
+
+from hdri_dilate.dilate.batch import FileReport
+from hdri_dilate.dilate.engine import DilateParams
+from hdri_dilate.dilate.jobqueue import DONE, FAILED, PENDING, RUNNING, JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    with JobQueue(tmp_path / "queue.db", max_attempts=2) as queue:
+        yield queue
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    paths = []
+    for name in ("a.exr", "b.exr"):
+        path = tmp_path / name
+        path.write_bytes(name.encode() * 100)
+        paths.append(path)
+
+    return paths
+
+
+def _state(queue: JobQueue, job_id: int) -> tuple[str, int]:
+    row = queue.connection.execute("SELECT state, attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return row["state"], row["attempts"]
+
+
+def _finish_done(queue: JobQueue, tmp_path) -> list:
+    """Claim and finish every job with an output written to ``tmp_path``"""
+    outputs = []
+    while (job := queue.claim()) is not None:
+        output = tmp_path / f"{job.id}_dilated.exr"
+        output.write_bytes(b"output")
+        outputs.append(output)
+        queue.finish(job.id, FileReport(job.image_path, outputs=[str(output)]))
+
+    return outputs
+
+
+def test_add_skips_done_jobs_with_their_outputs(queue, inputs, tmp_path):
+    assert queue.add(inputs, tmp_path / "out", DilateParams()) == {"queued": 2, "skipped": 0}
+    _finish_done(queue, tmp_path)
+
+    # Only the threads differ, they do not change the outputs
+    assert queue.add(inputs, tmp_path / "out", DilateParams(max_workers=3)) == {"queued": 0, "skipped": 2}
+    assert queue.claim() is None
+
+
+def test_add_requeues_changed_params_inputs_and_missing_outputs(queue, inputs, tmp_path):
+    queue.add(inputs, tmp_path / "out", DilateParams())
+    _finish_done(queue, tmp_path)
+
+    assert queue.add(inputs, tmp_path / "out", DilateParams(threshold=2.0)) == {"queued": 2, "skipped": 0}
+    _finish_done(queue, tmp_path)
+
+    inputs[0].write_bytes(b"re-rendered")
+    assert queue.add(inputs, tmp_path / "out", DilateParams(threshold=2.0)) == {"queued": 1, "skipped": 1}
+    outputs = _finish_done(queue, tmp_path)
+
+    outputs[0].unlink()
+    assert queue.add(inputs, tmp_path / "out", DilateParams(threshold=2.0)) == {"queued": 1, "skipped": 1}
+
+
+def test_claim_hands_every_job_to_a_single_worker(queue, inputs, tmp_path):
+    queue.add(inputs, tmp_path / "out", DilateParams())
+    with JobQueue(queue.db_path) as other:
+        first = queue.claim()
+        second = other.claim()
+
+        assert {first.id, second.id} == {1, 2}
+        assert queue.claim() is None
+        assert other.claim() is None
+        assert first.params == DilateParams()
+
+
+def test_claim_retries_failed_jobs_until_out_of_attempts(queue, inputs, tmp_path):
+    queue.add(inputs[:1], tmp_path / "out", DilateParams())
+    for attempt in (1, 2):
+        job = queue.claim()
+        assert _state(queue, job.id) == (RUNNING, attempt)
+        queue.finish(job.id, FileReport(job.image_path, error="boom"))
+
+    assert _state(queue, job.id) == (FAILED, 2)
+    assert queue.claim() is None
+
+
+def test_release_does_not_use_an_attempt(queue, inputs, tmp_path):
+    queue.add(inputs[:1], tmp_path / "out", DilateParams())
+    job = queue.claim()
+    queue.release(job.id)
+
+    assert _state(queue, job.id) == (PENDING, 0)
+    assert queue.claim().id == job.id
+
+
+def test_recover_requeues_jobs_of_dead_workers_on_this_host(queue, inputs, tmp_path):
+    queue.add(inputs, tmp_path / "out", DilateParams())
+    dead = queue.claim()
+    alive = queue.claim()
+    process = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+    queue.connection.execute(
+        "UPDATE jobs SET claimed_by = ? WHERE id = ?",
+        (f"{socket.gethostname()}:{process.stdout.strip()}", dead.id),
+    )
+
+    assert queue.recover() == 1
+    assert _state(queue, dead.id)[0] == PENDING
+    assert _state(queue, alive.id)[0] == RUNNING
+    assert queue.counts() == {PENDING: 1, RUNNING: 1, DONE: 0, FAILED: 0}
@@ -0,0 +1,98 @@
+import threading
+from pathlib import Path
+
+import pytest
+
+from hdri_dilate.dilate.engine import DilateParams
+from hdri_dilate.dilate.memory import (
+    MemoryBudget,
+    admission_order,
+    estimate_file_peak_bytes,
+    estimate_peak_bytes,
+    parse_size,
+)
+
+
+def test_budget_admits_jobs_while_they_fit():
+    budget = MemoryBudget(100)
+
+    assert budget.try_acquire(60)
+    assert budget.try_acquire(40)
+    assert not budget.try_acquire(1)
+
+    budget.release(40)
+    assert budget.try_acquire(30)
+    assert (budget.in_use, budget.running) == (90, 2)
+
+
+def test_budget_admits_an_oversized_job_alone():
+    budget = MemoryBudget(100)
+
+    assert budget.try_acquire(500)
+    assert not budget.try_acquire(1)
+
+    budget.release(500)
+    assert budget.try_acquire(1)
+    assert not budget.try_acquire(500)
+
+
+def test_no_budget_admits_everything():
+    budget = MemoryBudget(None)
+
+    assert all(budget.try_acquire(2 ** 40) for _ in range(10))
+
+
+def test_acquire_waits_for_a_release():
+    budget = MemoryBudget(100)
+    budget.try_acquire(80)
+    acquired = threading.Event()
+
+    def acquire():
+        if budget.acquire(50, timeout=10):
+            acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not acquired.wait(0.1)
+
+    budget.release(80)
+    thread.join()
+    assert acquired.is_set()
+    assert not budget.acquire(60, timeout=0.01)
+
+
+def test_admission_order_starts_with_the_largest_jobs():
+    inputs = [Path("small.exr"), Path("large.exr"), Path("medium.exr")]
+    estimates = dict(zip(inputs, (1, 3, 2)))
+
+    assert admission_order(inputs, estimates) == [Path("large.exr"), Path("medium.exr"), Path("small.exr")]
+
+
+def test_estimate_scales_with_the_pixels():
+    small = estimate_peak_bytes(1024, 2048, DilateParams())
+    large = estimate_peak_bytes(2048, 4096, DilateParams())
+
+    assert large - small == 3 * (small - estimate_peak_bytes(0, 0, DilateParams()))
+    assert estimate_peak_bytes(1024, 2048, DilateParams(pyramid_levels=2)) > small
+
+
+def test_unreadable_files_are_estimated_as_16k_plates(tmp_path):
+    path = tmp_path / "broken.exr"
+    path.write_bytes(b"not an exr")
+
+    assert estimate_file_peak_bytes(path, DilateParams()) == estimate_peak_bytes(8192, 16384, DilateParams())
+
+
+@pytest.mark.parametrize("text, size", [
+    ("1073741824", 1024 ** 3),
+    ("96G", 96 * 1024 ** 3),
+    ("512mb", 512 * 1024 ** 2),
+    ("1.5 GiB", int(1.5 * 1024 ** 3)),
+])
+def test_parse_size(text, size):
+    assert parse_size(text) == size
+
+
+def test_parse_size_rejects_garbage():
+    with pytest.raises(ValueError):
+        parse_size("lots")
@@ -0,0 +1,26 @@
+import cv2
+import numpy as np
+
+from hdri_dilate.dilate.pyramid import PyramidEstimator
+
+
+def _estimator(is_exceeded) -> PyramidEstimator:
+    hdri = np.full((64, 64, 3), 0.5, dtype=np.float32)
+    hdri[28:36, 28:36] = 20.0
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (7, 7))
+    return PyramidEstimator(hdri, 2, cv2.MORPH_RECT, kernel, is_exceeded, 16)
+
+
+def test_coarse_steps_stop_below_the_threshold():
+    estimator = _estimator(lambda channels: any(channel >= 1.0 for channel in channels))
+    ys, xs = np.mgrid[28:36, 28:36]
+
+    assert 1 <= estimator.coarse_steps(ys.ravel(), xs.ravel()) < estimator.max_steps
+
+
+def test_coarse_steps_stop_once_the_mask_fills_the_frame():
+    estimator = _estimator(lambda channels: True)
+    ys, xs = np.mgrid[28:36, 28:36]
+
+    # The 16x16 coarse frame is covered after 7 steps of one pixel, so the 8th no longer grows it
+    assert estimator.coarse_steps(ys.ravel(), xs.ravel()) == 8